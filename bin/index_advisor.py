@@ -0,0 +1,40 @@
+#! /usr/bin/env python3
+
+"""
+Replay the lookups recorded by the routes (see `DEBUG_QUERY_SHAPES` setting)
+to find the ones not served by an index
+"""
+
+import pymongo
+from sys import argv
+
+from vigiechiro import settings
+from vigiechiro.xin.debug import explain_query_shapes, QUERY_SHAPES_COLLECTION
+
+
+conn = pymongo.MongoClient(host=settings.MONGO_HOST)
+db = conn.get_default_database()
+
+
+def advise():
+    results = explain_query_shapes(db)
+    for shape, issues in results:
+        print('{} {} {} sort={} : {}'.format(shape.get('command', 'find'), shape['collection'],
+                                            shape['filter'], shape.get('sort'), ', '.join(issues)))
+        print('    routes: {}'.format(', '.join(str(r) for r in shape['routes'])))
+    print('{} query shapes with issues'.format(len(results)))
+    return results
+
+
+def reset():
+    db[QUERY_SHAPES_COLLECTION].drop()
+
+
+if __name__ == '__main__':
+    if len(argv) == 1:
+        if advise():
+            raise SystemExit(1)
+    elif len(argv) == 2 and argv[1] == 'reset':
+        reset()
+    else:
+        print('%s [reset]' % argv[0])
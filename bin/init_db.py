@@ -8,7 +8,9 @@ import pymongo
 from datetime import datetime, timedelta
 from sys import argv
 
-from vigiechiro import settings
+from vigiechiro import settings, resources
+from vigiechiro.xin import Resource
+from vigiechiro.xin.auth import build_token_index, sweep_expired_tokens
 
 
 COLLECTIONS = [
@@ -21,7 +23,8 @@ COLLECTIONS = [
     'sites',
     'taxons',
     'utilisateurs',
-    'configuration'
+    'configuration',
+    'campagnes'
 ]
 
 
@@ -34,40 +37,38 @@ def clean_db():
 
 
 def ensure_indexes():
-    db.grille_stoc.create_index([('centre', pymongo.GEOSPHERE)])
-    db.utilisateurs.create_index([
-        ('email', pymongo.TEXT),
-        ('pseudo', pymongo.TEXT),
-        ('nom', pymongo.TEXT),
-        ('prenom', pymongo.TEXT),
-        ('organisation', pymongo.TEXT),
-        ('tag', pymongo.TEXT)
-    ], default_language='french', name='utilisateursTextIndex')
-    db.taxons.create_index([
-        ('libelle_long', pymongo.TEXT),
-        ('libelle_court', pymongo.TEXT),
-        ('tags', pymongo.TEXT)
-    ], default_language='french', name='taxonsTextIndex')
-    db.taxons.create_index([('libelle_long', 1)])
-    db.protocoles.create_index([
-        ('titre', pymongo.TEXT),
-        ('tags', pymongo.TEXT)
-    ], default_language='french', name='protocolesTextIndex')
-    db.sites.create_index([
-        ('titre', pymongo.TEXT)
-    ], default_language='french', name='sitesTextIndex')
-    db.sites.create_index([('titre', 1)])
-    db.sites.create_index([('protocole', 1)])
-    db.actualites.create_index([('_updated', -1)])
-    db.fichiers.create_index([('titre', 1), ('mime', 1)])
-    db.fichiers.create_index([('s3_id', 1)])
-    db.fichiers.create_index([("lien_participation", 1) , ("mime", 1)])
-    db.donnees.create_index([('proprietaire', 1), ('publique', 1)])
-    db.donnees.create_index([('participation', 1), ('titre', 1)])
-    db.donnees.create_index([("observations.tadarida_taxon", 1) , ("observations.tadarida_probabilite", 1), ("_created", 1)])
-    db.donnees.create_index([("observations.tadarida_taxon", 1) , ("participation" , 1)])
-    db.queuer.create_index([('status', 1)])
-    db.queuer.create_index([('submitted', 1)])
+    db.queuer_jobs.create_index([('status', 1)])
+    db.queuer_jobs.create_index([('submitted', 1)])
+    db.queuer_jobs.create_index([('status', 1), ('submitted', 1)])
+    db.queuer_jobs.create_index([('status', 1), ('lane', 1), ('submitted', 1)])
+    # Guarantee a singleton job is only waiting once
+    db.queuer_jobs.create_index(
+        [('coalesce_key', 1)], unique=True, name='coalesce_key_ready',
+        partialFilterExpression={'status': 'READY', 'coalesce_key': {'$exists': True}})
+    # Finished jobs archive, also used by the queue statistics
+    retention = settings.QUEUER_ARCHIVE_RETENTION_DAYS * 24 * 3600
+    try:
+        db.queuer_jobs_archive.create_index([('finished_at', 1)],
+                                            expireAfterSeconds=retention)
+    except pymongo.errors.OperationFailure:
+        # Retention has changed
+        db.command('collMod', 'queuer_jobs_archive',
+                   index={'keyPattern': {'finished_at': 1}, 'expireAfterSeconds': retention})
+    # Reprocessing campaigns progress
+    db.queuer_jobs.create_index([('kwargs.campagne', 1)], sparse=True)
+    db.queuer_jobs_archive.create_index([('kwargs.campagne', 1), ('status', 1)], sparse=True)
+    # Expired locks are free to be taken again, this only cleans them up
+    db.queuer_jobs_locks.create_index([('expires_at', 1)], expireAfterSeconds=0)
+    # Indexes declared by the resources (and their unique fields)
+    failed = []
+    for name in COLLECTIONS:
+        resource = getattr(resources, name, None)
+        if isinstance(resource, Resource):
+            failed += ['%s.%s' % (name, index) for index in resource.ensure_indexes(db)]
+    # Watermark used to detect the modifications of the cached resources
+    for resource in settings.RESOURCES_CACHE:
+        db[resource].create_index([('_updated', -1)])
+    return failed
 
 
 def insert_default_documents():
@@ -77,15 +78,21 @@ def insert_default_documents():
         'protocole_routier_count': 600
     })
     # Script worker utilisateur
+    token_expire = datetime.utcnow() + timedelta(days=settings.SCRIPT_WORKER_EXPIRES)
     db.utilisateurs.insert_one({
             'pseudo': 'script_worker',
             'email': 'script_worker@email.com',
             'role': 'Administrateur',
-            'tokens': {settings.SCRIPT_WORKER_TOKEN:
-            datetime.utcnow() + timedelta(days=settings.SCRIPT_WORKER_EXPIRES)}
+            'tokens': {settings.SCRIPT_WORKER_TOKEN: token_expire},
+            'tokens_index': [build_token_index(settings.SCRIPT_WORKER_TOKEN, token_expire)]
         })
 
 
+def check_indexes(failed):
+    if failed:
+        raise SystemExit('Cannot create indexes {}'.format(', '.join(failed)))
+
+
 def reset_db():
     print('You are about to fully ERASE the database {green}{name}{endc}'.format(
         green='\033[92m', name=settings.MONGO_HOST, endc='\033[0m'))
@@ -96,7 +103,7 @@ def reset_db():
     clean_db()
     print(' Done !')
     print('Creating indexes...', flush=True, end='')
-    ensure_indexes()
+    check_indexes(ensure_indexes())
     print(' Done !')
     insert_default_documents()
 
@@ -106,8 +113,10 @@ if __name__ == '__main__':
         if argv[1] == 'reset':
             reset_db()
         elif argv[1] == 'ensure_indexes':
-            ensure_indexes()
+            check_indexes(ensure_indexes())
+        elif argv[1] == 'sweep_tokens':
+            print('%s utilisateurs updated' % sweep_expired_tokens(db))
         else:
-            print('%s [reset|ensure_indexes]' % argv[0])
+            print('%s [reset|ensure_indexes|sweep_tokens]' % argv[0])
     else:
-        print('%s [reset|ensure_indexes]' % argv[0])
+        print('%s [reset|ensure_indexes|sweep_tokens]' % argv[0])
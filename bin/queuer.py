@@ -1,29 +1,45 @@
 #! /usr/bin/env python3
 
+import sys
 from sys import argv
 from bson import ObjectId
 from pprint import pprint
 from functools import wraps
 
-from vigiechiro.scripts import queuer, participation_generate_bilan, process_participation, participation_generate_observations_csv
+# Only import the queue primitives here, the application and the tasks
+# are loaded when needed to keep the simple commands (e.g. `pendings`) fast
+from vigiechiro.scripts import queuer
+from vigiechiro.scripts.queuer import DEFAULT_LANE
 
 
 USAGE = """usage:
 {cmd} submit [participation|bilan|observations_csv] <partication_id>    Submit a task as a job for asynchronous execution
 {cmd} exec [participation|bilan|observations_csv] <partication_id>      Synchronous execution of the given task
 {cmd} consume [<job_id>|next_job]                      Synchronous execution of the given job
+{cmd} worker [<lane>,...]                              Execute jobs (from the given lanes by priority) until SIGTERM
+{cmd} pool --workers <N> [--lane-cap <lane>=<max>...]  Run and supervise N workers, with per-lane concurrency caps
 {cmd} pendings                                         Return number of pending jobs
+{cmd} inflight                                         Return number of running jobs
+{cmd} reap                                             Requeue or fail the jobs whose worker is lost
+{cmd} sweep_tokens                                     Remove the expired authentication tokens
+{cmd} estimate                                         Return recommended slurm options per pending job
+{cmd} stats                                            Return per task queue depth, latencies and throughput
 {cmd} info <job_id>                                    Return info on a given job
+{cmd} campaign create <titre> <version_c> [--protocole <id>] [--after <date>] [--before <date>] [--rate <per_hour>] [--max-queued <N>]
+                                                       Reprocess the participations not processed with the given tadarida C version
+{cmd} campaign feed                                    Submit the next jobs of the running campaigns
+{cmd} campaign status [<campaign_id>]                  Return the progress of the campaigns
 """.format(cmd=argv[0])
 
 
 def get_task(shortname):
+    from vigiechiro import scripts
     if shortname == 'participation':
-        return process_participation
+        return scripts.process_participation
     elif shortname == 'bilan':
-        return participation_generate_bilan
+        return scripts.participation_generate_bilan
     elif shortname == "observations_csv":
-        return participation_generate_observations_csv
+        return scripts.participation_generate_observations_csv
     else:
         raise RuntimeError('Unknown task %s' % shortname)
 
@@ -38,20 +54,103 @@ def context(f):
 
 
 @context
+def run_worker(lanes):
+    from vigiechiro.scripts.queuer_pool import GracefulStop
+    queuer.run_worker(lanes, should_stop=GracefulStop())
+
+
+def run_pool(args):
+    from vigiechiro.scripts.queuer_pool import WorkerPool
+    workers = None
+    lane_caps = {}
+    while args:
+        if args[0] == '--workers' and len(args) > 1:
+            workers = int(args[1])
+        elif args[0] == '--lane-cap' and len(args) > 1:
+            lane, cap = args[1].split('=')
+            lane_caps[lane] = int(cap)
+        else:
+            raise SystemExit(USAGE)
+        args = args[2:]
+    if not workers:
+        raise SystemExit(USAGE)
+    queuer.load_tasks()
+    lanes = sorted({task.lane for task in queuer.registered_tasks.values()} | {DEFAULT_LANE})
+    worker_cmd = [sys.executable, __file__, 'worker']
+    WorkerPool(worker_cmd, workers, lanes, lane_caps=lane_caps).run()
+
+
 def pending_jobs_count():
     return queuer.get_pending_jobs_count()
 
 
+def inflight_jobs_count():
+    return queuer.get_inflight_jobs_count()
+
+
 @context
+def reap_expired_jobs():
+    return queuer.reap_expired_jobs()
+
+
+def sweep_expired_tokens():
+    from vigiechiro.xin.auth import sweep_expired_tokens
+    return sweep_expired_tokens(queuer.get_db())
+
+
+def estimate_pending_jobs():
+    from vigiechiro.scripts.queuer_estimator import estimate_pending_jobs, format_sbatch_options
+    return [(job, format_sbatch_options(recommended))
+            for job, recommended in estimate_pending_jobs(queuer)]
+
+
+def jobs_stats():
+    return queuer.get_stats()
+
+
 def pending_jobs_info():
     return list(queuer.get_pending_jobs()[:20])
 
 
-@context
 def get_job_status(job_id):
     return queuer.collection.find_one({'_id': job_id})
 
 
+@context
+def create_campaign(args):
+    from vigiechiro.resources.campagnes import create_campagne
+    options = {'--protocole': 'protocole', '--after': 'date_debut_min',
+               '--before': 'date_debut_max', '--rate': 'debit_par_heure',
+               '--max-queued': 'max_en_attente'}
+    if len(args) < 2:
+        raise SystemExit(USAGE)
+    payload = {'titre': args[0], 'version_tadarida_c': args[1]}
+    args = args[2:]
+    while args:
+        if args[0] not in options or len(args) < 2:
+            raise SystemExit(USAGE)
+        value = args[1]
+        if args[0] in ('--rate', '--max-queued'):
+            value = int(value)
+        payload[options[args[0]]] = value
+        args = args[2:]
+    return create_campagne(payload)
+
+
+@context
+def feed_campaigns():
+    from vigiechiro.resources.campagnes import feed_campagnes
+    return feed_campagnes()
+
+
+@context
+def campaigns_status(campaign_id=None):
+    from vigiechiro.resources.campagnes import campagnes, get_campagne_progress
+    lookup = {'_id': campaign_id} if campaign_id else {'etat': {'$in': ['EN_COURS', 'PAUSE']}}
+    found, _ = campagnes.find(lookup)
+    return [(c, get_campagne_progress(c)) for c in found]
+
+
 @context
 def submit_job(task, *args, **kwargs):
     return task.delay(*args, **kwargs)
@@ -63,6 +162,31 @@ def main():
             count = pending_jobs_count()
             print(count)
             raise SystemExit(0)
+        elif argv[1] == 'worker' and len(argv) in (2, 3):
+            lanes = argv[2].split(',') if len(argv) == 3 else None
+            run_worker(lanes)
+            raise SystemExit(0)
+        elif argv[1] == 'pool':
+            run_pool(argv[2:])
+            raise SystemExit(0)
+        elif argv[1] == 'inflight' and len(argv) == 2:
+            count = inflight_jobs_count()
+            print(count)
+            raise SystemExit(0)
+        elif argv[1] == 'reap' and len(argv) == 2:
+            for job_id, status in reap_expired_jobs():
+                print('Job %s reaped, now %s' % (job_id, status))
+            raise SystemExit(0)
+        elif argv[1] == 'sweep_tokens' and len(argv) == 2:
+            print('%s utilisateurs updated' % sweep_expired_tokens())
+            raise SystemExit(0)
+        elif argv[1] == 'estimate' and len(argv) == 2:
+            for job, options in estimate_pending_jobs():
+                print('%s %s %s' % (job['_id'], job['name'], options))
+            raise SystemExit(0)
+        elif argv[1] == 'stats' and len(argv) == 2:
+            pprint(jobs_stats())
+            raise SystemExit(0)
         elif argv[1] == 'info':
             if len(argv) == 2:
                 data = pending_jobs_info()
@@ -73,6 +197,24 @@ def main():
                 if data:
                     pprint(data)
                     raise SystemExit(0)
+        elif argv[1] == 'campaign' and len(argv) > 2:
+            if argv[2] == 'create':
+                campaign = create_campaign(argv[3:])
+                print('Created campaign %s (%s participations selected, %s up to date)' % (
+                    campaign['_id'], campaign['nb_selectionnees'], campaign['nb_a_jour']))
+                raise SystemExit(0)
+            elif argv[2] == 'feed' and len(argv) == 3:
+                for campaign_id, count in feed_campaigns().items():
+                    print('Campaign %s: %s jobs submitted' % (campaign_id, count))
+                raise SystemExit(0)
+            elif argv[2] == 'status' and len(argv) in (3, 4):
+                campaign_id = ObjectId(argv[3]) if len(argv) == 4 else None
+                for campaign, progress in campaigns_status(campaign_id):
+                    print('Campaign %s (%s) %s: %s/%s submitted' % (
+                        campaign['_id'], campaign['titre'], campaign['etat'],
+                        campaign['nb_soumises'], campaign['nb_selectionnees']))
+                    pprint(progress)
+                raise SystemExit(0)
         elif argv[1] in ('submit', 'exec') and len(argv) == 4:
             task = get_task(argv[2])
             if task:
@@ -42,10 +42,31 @@ print(len([l for l in out.splitlines()[1:] if l.strip()]))
 " | python
 }
 
+# Remove the expired authentication tokens, once per run of the script
+python $VIGIECHIRO_DIR/vigiechiro-api/bin/queuer.py sweep_tokens
+if ( [ $? -ne 0 ] )
+then
+    printf "[$(date)] command `python $VIGIECHIRO_DIR/vigiechiro-api/bin/queuer.py sweep_tokens` has failed\n"
+fi
+
 # Run the script for 60 * 120 == 2 hours
 # This is much lower than the default maximum time (i.e. 7 days)
 for i in `seq 120`
 do
+    # Recover the jobs whose worker has been killed (timeout, OOM...)
+    python $VIGIECHIRO_DIR/vigiechiro-api/bin/queuer.py reap
+    if ( [ $? -ne 0 ] )
+    then
+        printf "[$(date)] command `python $VIGIECHIRO_DIR/vigiechiro-api/bin/queuer.py reap` has failed\n"
+    fi
+
+    # Submit the next participations of the reprocessing campaigns
+    python $VIGIECHIRO_DIR/vigiechiro-api/bin/queuer.py campaign feed
+    if ( [ $? -ne 0 ] )
+    then
+        printf "[$(date)] command `python $VIGIECHIRO_DIR/vigiechiro-api/bin/queuer.py campaign feed` has failed\n"
+    fi
+
     PENDINGS=`python $VIGIECHIRO_DIR/vigiechiro-api/bin/queuer.py pendings`
     if ( [ $? -ne 0 ] )
     then
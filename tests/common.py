@@ -9,6 +9,7 @@ from datetime import datetime, timedelta
 
 from vigiechiro import settings, app
 from vigiechiro.resources import utilisateurs as utilisateurs_resource
+from vigiechiro.xin.auth import build_token_index
 
 from wsgiref.handlers import format_date_time
 from time import mktime
@@ -75,7 +76,8 @@ class AuthRequests:
             'donnees_publiques': False,
             'email': 'user_{}@email.com'.format(self._user_id),
             'role': role,
-            'tokens': {self.token: token_expire}
+            'tokens': {self.token: token_expire},
+            'tokens_index': [build_token_index(self.token, token_expire)]
         }
         for key, value in fields:
             self.user[key] = value
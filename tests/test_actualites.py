@@ -103,3 +103,38 @@ def test_list_protocole_users(clean_actualites, protocoles_base,
 
 def test_follow():
     pass
+
+
+def test_bulk_write(clean_actualites, observateur, protocoles_base):
+    from bson import ObjectId
+    from vigiechiro.resources.actualites import actualites as actualites_resource
+    protocole_id = protocoles_base[0]['_id']
+    sujet_id = observateur.user['_id']
+
+    @with_flask_context
+    def insert_many(payloads):
+        return actualites_resource.insert_many(payloads)
+
+    @with_flask_context
+    def bulk_update(updates):
+        return actualites_resource.bulk_update(updates)
+
+    inserted, errors = insert_many([
+        {'action': 'INSCRIPTION_PROTOCOLE', 'sujet': sujet_id, 'protocole': protocole_id},
+        {'action': 'INSCRIPTION_PROTOCOLE', 'sujet': ObjectId(), 'protocole': protocole_id},
+        {'action': 'dummy'}])
+    assert len(inserted) == 1
+    assert set(errors) == {1, 2}
+    assert all(code == 422 for code, _ in errors.values())
+    assert db.actualites.count() == 1
+    actualite = inserted[0]
+    etags, errors = bulk_update([
+        (actualite['_id'], {'date_validation': datetime.utcnow()}),
+        ({'_id': actualite['_id'], '_etag': actualite['_etag']}, {'date_refus': datetime.utcnow()}),
+        (ObjectId(), {'date_refus': datetime.utcnow()})])
+    assert list(etags) == [0]
+    assert errors == {1: (412, 'If-Match condition has failed'), 2: (404, )}
+    stored = db.actualites.find_one({'_id': actualite['_id']})
+    assert stored['_etag'] == etags[0]
+    assert 'date_validation' in stored
+    assert 'date_refus' not in stored
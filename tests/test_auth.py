@@ -7,6 +7,7 @@ from urllib.parse import urlparse, parse_qs
 from .common import db, observateur
 from .test_utilisateurs import users_base
 from vigiechiro import settings
+from vigiechiro.xin.auth import sweep_expired_tokens, hash_token
 
 
 PROTECTED_URL = settings.BACKEND_DOMAIN + '/moi'
@@ -41,6 +42,37 @@ def test_expiration_token(observateur):
     assert r.status_code == 401, r.text
 
 
+def test_sweep_expired_tokens(observateur):
+    user_id = ObjectId(observateur.user_id)
+    expired = 'EXPIREDTOKEN'
+    db.utilisateurs.update_one({'_id': user_id}, {'$set': {
+        'tokens.' + expired: datetime.utcnow() - timedelta(seconds=1)}})
+    db.utilisateurs.update_one({'_id': user_id}, {'$push': {'tokens_index': {
+        'hash': hash_token(expired), 'expire': datetime.utcnow() - timedelta(seconds=1)}}})
+    assert sweep_expired_tokens(db) >= 1
+    user = db.utilisateurs.find_one({'_id': user_id})
+    assert list(user['tokens'].keys()) == [observateur.token]
+    assert [i['hash'] for i in user['tokens_index']] == [hash_token(observateur.token)]
+    r = observateur.get('/moi')
+    assert r.status_code == 200, r.text
+
+
+def test_unindexed_token(observateur):
+    user_id = ObjectId(observateur.user_id)
+    db.utilisateurs.update_one({'_id': user_id}, {'$unset': {'tokens_index': True}})
+    # Tokens created before the tokens index are rejected until indexed
+    # by the migration (i.e. `bin/init_db.py sweep_tokens`)
+    r = observateur.get('/moi')
+    assert r.status_code == 401, r.text
+    assert sweep_expired_tokens(db) >= 1
+    user = db.utilisateurs.find_one({'_id': user_id})
+    assert [i['hash'] for i in user['tokens_index']] == [hash_token(observateur.token)]
+    r = observateur.get('/moi')
+    assert r.status_code == 200, r.text
+    r = observateur.get('/moi')
+    assert r.status_code == 200, r.text
+
+
 def test_single_login():
     r = requests.get(settings.BACKEND_DOMAIN + '/login/google',
                      allow_redirects=False)
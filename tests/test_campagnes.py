@@ -0,0 +1,110 @@
+import pytest
+from bson import ObjectId
+from datetime import datetime, timedelta
+
+from .common import db, administrateur, observateur, with_flask_context
+from vigiechiro.resources.campagnes import feed_campagnes
+from vigiechiro.resources.participations import build_version_key
+
+
+@pytest.fixture
+def participations_to_process(request, administrateur):
+    protocole_id = ObjectId()
+    now = datetime.utcnow()
+    participations = []
+    for i, version in enumerate([None, '1', '1', '2', '2']):
+        participation = {'observateur': administrateur.user['_id'],
+                         'protocole': protocole_id, 'site': ObjectId(),
+                         'date_debut': now - timedelta(days=i),
+                         '_created': now, '_updated': now, '_etag': str(i)}
+        if version:
+            participation['traitement'] = {'etat': 'FINI', 'version_tadarida_c': version}
+        participations.append(participation)
+    # Another protocole, not part of the campagne
+    participations.append({'observateur': administrateur.user['_id'],
+                           'protocole': ObjectId(), 'site': ObjectId(),
+                           'date_debut': now, '_etag': 'other'})
+    db.participations.insert_many(participations)
+    def finalizer():
+        db.participations.remove()
+        db.campagnes.remove()
+        db.queuer_jobs.remove()
+    request.addfinalizer(finalizer)
+    return protocole_id
+
+
+def test_campagne(administrateur, participations_to_process):
+    r = administrateur.post('/campagnes', json={
+        'titre': 'Tadarida C v2', 'protocole': str(participations_to_process),
+        'version_tadarida_c': '2', 'max_en_attente': 2})
+    assert r.status_code == 201, r.text
+    campagne = r.json()
+    assert campagne['etat'] == 'EN_COURS'
+    assert campagne['nb_selectionnees'] == 3
+    assert campagne['nb_a_jour'] == 2
+    def allow_rate():
+        db.campagnes.update_one({'_id': ObjectId(campagne['_id'])}, {'$set': {
+            '_created': datetime.utcnow() - timedelta(days=1),
+            'date_dernier_envoi': datetime.utcnow() - timedelta(days=1)}})
+
+    # Nothing is submitted until the rate allows it
+    assert with_flask_context(feed_campagnes)() == {ObjectId(campagne['_id']): 0}
+    allow_rate()
+    # Number of jobs in queue is capped by `max_en_attente`
+    assert with_flask_context(feed_campagnes)() == {ObjectId(campagne['_id']): 2}
+    jobs = list(db.queuer_jobs.find({'kwargs.campagne': ObjectId(campagne['_id'])}))
+    assert len(jobs) == 2
+    for job in jobs:
+        assert job['name'] == 'process_participation'
+        assert job['lane'] == 'heavy'
+        assert not job['kwargs'].get('notify_mail')
+    assert with_flask_context(feed_campagnes)() == {ObjectId(campagne['_id']): 0}
+    # Once the jobs are over, the last participation is submitted
+    db.queuer_jobs.remove()
+    allow_rate()
+    assert with_flask_context(feed_campagnes)() == {ObjectId(campagne['_id']): 1}
+    r = administrateur.get('/campagnes/%s' % campagne['_id'])
+    assert r.status_code == 200, r.text
+    assert r.json()['nb_soumises'] == 3
+    assert r.json()['progression']['attente'] == 1
+    assert r.json()['progression']['restantes'] == 0
+    # Campagne is over when no job remains
+    db.queuer_jobs.remove()
+    with_flask_context(feed_campagnes)()
+    r = administrateur.get('/campagnes/%s' % campagne['_id'])
+    assert r.json()['etat'] == 'FINI'
+
+
+def test_campagne_cancel(administrateur, participations_to_process):
+    r = administrateur.post('/campagnes', json={
+        'titre': 'Tadarida C v2', 'protocole': str(participations_to_process),
+        'version_tadarida_c': '2', 'max_en_attente': 2})
+    assert r.status_code == 201, r.text
+    campagne_id = ObjectId(r.json()['_id'])
+    db.campagnes.update_one({'_id': campagne_id}, {'$set': {
+        '_created': datetime.utcnow() - timedelta(days=1)}})
+    assert with_flask_context(feed_campagnes)() == {campagne_id: 2}
+    etag = db.campagnes.find_one({'_id': campagne_id})['_etag']
+    # One of the jobs is already processed by a worker
+    running = db.queuer_jobs.find_one({'kwargs.campagne': campagne_id})
+    db.queuer_jobs.update_one({'_id': running['_id']}, {'$set': {'status': 'RESERVED'}})
+    r = administrateur.patch('/campagnes/%s' % campagne_id, json={'etat': 'ANNULE'},
+                             headers={'If-Match': etag})
+    assert r.status_code == 200, r.text
+    assert r.json()['etat'] == 'ANNULE'
+    jobs = list(db.queuer_jobs.find({'kwargs.campagne': campagne_id}))
+    assert [j['_id'] for j in jobs] == [running['_id']]
+    # Nothing is submitted anymore
+    assert with_flask_context(feed_campagnes)() == {}
+
+
+def test_campagne_access(observateur):
+    r = observateur.post('/campagnes', json={'titre': 'test', 'version_tadarida_c': '2'})
+    assert r.status_code == 403, r.text
+    r = observateur.get('/campagnes')
+    assert r.status_code == 403, r.text
+
+
+def test_build_version_key():
+    versions = ['10', '9', '3.10', '3.9', '3.9.1']
+    assert sorted(versions, key=build_version_key) == ['3.9', '3.9.1', '3.10', '9', '10']
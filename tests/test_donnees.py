@@ -147,6 +147,12 @@ def test_access(clean_donnees, donnee_env, observateur_other, validateur, admini
     # Other observateurs can't see it
     r = observateur_other.get(donnee_url)
     assert r.status_code == 403, r.text
+    # Even with the etag of the donnee
+    etag = validateur.get(donnee_url).headers['ETag']
+    r = observateur_other.get(donnee_url, headers={'If-None-Match': etag})
+    assert r.status_code == 403, r.text
+    r = validateur.get(donnee_url, headers={'If-None-Match': etag})
+    assert r.status_code == 304, r.text
     r = observateur_other.get('/donnees')
     assert r.status_code == 200, r.text
     assert(len(r.json()['_items']) == 0), r.json()
@@ -361,3 +367,5 @@ def test_multi_bilan_triggered(clean_donnees, administrateur, participation_read
                                json=update_payload)
         assert r.status_code == 200, r.text
         assert queuer.get_pending_jobs().count() == 1
+        # Submissions have been merged into the pending job
+        assert queuer.get_pending_jobs()[0]['submissions_count'] == 2
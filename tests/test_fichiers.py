@@ -124,9 +124,13 @@ def test_access_rights(file_uploaded, observateur, observateur_other,
                           headers={'If-Match': observateur.user['_etag']},
                           json={'donnees_publiques': False})
     assert r.status_code == 200, r.text
+    etag = administrateur.get(url).headers['ETag']
     def try_access(user, result):
         r = user.get(url)
         assert r.status_code == result, r.text
+        # Conditional GET doesn't bypass the access rights
+        r = user.get(url, headers={'If-None-Match': etag})
+        assert r.status_code == (304 if result == 200 else result), r.text
         r = user.get(url_s3_access)
         assert r.status_code == result, r.text
         if result == 200:
@@ -0,0 +1,80 @@
+import pytest
+from datetime import datetime, timedelta
+
+from .common import db, administrateur, observateur
+
+
+@pytest.fixture
+def jobs(request):
+    now = datetime.utcnow()
+    jobs = [
+        {'name': 'process_participation', 'status': 'READY', 'args': [], 'kwargs': {},
+         'submitted': now},
+        {'name': 'process_participation', 'status': 'RESERVED', 'args': [], 'kwargs': {},
+         'submitted': now - timedelta(minutes=10), 'reserved_at': now - timedelta(minutes=5)},
+    ]
+    archived = []
+    for i in range(1, 11):
+        status = 'DONE' if i % 5 else 'ERROR'
+        archived.append({'name': 'participation_generate_bilan', 'args': [], 'kwargs': {},
+                         'status': status,
+                         'submitted': now - timedelta(minutes=30),
+                         'reserved_at': now - timedelta(minutes=30 - i),
+                         'done_at' if status == 'DONE' else 'errored_at': now - timedelta(minutes=20),
+                         'finished_at': now - timedelta(minutes=20)})
+    db.queuer_jobs.remove()
+    db.queuer_jobs_archive.remove()
+    db.queuer_jobs_stats.remove()
+    db.queuer_jobs.insert_many(jobs)
+    db.queuer_jobs_archive.insert_many(archived)
+    db.queuer_jobs_stats.insert_one({'_id': 'participation_generate_bilan',
+                                     'DONE': 42, 'ERROR': 2})
+    def finalizer():
+        db.queuer_jobs.remove()
+        db.queuer_jobs_archive.remove()
+        db.queuer_jobs_stats.remove()
+    request.addfinalizer(finalizer)
+    return jobs
+
+
+def test_queuer_stats(administrateur, jobs):
+    r = administrateur.get('/monitoring/queuer')
+    assert r.status_code == 200, r.text
+    tasks = r.json()['tasks']
+    assert tasks['process_participation']['depth'] == {'READY': 1, 'RESERVED': 1}
+    bilan = tasks['participation_generate_bilan']
+    assert bilan['depth'] == {'READY': 0, 'RESERVED': 0}
+    window = bilan['windows']['1h']
+    assert window['wait']['count'] == 10
+    assert window['wait']['p50'] == 5 * 60
+    assert window['wait']['p99'] == 9 * 60
+    assert window['run']['count'] == 10
+    assert window['error_rate'] == 0.2
+    assert window['throughput_per_hour'] == pytest.approx(10, rel=0.01)
+    assert bilan['totals']['DONE'] == 42
+    assert bilan['totals']['ERROR'] == 2
+
+
+def test_queuer_stats_access(observateur):
+    r = observateur.get('/monitoring/queuer')
+    assert r.status_code == 403, r.text
+
+
+def test_updates_stats(administrateur):
+    r = administrateur.get('/monitoring/updates')
+    assert r.status_code == 200, r.text
+    before = r.json().get('utilisateurs', {})
+    # Update by id of the payload, no need to read the document first
+    r = administrateur.patch('/moi', json={'commentaire': 'New comment'})
+    assert r.status_code == 200, r.text
+    assert r.json()['commentaire'] == 'New comment'
+    r = administrateur.get('/monitoring/updates')
+    stats = r.json()['utilisateurs']
+    assert stats['updates'] == before.get('updates', 0) + 1
+    assert stats['reads_skipped'] == before.get('reads_skipped', 0) + 1
+
+
+def test_cache_and_updates_stats_access(observateur):
+    for route in ('/monitoring/cache', '/monitoring/updates'):
+        r = observateur.get(route)
+        assert r.status_code == 403, r.text
@@ -0,0 +1,90 @@
+import pytest
+import subprocess
+import sys
+from datetime import datetime
+
+from vigiechiro.scripts.queuer import (Queuer, Task, start_memory_usage,
+                                       get_memory_usage)
+
+
+def test_queuer_import_without_app():
+    # Queue commands (e.g. `bin/queuer.py pendings`) run every minute,
+    # they shouldn't pay the cost of loading the application
+    code = ("import sys\n"
+            "from vigiechiro.scripts import queuer\n"
+            "from vigiechiro.scripts.queuer_pool import WorkerPool\n"
+            "heavy = {'flask', 'authomatic', 'vigiechiro.app', 'vigiechiro.resources'}\n"
+            "print(sorted(heavy & set(sys.modules)))\n")
+    out = subprocess.check_output([sys.executable, '-c', code])
+    assert out.decode().strip() == '[]'
+
+
+def test_memory_usage():
+    started = start_memory_usage()
+    data = bytearray(200 * 1024 * 1024)
+    first_job = get_memory_usage(started)
+    assert first_job >= 200
+    del data
+    # Peak of a previous job isn't reported by the next ones
+    started = start_memory_usage()
+    second_job = get_memory_usage(started)
+    assert second_job is None or second_job < first_job - 150
+    started = start_memory_usage()
+    subprocess.check_call([sys.executable, '-c', 'bytearray(300 * 1024 * 1024)'])
+    assert get_memory_usage(started) >= 300
+
+
+@pytest.fixture
+def test_queuer(request):
+    test_queuer = Queuer('test_queuer_jobs')
+    def finalizer():
+        for collection in (test_queuer.collection, test_queuer.archive_collection,
+                           test_queuer.stats_collection, test_queuer.locks_collection):
+            collection.drop()
+    request.addfinalizer(finalizer)
+    return test_queuer
+
+
+def test_lock_defer_job(test_queuer):
+    def locked_task():
+        with test_queuer.lock('participation:42'):
+            return 'done'
+    test_queuer.register_task(Task(locked_task))
+    assert test_queuer.acquire_lock('participation:42', 'other_worker')
+    job_id = test_queuer.submit_job('locked_task')
+    # Lock is taken, job must be put back in the queue for later
+    assert test_queuer.execute_job(job_id) is None
+    job = test_queuer.collection.find_one({'_id': job_id})
+    assert job['status'] == 'READY'
+    assert job['attempts'] == 0
+    assert job['deferrals_count'] == 1
+    assert job['not_before'] > datetime.utcnow()
+    assert test_queuer.get_pending_jobs_count() == 0
+    # Once released, the job can run and releases the lock in turn
+    test_queuer.release_lock('participation:42', 'other_worker')
+    test_queuer.collection.update_one({'_id': job_id}, {'$unset': {'not_before': True}})
+    assert test_queuer.execute_job(job_id) == 'done'
+    assert test_queuer.archive_collection.find_one({'_id': job_id})['status'] == 'DONE'
+    assert test_queuer.locks_collection.count_documents({}) == 0
+
+
+def test_reap_merge_singleton_job(test_queuer):
+    def singleton_task(x):
+        return x
+    test_queuer.register_task(Task(singleton_task, max_retry=1))
+    test_queuer.collection.create_index(
+        [('coalesce_key', 1)], unique=True,
+        partialFilterExpression={'status': 'READY', 'coalesce_key': {'$exists': True}})
+    expired_id = test_queuer.submit_singleton_job('singleton_task', [42], {})
+    # The job's worker is lost while a similar job is submitted
+    test_queuer.collection.update_one({'_id': expired_id}, {'$set': {
+        'status': 'RESERVED', 'attempts': 1, 'worker': 'lost_worker',
+        'reserved_at': datetime.utcnow(), 'lease_expires_at': datetime.utcnow()}})
+    waiting_id = test_queuer.submit_singleton_job('singleton_task', [42], {})
+    assert waiting_id != expired_id
+    # The expired job is merged into the waiting one instead of failing
+    assert test_queuer.reap_expired_jobs() == [(expired_id, 'MERGED')]
+    assert test_queuer.collection.find_one({'_id': expired_id}) is None
+    assert test_queuer.collection.find_one({'_id': waiting_id})['submissions_count'] == 2
+    assert test_queuer.archive_collection.count_documents({}) == 0
+    assert test_queuer.stats_collection.count_documents({}) == 0
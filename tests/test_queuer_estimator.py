@@ -0,0 +1,52 @@
+import pytest
+
+from vigiechiro.scripts.queuer_estimator import (
+    solve_least_squares, LinearModel, recommend_resources, format_sbatch_options,
+    DEFAULT_TIME, DEFAULT_MEM_MB, MIN_TIME, MAX_MEM_MB)
+
+
+def test_solve_least_squares():
+    # y = 3 + 2 * x1 + 0.5 * x2
+    rows = [[1, x1, x2] for x1, x2 in [(0, 0), (1, 0), (0, 1), (2, 3), (5, 1)]]
+    targets = [3 + 2 * x1 + 0.5 * x2 for _, x1, x2 in rows]
+    coefs = solve_least_squares(rows, targets)
+    assert coefs == pytest.approx([3, 2, 0.5], abs=1e-4)
+
+
+def test_solve_least_squares_colinear():
+    rows = [[1, x, 2 * x] for x in range(5)]
+    coefs = solve_least_squares(rows, [10 * x for x in range(5)])
+    assert coefs[1] + 2 * coefs[2] == pytest.approx(10, abs=1e-3)
+
+
+def test_linear_model():
+    samples = [({'wav': n, 'ta': 2 * n + 1}, 60 + 3 * n + (2 * n + 1)) for n in range(10)]
+    model = LinearModel.fit(samples)
+    assert model.features == ['ta', 'wav']
+    assert model.predict({'wav': 100, 'ta': 201}) == pytest.approx(60 + 300 + 201, rel=1e-3)
+    # Missing inputs are considered as zero and prediction is never negative
+    assert model.predict({}) >= 0
+
+
+def test_recommend_resources():
+    assert recommend_resources(None, {'wav': 10}) == {
+        'time': DEFAULT_TIME, 'mem': DEFAULT_MEM_MB, 'cpus': 1}
+    models = {
+        'time': LinearModel(['wav'], [0, 3600]),
+        'mem': LinearModel(['wav'], [1000, 1000]),
+        'cpu_time': LinearModel(['wav'], [0, 3600 * 3])
+    }
+    assert recommend_resources(models, {'wav': 2}) == {
+        'time': 4 * 3600, 'mem': 4500, 'cpus': 3}
+    # Recommendations are bounded
+    small = recommend_resources(models, {'wav': 0})
+    assert small['time'] == MIN_TIME
+    assert recommend_resources(models, {'wav': 100})['mem'] == MAX_MEM_MB
+    # No memory history
+    models['mem'] = None
+    assert recommend_resources(models, {'wav': 2})['mem'] == DEFAULT_MEM_MB
+
+
+def test_format_sbatch_options():
+    assert format_sbatch_options({'time': 26 * 3600 + 61, 'mem': 2048, 'cpus': 2}) == \
+        '--time=1-02:01:01 --mem=2048MB --cpus-per-task=2'
@@ -0,0 +1,63 @@
+import signal
+import sys
+import time
+
+from vigiechiro.scripts.queuer_pool import build_slots, WorkerPool
+
+
+WORKER_SCRIPT = """
+import os, signal, sys, time
+stopping = []
+signal.signal(signal.SIGTERM, lambda *args: stopping.append(True))
+with open(os.path.join(sys.argv[1], '%s-%s' % (sys.argv[2], os.getpid())), 'w'):
+    pass
+if sys.argv[3] == 'crash':
+    raise SystemExit(1)
+while not stopping:
+    time.sleep(0.01)
+"""
+
+
+def test_build_slots():
+    slots = build_slots(4, ['default', 'heavy', 'light'], {'heavy': 1, 'light': 2})
+    assert slots == [
+        ['heavy', 'light', 'default'],
+        ['light', 'default'],
+        ['default'],
+        ['default']
+    ]
+    # Workers with nothing to consume are not started
+    assert build_slots(3, ['heavy'], {'heavy': 2}) == [['heavy'], ['heavy']]
+
+
+def _start_pool(pool):
+    for slot in range(len(pool.slots)):
+        pool._spawn(slot)
+
+
+def _run_pool(pool, until, timeout=10):
+    end = time.monotonic() + timeout
+    while not until():
+        assert time.monotonic() < end, 'timeout'
+        pool.poll()
+        time.sleep(0.05)
+
+
+def test_pool_drain(tmpdir):
+    cmd = [sys.executable, '-c', WORKER_SCRIPT, str(tmpdir), 'run', 'ok']
+    pool = WorkerPool(cmd, 2, ['default'])
+    _start_pool(pool)
+    _run_pool(pool, lambda: len(tmpdir.listdir()) == 2)
+    pool._on_signal(signal.SIGTERM, None)
+    _run_pool(pool, lambda: not pool.poll())
+    assert not pool.processes
+
+
+def test_pool_restart_crashed(tmpdir):
+    cmd = [sys.executable, '-c', WORKER_SCRIPT, str(tmpdir), 'run']
+    pool = WorkerPool(cmd, 1, ['crash'])
+    _start_pool(pool)
+    _run_pool(pool, lambda: len(tmpdir.listdir()) >= 2)
+    assert pool.backoffs[0] >= 1
+    pool._on_signal(signal.SIGTERM, None)
+    _run_pool(pool, lambda: not pool.poll())
@@ -1,3 +1,4 @@
+import json
 import requests
 from pymongo import MongoClient
 import pytest
@@ -177,6 +178,15 @@ def test_unique_libelle(taxons_base, new_taxon_payload, administrateur):
         new_taxon_payload[libelle] = taxons_base[0][libelle]
         r = administrateur.post('/taxons', json=new_taxon_payload)
         assert r.status_code == 422, r.text
+        field, error = r.json()['_errors'].popitem()
+        assert error == "value '%s' is not unique" % taxons_base[0][field]
+    # Same thing on update
+    url = '/taxons/{}'.format(taxons_base[1]['_id'])
+    r = administrateur.get(url)
+    r = administrateur.patch(url, headers={'If-Match': r.json()['_etag']},
+                             json={'libelle_long': taxons_base[0]['libelle_long']})
+    assert r.status_code == 422, r.text
+    assert 'libelle_long' in r.json()['_errors']
 
 
 def test_get_resume_list(taxons_base, observateur):
@@ -187,3 +197,107 @@ def test_get_resume_list(taxons_base, observateur):
     items = {item['_id']: item for item in  r.json()['_items']}
     for taxon in taxons_base:
         assert str(taxon['_id']) in items
+
+
+def test_list_cursor(taxons_base, observateur):
+    r = observateur.get('/taxons', params={'max_results': 3})
+    assert r.status_code == 200, r.text
+    expected = [t['_id'] for t in r.json()['_items']]
+    found = []
+    params = {'max_results': 2, 'cursor': ''}
+    while True:
+        r = observateur.get('/taxons', params=params)
+        assert r.status_code == 200, r.text
+        found += [t['_id'] for t in r.json()['_items']]
+        if not r.json()['_meta']['next']:
+            break
+        params['cursor'] = r.json()['_meta']['next']
+    assert found == expected
+    r = observateur.get('/taxons', params={'cursor': 'dummy'})
+    assert r.status_code == 422, r.text
+
+
+def test_list_total(taxons_base, new_taxon_payload, administrateur):
+    r = administrateur.get('/taxons')
+    assert r.status_code == 200, r.text
+    assert r.json()['_meta']['total_kind'] == 'estimated'
+    assert r.json()['_meta']['total'] == 3
+    r = administrateur.get('/taxons', params={'total': 'false'})
+    assert r.json()['_meta']['total_kind'] == 'disabled'
+    assert r.json()['_meta']['total'] is None
+    # Filtered lookup's total is cached until the resource is modified
+    r = administrateur.get('/taxons', params={'q': 'Chiroptera', 'total': 'exact'})
+    assert r.json()['_meta']['total_kind'] == 'exact'
+    total = r.json()['_meta']['total']
+    r = administrateur.get('/taxons', params={'q': 'Chiroptera'})
+    assert r.json()['_meta']['total_kind'] == 'cached'
+    assert r.json()['_meta']['total'] == total
+    r = administrateur.post('/taxons', json=new_taxon_payload)
+    assert r.status_code == 201, r.text
+    r = administrateur.get('/taxons', params={'q': 'Chiroptera'})
+    assert r.json()['_meta']['total_kind'] == 'exact'
+    r = administrateur.get('/taxons', params={'total': 'dummy'})
+    assert r.status_code == 422, r.text
+
+
+def test_list_stream(taxons_base, observateur):
+    r = observateur.get('/taxons', params={'stream': 'ndjson'})
+    assert r.status_code == 200, r.text
+    assert r.headers['Content-Type'] == 'application/x-ndjson'
+    lines = r.text.splitlines()
+    assert len(lines) == 3
+    assert json.loads(lines[0])['libelle_long'] == 'Chiroptera'
+    r = observateur.get('/taxons', params={'stream': 'json', 'max_results': 2})
+    assert r.status_code == 200, r.text
+    assert len(r.json()) == 2
+    r = observateur.get('/taxons', params={'stream': 'xml'})
+    assert r.status_code == 422, r.text
+
+
+def test_conditional_get(taxons_base, administrateur):
+    url = '/taxons/{}'.format(taxons_base[0]['_id'])
+    r = administrateur.get(url)
+    assert r.status_code == 200, r.text
+    etag = r.headers['ETag']
+    assert etag == '"%s"' % r.json()['_etag']
+    r = administrateur.get(url, headers={'If-None-Match': etag})
+    assert r.status_code == 304, r.text
+    assert not r.content
+    r = administrateur.patch(url, headers={'If-Match': r.headers['ETag'].strip('"')},
+                             json={"tags": ['new_tag']})
+    assert r.status_code == 200, r.text
+    r = administrateur.get(url, headers={'If-None-Match': etag})
+    assert r.status_code == 200, r.text
+    # Lists get a weak etag
+    r = administrateur.get('/taxons')
+    assert r.status_code == 200, r.text
+    assert r.json()['_items']
+    etag = r.headers['ETag']
+    assert etag.startswith('W/')
+    r = administrateur.get('/taxons', headers={'If-None-Match': etag})
+    assert r.status_code == 304, r.text
+    r = administrateur.get(url)
+    r = administrateur.patch(url, headers={'If-Match': r.json()['_etag']},
+                             json={"tags": ['other_tag']})
+    assert r.status_code == 200, r.text
+    r = administrateur.get('/taxons', headers={'If-None-Match': etag})
+    assert r.status_code == 200, r.text
+
+
+def test_fields_and_expand(taxons_base, observateur):
+    url = '/taxons/{}'.format(taxons_base[1]['_id'])
+    r = observateur.get(url)
+    assert r.status_code == 200, r.text
+    assert isinstance(r.json()['parents'][0], dict)
+    r = observateur.get(url, params={'fields': 'libelle_court,parents', 'expand': ''})
+    assert r.status_code == 200, r.text
+    assert set(r.json()) == {'_id', '_etag', '_created', '_updated', 'libelle_court', 'parents'}
+    assert r.json()['parents'] == [str(taxons_base[0]['_id'])]
+    r = observateur.get('/taxons', params={'fields': 'libelle_long', 'cursor': ''})
+    assert r.status_code == 200, r.text
+    for item in r.json()['_items']:
+        assert 'libelle_court' not in item
+        assert 'libelle_long' in item
+    for params in ({'fields': 'dummy'}, {'expand': 'libelle_long'}):
+        r = observateur.get('/taxons', params=params)
+        assert r.status_code == 422, r.text
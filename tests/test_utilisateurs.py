@@ -10,6 +10,7 @@ from .test_protocoles import protocoles_base
 from .test_taxons import taxons_base
 from vigiechiro import settings
 from vigiechiro.resources import utilisateurs as utilisateurs_resource
+from vigiechiro.xin.auth import build_token_index
 
 
 @pytest.fixture(scope="module")
@@ -42,6 +43,8 @@ def users_base(request):
     def insert_users():
         inserted_users = []
         for user in users:
+            user['tokens_index'] = [build_token_index(token, expire)
+                                    for token, expire in user['tokens'].items()]
             inserted_user = utilisateurs_resource.insert(user, auto_abort=False,
                 additional_context={'internal': True})
             assert inserted_user
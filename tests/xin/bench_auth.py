@@ -0,0 +1,57 @@
+"""
+Benchmark of the token authentication, requires the database
+
+usage: python -m tests.xin.bench_auth [<utilisateurs> [<iterations>]]
+"""
+
+import sys
+import timeit
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from vigiechiro import app
+from vigiechiro.xin import auth
+from vigiechiro.resources.utilisateurs import utilisateurs
+
+
+BENCH_EMAIL = 'bench_auth_{}@email.com'
+
+
+def insert_utilisateurs(db, count):
+    """Insert `count` utilisateurs with a token each, return the last token"""
+    expire = datetime.utcnow() + timedelta(days=1)
+    documents = []
+    for i in range(count):
+        token = uuid4().hex
+        documents.append({'pseudo': 'bench_{}'.format(i), 'email': BENCH_EMAIL.format(i),
+                          'role': 'Observateur', 'tokens': {token: expire},
+                          'tokens_index': [auth.build_token_index(token, expire)]})
+    db.utilisateurs.insert_many(documents)
+    return token
+
+
+def bench(count=5000, iterations=200):
+    with app.test_request_context():
+        db = app.data.db
+        utilisateurs.ensure_indexes()
+        token = insert_utilisateurs(db, count)
+        # Lookup done on each request before the tokens index
+        previous = lambda: db.utilisateurs.find_one({'tokens.{}'.format(token): {'$exists': True}})
+        check = lambda: auth.check_auth(token, ['Observateur'])
+        results = []
+        try:
+            for name, f, cache_ttl in (('previous', previous, 0),
+                                       ('indexed', check, 0),
+                                       ('cached', check, 300)):
+                app.config['AUTH_CACHE_TTL'] = cache_ttl
+                auth._auth_cache = None
+                assert f()
+                results.append((name, min(timeit.repeat(f, number=iterations, repeat=3)) / iterations))
+        finally:
+            db.utilisateurs.delete_many({'email': {'$regex': '^bench_auth_'}})
+    for name, duration in results:
+        print('%s: %.3f ms per request (%s utilisateurs)' % (name, duration * 1000, count))
+
+
+if __name__ == '__main__':
+    bench(*[int(arg) for arg in sys.argv[1:]])
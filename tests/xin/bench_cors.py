@@ -0,0 +1,41 @@
+"""
+Benchmark of the CORS preflight requests
+
+usage: python -m tests.xin.bench_cors [<iterations>]
+"""
+
+import sys
+import timeit
+from werkzeug.test import EnvironBuilder
+
+from vigiechiro import app, settings
+
+
+def build_preflight_environ(path):
+    return EnvironBuilder(path=settings.BACKEND_URL_PREFIX + path, method='OPTIONS', headers={
+        'Origin': settings.FRONTEND_DOMAIN,
+        'Access-Control-Request-Method': 'PATCH',
+        'Access-Control-Request-Headers': 'authorization, content-type, if-match'
+    }).get_environ()
+
+
+def run(wsgi_app, environ):
+    def start_response(status, headers, exc_info=None):
+        assert status.startswith('200'), status
+    response = wsgi_app(dict(environ), start_response)
+    b''.join(response)
+    if hasattr(response, 'close'):
+        response.close()
+
+
+def bench(iterations=2000):
+    environ = build_preflight_environ('/participations/5f0000000000000000000000/donnees')
+    # The middleware wraps the flask dispatch
+    for name, wsgi_app in (('flask', app.wsgi_app.wsgi_app), ('middleware', app.wsgi_app)):
+        f = lambda: run(wsgi_app, environ)
+        duration = min(timeit.repeat(f, number=iterations, repeat=3)) / iterations
+        print('%s: %.3f ms per preflight' % (name, duration * 1000))
+
+
+if __name__ == '__main__':
+    bench(*[int(arg) for arg in sys.argv[1:]])
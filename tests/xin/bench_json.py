@@ -0,0 +1,40 @@
+"""
+Benchmark of the JSON backends on a page of expanded donnees
+
+usage: python -m tests.xin.bench_json [<iterations>]
+"""
+
+import sys
+import json
+import timeit
+from bson import ObjectId
+from datetime import datetime
+
+from vigiechiro.xin.tools import JSON_BACKENDS, MongoJsonEncoder
+from .bench_schema import build_donnee
+
+
+PAGE_SIZE = 20
+
+
+def build_page(page_size=PAGE_SIZE):
+    items = []
+    for _ in range(page_size):
+        donnee = build_donnee()
+        now = datetime.utcnow()
+        donnee.update({'_id': ObjectId(), '_created': now, '_updated': now, '_etag': 'etag'})
+        items.append(donnee)
+    return {'_items': items, '_meta': {'max_results': page_size, 'total': page_size, 'page': 1}}
+
+
+def bench(iterations=50):
+    page = build_page()
+    functions = [('previous', lambda: json.dumps(page, cls=MongoJsonEncoder))]
+    functions += [(name, lambda dumps=dumps: dumps(page)) for name, dumps in JSON_BACKENDS.items()]
+    for name, f in functions:
+        duration = min(timeit.repeat(f, number=iterations, repeat=3)) / iterations
+        print('%s: %.3f ms per page of %s donnees' % (name, duration * 1000, PAGE_SIZE))
+
+
+if __name__ == '__main__':
+    bench(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,68 @@
+"""
+Benchmark of the schema runners on donnees documents
+
+usage: python -m tests.xin.bench_schema [<iterations>]
+"""
+
+import sys
+import timeit
+from copy import deepcopy
+from bson import ObjectId
+from datetime import datetime
+
+from vigiechiro import app
+from vigiechiro.resources.donnees import donnees
+
+
+OBSERVATIONS_COUNT = 50
+
+
+def build_donnee(observations_count=OBSERVATIONS_COUNT):
+    taxon = {'_id': ObjectId(), 'libelle_court': 'Pippip'}
+    auteur = {'_id': ObjectId(), 'pseudo': 'auteur'}
+    now = datetime.utcnow()
+    observations = []
+    for i in range(observations_count):
+        observations.append({
+            'temps_debut': i * 0.5,
+            'temps_fin': i * 0.5 + 0.2,
+            'frequence_mediane': 45.3,
+            'tadarida_taxon': taxon,
+            'tadarida_probabilite': 0.87,
+            'tadarida_taxon_autre': [{'taxon': taxon, 'probabilite': 0.1},
+                                     {'taxon': taxon, 'probabilite': 0.02}],
+            'observateur_taxon': taxon,
+            'observateur_probabilite': 'PROBABLE',
+            'messages': [{'message': 'ok', 'auteur': auteur, 'date': now}]
+        })
+    return {
+        'titre': 'Cir1-2020-Pass1-Tron1-Chiro_0_00000_000',
+        'participation': {'_id': ObjectId()},
+        'proprietaire': auteur,
+        'publique': True,
+        'observations': observations
+    }
+
+
+def bench(iterations=200):
+    # Relations are provided expanded to avoid database accesses
+    donnee = build_donnee()
+    with app.test_request_context():
+        result = donnees.validator.run(deepcopy(donnee))
+        assert result.is_valid, result.errors
+        stored = dict(result.document, _id=ObjectId())
+        validate = lambda: donnees.validator.run(deepcopy(donnee))
+        unserialize = lambda: donnees.unserializer.run(
+            deepcopy(stored), additional_context={'expend': False})
+        copy = lambda: deepcopy(donnee)
+        results = {}
+        for name, f in (('deepcopy', copy), ('validator', validate),
+                        ('unserializer', unserialize)):
+            results[name] = min(timeit.repeat(f, number=iterations, repeat=3)) / iterations
+    # Document copy is not part of the runners' cost
+    for name in ('validator', 'unserializer'):
+        print('%s: %.3f ms per document' % (name, (results[name] - results['deepcopy']) * 1000))
+
+
+if __name__ == '__main__':
+    bench(*[int(arg) for arg in sys.argv[1:]])
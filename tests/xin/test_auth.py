@@ -0,0 +1,10 @@
+from vigiechiro import settings
+from vigiechiro.xin.auth import build_authomatic_config
+
+
+def test_build_authomatic_config():
+    config = build_authomatic_config(settings.AUTHOMATIC)
+    assert config['google']['scope'] == ['profile', 'email']
+    assert config['facebook']['scope'] == settings.AUTHOMATIC['facebook']['scope']
+    # Settings are left untouched
+    assert 'scope' not in settings.AUTHOMATIC['google']
@@ -0,0 +1,57 @@
+import pytest
+import time
+
+from vigiechiro.xin.cache import ResourceCache
+
+
+class Test_ResourceCache:
+
+    def test_hit_and_miss(self):
+        cache = ResourceCache('taxons')
+        assert cache.get('a') is None
+        cache.set('a', {'libelle_court': 'Pippip'}, cache.generation)
+        assert cache.get('a') == {'libelle_court': 'Pippip'}
+        stats = cache.get_stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['hit_rate'] == 0.5
+
+
+    def test_returns_copies(self):
+        cache = ResourceCache('taxons')
+        document = {'tags': ['a']}
+        cache.set('a', document, cache.generation)
+        document['tags'].append('b')
+        cache.get('a')['tags'].append('c')
+        assert cache.get('a') == {'tags': ['a']}
+
+
+    def test_lru(self):
+        cache = ResourceCache('taxons', max_size=2)
+        for key in ('a', 'b'):
+            cache.set(key, {}, cache.generation)
+        cache.get('a')
+        cache.set('c', {}, cache.generation)
+        assert cache.get('b') is None
+        assert cache.get('a') == {}
+        assert cache.get('c') == {}
+
+
+    def test_ttl(self):
+        cache = ResourceCache('taxons', ttl=0)
+        cache.set('a', {}, cache.generation)
+        time.sleep(0.01)
+        assert cache.get('a') is None
+        assert cache.get_stats()['size'] == 0
+
+
+    def test_invalidate(self):
+        cache = ResourceCache('taxons')
+        generation = cache.generation
+        cache.set('a', {}, generation)
+        cache.invalidate()
+        assert cache.get('a') is None
+        # Document fetched before the invalidation is outdated
+        cache.set('a', {}, generation)
+        assert cache.get('a') is None
+        assert cache.get_stats()['invalidations'] == 1
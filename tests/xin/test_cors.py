@@ -0,0 +1,68 @@
+import pytest
+from flask import Flask
+
+from vigiechiro.xin.cors import crossdomain, PreflightMiddleware
+
+
+PREFLIGHT_HEADERS = {'Origin': 'http://localhost:9000',
+                     'Access-Control-Request-Method': 'PATCH'}
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    calls = app.calls = []
+
+    @app.before_request
+    def count_dispatch():
+        calls.append(1)
+
+    @app.route('/items/<int:item_id>', methods=['GET'])
+    @crossdomain(methods=['GET', 'PATCH'])
+    def get_item(item_id):
+        return 'get'
+
+    @app.route('/items/<int:item_id>', methods=['PATCH'])
+    @crossdomain(methods=['GET', 'PATCH'])
+    def patch_item(item_id):
+        return 'patch'
+
+    @app.route('/no_cors', methods=['OPTIONS', 'GET'])
+    def no_cors():
+        return 'no cors'
+
+    return app
+
+
+def test_preflight_middleware(app):
+    response = app.test_client().options('/items/42', headers=PREFLIGHT_HEADERS)
+    assert app.calls
+    app.calls.clear()
+    app.wsgi_app = PreflightMiddleware(app)
+    preflight = app.test_client().options('/items/42', headers=PREFLIGHT_HEADERS)
+    # Answered without going through flask, with the same headers
+    assert not app.calls
+    assert preflight.status_code == 200
+    # Flask's allowed methods are not sorted
+    allow = lambda r: set(r.headers.pop('Allow').split(', '))
+    assert allow(preflight) == allow(response) == {'GET', 'HEAD', 'OPTIONS', 'PATCH'}
+    assert dict(preflight.headers) == dict(response.headers)
+    assert preflight.headers['Access-Control-Allow-Methods'] == 'GET, PATCH'
+
+
+def test_preflight_middleware_fallback(app):
+    app.wsgi_app = PreflightMiddleware(app)
+    client = app.test_client()
+    # Not a preflight
+    assert client.options('/items/42').status_code == 200
+    assert len(app.calls) == 1
+    # Route without cors support
+    assert client.options('/no_cors', headers=PREFLIGHT_HEADERS).data == b'no cors'
+    assert len(app.calls) == 2
+    # Unknown route
+    assert client.options('/unknown', headers=PREFLIGHT_HEADERS).status_code == 404
+    assert len(app.calls) == 3
+    # Regular requests keep their headers
+    r = client.get('/items/42')
+    assert r.data == b'get'
+    assert r.headers['Access-Control-Allow-Methods'] == 'GET, PATCH'
@@ -0,0 +1,153 @@
+import json
+import logging
+import pytest
+from types import SimpleNamespace
+from uuid import uuid4
+from bson import ObjectId
+from flask import Flask, g
+
+from vigiechiro.xin.debug import (QueriesProfiler, init_queries_profiler,
+                                  _command_shape, PROFILER_SLOWEST_COUNT,
+                                  check_query_plan, QueryShapesRecorder,
+                                  init_query_shapes_registry, explain_query_shapes,
+                                  build_placeholder_query, QUERY_SHAPES_COLLECTION)
+
+
+def test_command_shape():
+    shape = _command_shape('find', {'find': 'donnees', 'sort': {'_id': 1},
+                                    'filter': {'participation': ObjectId(),
+                                               'titre': {'$in': ['a', 'b']}}})
+    assert shape == {'command': 'find', 'collection': 'donnees', 'sort': {'_id': 1},
+                     'filter': {'participation': '?', 'titre': {'$in': ['?']}}}
+    shape = _command_shape('update', {'update': 'sites', 'updates': [{'q': {'_id': 1}}]})
+    assert shape['filter'] == {'_id': '?'}
+    assert _command_shape('getMore', {'getMore': 42, 'collection': 'taxons'})['collection'] == 'taxons'
+    # Values used as field names are hidden as well
+    token = uuid4().hex
+    shape = _command_shape('find', {'find': 'utilisateurs',
+                                    'filter': {'tokens.{}'.format(token): {'$exists': True}}})
+    assert shape['filter'] == {'tokens.*': {'$exists': '?'}}
+    shape = _command_shape('find', {'find': 'donnees', 'sort': {'counts.{}'.format(ObjectId()): 1},
+                                    'filter': {'counts.{}.n'.format(ObjectId()): 1}})
+    assert shape['filter'] == {'counts.*.n': '?'}
+    assert shape['sort'] == {'counts.*': 1}
+
+
+def test_profiler(caplog):
+    caplog.set_level(logging.INFO, logger='vigiechiro.profiler')
+    app = Flask(__name__)
+    profiler = QueriesProfiler()
+    init_queries_profiler(app, slow_request_threshold=0.001)
+
+    token = uuid4().hex
+
+    @app.route('/')
+    def route():
+        for i in range(PROFILER_SLOWEST_COUNT + 2):
+            profiler.started(SimpleNamespace(request_id=i, command_name='find',
+                                             command={'find': 'taxons', 'filter': {
+                                                 'tokens.{}'.format(token): {'$gt': 0}}}))
+            profiler.succeeded(SimpleNamespace(request_id=i, duration_micros=i * 1000))
+        profile = g._queries_profile
+        assert profile['count'] == PROFILER_SLOWEST_COUNT + 2
+        assert sorted(d for d, _, _ in profile['slowest']) == [2, 3, 4, 5, 6]
+        return 'ok'
+
+    r = app.test_client().get('/')
+    assert r.status_code == 200
+    assert r.headers['Server-Timing'].startswith('db;desc="7 queries";dur=21.0, total;dur=')
+    # Summary is logged once the response is over
+    r.close()
+    summary, slow = [record for record in caplog.records
+                     if record.name == 'vigiechiro.profiler']
+    assert json.loads(summary.getMessage())['route'] == 'route'
+    assert json.loads(summary.getMessage())['slowest'][0]['duration'] == 6
+    assert slow.levelname == 'WARNING'
+    # The tokens never reach the logs
+    assert token not in summary.getMessage() + slow.getMessage()
+    assert 'tokens.*' in slow.getMessage()
+
+
+def test_check_query_plan():
+    index_scan = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': 'site_1__id_1'}}
+    assert check_query_plan(index_scan) == []
+    assert check_query_plan({'stage': 'COLLSCAN'}) == ['collection scan']
+    sort = {'stage': 'SORT', 'inputStage': {'stage': 'SORT_KEY_GENERATOR', 'inputStage': index_scan}}
+    assert check_query_plan(sort) == ['in-memory sort']
+    union = {'stage': 'SUBPLAN', 'inputStage': {'stage': 'OR', 'inputStages': [
+        index_scan, {'stage': 'COLLSCAN'}]}}
+    assert check_query_plan(union) == ['collection scan']
+
+
+def test_placeholder_query():
+    shape = _command_shape('find', {'find': 'donnees', 'filter': {'$or': [
+        {'titre': {'$regex': 'a', '$options': 'i'}}, {'l': {'$size': 2, '$in': [1, 2]}}]}})
+    assert build_placeholder_query(shape['filter']) == {'$or': [
+        {'titre': {'$regex': '^', '$options': ''}}, {'l': {'$size': 0, '$in': [0]}}]}
+
+
+class FakeCollection:
+
+    def __init__(self):
+        self.documents = {}
+
+    def update_one(self, lookup, update, upsert=False):
+        document = self.documents.setdefault(lookup['_id'], dict(update['$setOnInsert']))
+        document.setdefault('routes', []).append(update['$addToSet']['routes'])
+
+    def find(self):
+        return list(self.documents.values())
+
+
+class FakeDB:
+
+    def __init__(self):
+        self.collection = FakeCollection()
+        self.explained = []
+
+    def __getitem__(self, name):
+        assert name == QUERY_SHAPES_COLLECTION
+        return self.collection
+
+    def command(self, name, command, verbosity=None):
+        self.explained.append(command)
+        if 'aggregate' in command:
+            return {'stages': [{'$cursor': {'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}}}}]}
+        return {'queryPlanner': {'winningPlan': {'stage': 'IXSCAN'}}}
+
+
+def test_query_shapes():
+    app = Flask(__name__)
+    db = FakeDB()
+    app.data = SimpleNamespace(db=db)
+    recorder = QueryShapesRecorder()
+    init_query_shapes_registry(app)
+    token = uuid4().hex
+    commands = [
+        ('find', {'find': 'utilisateurs', 'filter': {'tokens.{}'.format(token): {'$exists': True}}}),
+        ('count', {'count': 'donnees', 'query': {'participation': ObjectId()}}),
+        ('distinct', {'distinct': 'donnees', 'key': 'observations.tadarida_taxon',
+                      'query': {'participation': ObjectId()}}),
+        ('aggregate', {'aggregate': 'donnees', 'pipeline': [{'$match': {'titre': 'a'}}]}),
+    ]
+
+    @app.route('/')
+    def route():
+        for i, (command_name, command) in enumerate(commands):
+            recorder.started(SimpleNamespace(request_id=i, command_name=command_name,
+                                             command=command))
+        return 'ok'
+
+    app.test_client().get('/').close()
+    documents = db.collection.find()
+    assert len(documents) == 4
+    # The values of the lookups are not stored
+    assert token not in json.dumps(documents)
+    results = explain_query_shapes(db)
+    explained = {list(command)[0]: command for command in db.explained}
+    assert explained['find']['filter'] == {'tokens.*': {'$exists': True}}
+    assert explained['count']['query'] == {'participation': 0}
+    assert explained['distinct']['key'] == 'observations.tadarida_taxon'
+    assert explained['aggregate']['pipeline'] == [{'$match': {'titre': 0}}]
+    assert [(shape['command'], issues) for shape, issues in results] == [
+        ('aggregate', ['collection scan'])]
@@ -0,0 +1,80 @@
+import pytest
+from types import SimpleNamespace
+from bson import ObjectId
+from flask import Flask
+from werkzeug.exceptions import HTTPException
+
+from vigiechiro.xin.resource import Resource, DocumentException, UPDATE_MAX_RETRIES
+
+
+class SingleDocumentCollection:
+    """Collection of a single document, updates check its etag"""
+
+    def __init__(self, document):
+        self.document = document
+        self.reads = 0
+        self.updates = 0
+
+    def find_one(self, lookup, projection=None):
+        self.reads += 1
+        return dict(self.document)
+
+    def find_and_modify(self, query, update, new=False):
+        self.updates += 1
+        if query.get('_etag', self.document['_etag']) != self.document['_etag']:
+            return None
+        self.document.update(update['$set'])
+        return dict(self.document)
+
+
+@pytest.fixture
+def resource_app():
+    resource = Resource('test_resource', __name__, schema={'a': {'type': 'integer'}})
+    app = Flask(__name__)
+    collection = SingleDocumentCollection({'_id': ObjectId(), '_etag': 'etag', 'a': 1})
+    app.data = SimpleNamespace(db={'test_resource': collection})
+    with app.test_request_context():
+        yield resource, collection
+
+
+def test_update_too_many_conflicts(resource_app):
+    resource, collection = resource_app
+    # The document is modified by someone else between each read and update
+    collection.find_one = lambda *args, **kwargs: dict(collection.document, _etag='outdated')
+    with pytest.raises(DocumentException) as exc:
+        resource.update({'a': 1}, {'a': 2}, auto_abort=False)
+    assert exc.value.args[0][0] == 409
+    assert collection.updates == UPDATE_MAX_RETRIES + 1
+    with pytest.raises(HTTPException) as exc:
+        resource.update({'a': 1}, {'a': 2})
+    assert exc.value.code == 409
+
+
+def test_update_if_match(resource_app):
+    resource, collection = resource_app
+    document_id = collection.document['_id']
+    # The etag is checked even for the updates by id
+    with pytest.raises(DocumentException) as exc:
+        resource.update(document_id, {'a': 2}, if_match='outdated', auto_abort=False)
+    assert exc.value.args[0][0] == 412
+    assert collection.updates == 0
+    document = resource.update(document_id, {'a': 2}, if_match='etag')
+    assert document['a'] == 2
+    assert collection.reads == 2
+    # No etag to check, no need to read the document
+    document = resource.update(document_id, {'a': 3})
+    assert document['a'] == 3
+    assert collection.reads == 2
+
+
+def test_selection_overlapping_fields(resource_app):
+    resource = Resource('test_selection', __name__, schema={
+        'a': {'type': 'integer'},
+        'l': {'type': 'list', 'schema': {'type': 'dict', 'schema': {
+            'b': {'type': 'integer'}, 'c': {'type': 'integer'}}}}})
+    # Mongodb rejects a projection on both a field and one of its sub-fields
+    _, kwargs, _ = resource._apply_selection(({}, ), {'sort': [('l.c', 1)]}, None,
+                                             'l,l.b,a', None)
+    assert set(kwargs['projection']) == {'_id', '_created', '_updated', '_etag', 'l', 'a'}
+    _, kwargs, _ = resource._apply_selection(({}, ), {}, None, 'l.b,l.c', None)
+    assert set(kwargs['projection']) == {'_id', '_created', '_updated', '_etag', 'l.b', 'l.c'}
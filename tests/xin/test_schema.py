@@ -4,7 +4,7 @@ from bson import ObjectId
 from copy import deepcopy
 
 from vigiechiro import app
-from vigiechiro.xin.schema import GenericValidator, Validator, Unserializer
+from vigiechiro.xin.schema import GenericValidator, Validator, Unserializer, RelationsBatch
 
 from ..common import db
 
@@ -322,3 +322,70 @@ def test_bijection_data_relation(clean_db):
         assert result.is_valid, result.errors
         assert result.document == doc
     test()
+
+
+def test_attribute_registered_after_compile():
+    schema = {
+        'c': {'type': 'string', 'regex': r'^(A|B)$', 'even_length': True},
+    }
+    v = GenericValidator(schema)
+    v.attribute(lambda context: None, name='even_length')
+    result = v.run({'c': 'C'})
+    assert result.errors == {'c': "value does not match regex '^(A|B)$'"}
+    # New attribute must be taken into account by the compiled schema
+    def even_length(context):
+        if len(context.value) % 2:
+            context.add_error('odd length')
+    v.attribute(even_length)
+    result = v.run({'c': 'C'})
+    assert result.errors == {'c': ["value does not match regex '^(A|B)$'", 'odd length']}
+    result = v.run({'c': 'A'})
+    assert result.errors == {'c': 'odd length'}
+
+
+def test_registered_attribute_override():
+    schema = {'c': {'type': 'string', 'regex': 'A'}}
+    v = GenericValidator(schema)
+    assert v.run({'c': 'CA'}).errors == {'c': "value does not match regex 'A'"}
+    # Registered attributes take precedence over the builtin ones
+    def regex(context):
+        if context.schema['regex'] not in context.value:
+            context.add_error('substring not found')
+    v.attribute(regex)
+    assert v.run({'c': 'CA'}).errors == {}
+    assert v.run({'c': 'C'}).errors == {'c': 'substring not found'}
+
+
+def test_batched_data_relation(clean_db):
+    vigiechiro_db = db[TEST_RESOURCE]
+    relation_ids = [vigiechiro_db.insert({'a': i}) for i in range(3)]
+    unknown_id = ObjectId()
+    doc = {'_id': ObjectId(), 'l': relation_ids + [relation_ids[0], unknown_id]}
+    schema = {
+        '_id': {'type': 'objectid'},
+        'l': {
+            'type': 'list',
+            'schema': {
+                'type': 'objectid',
+                'data_relation': {'resource': TEST_RESOURCE, 'field': '_id',
+                                  'expend': True}
+            }
+        }
+    }
+    u = Unserializer(schema)
+    @with_flask_context
+    def test():
+        expected = u.run(deepcopy(doc))
+        relations_batch = RelationsBatch()
+        result = u.run(deepcopy(doc), additional_context={'relations_batch': relations_batch})
+        # Relations are expended only once the batch is fetched
+        assert result.document['l'] == doc['l']
+        relations_batch.expend()
+        assert result.document == expected.document
+        assert result.errors == expected.errors
+        assert list(result.errors) == ['l']
+        # Occurrences of the same relation must not share the fetched document
+        assert result.document['l'][0] == result.document['l'][3]
+        result.document['l'][0]['a'] = 42
+        assert result.document['l'][3]['a'] == 0
+    test()
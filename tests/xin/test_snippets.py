@@ -0,0 +1,53 @@
+import json
+import pytest
+from bson import ObjectId
+from datetime import datetime
+from werkzeug.exceptions import HTTPException
+
+from vigiechiro import app
+from vigiechiro.xin.snippets import (encode_cursor, decode_cursor, build_keyset_lookup,
+                                     build_list_etag, Paginator)
+
+
+class Test_cursor:
+
+    def test_encode_decode(self):
+        values = [datetime(2020, 5, 1, 12, 30), ObjectId()]
+        token = encode_cursor(['_updated', '_id'], values)
+        assert decode_cursor(token) == {'fields': ['_updated', '_id'], 'values': values}
+
+
+    def test_invalid(self):
+        with pytest.raises(HTTPException):
+            decode_cursor('dummy')
+
+
+    def test_keyset_lookup(self):
+        assert build_keyset_lookup([('_id', 1)], ['id']) == {'_id': {'$gt': 'id'}}
+        lookup = build_keyset_lookup([('titre', -1), ('_id', -1)], ['t', 'id'])
+        assert lookup == {'$or': [{'titre': {'$lt': 't'}},
+                                  {'titre': 't', '_id': {'$lt': 'id'}}]}
+
+
+class Test_list_etag:
+
+    def test_changes(self):
+        items = [{'_id': ObjectId(), '_etag': 'a', '_updated': datetime(2020, 5, 1)},
+                 {'_id': ObjectId(), '_etag': 'b', '_updated': datetime(2020, 5, 2)}]
+        meta = {'page': 1, 'total': 2}
+        etag = build_list_etag(items, meta)
+        assert build_list_etag([dict(item) for item in items], dict(meta)) == etag
+        assert build_list_etag(items[:1], meta) != etag
+        assert build_list_etag(items, {'page': 2, 'total': 2}) != etag
+        # Modified within the same second as the previous modification
+        modified = [items[0], dict(items[1], _etag='c')]
+        assert build_list_etag(modified, meta) != etag
+
+    def test_generator_items(self):
+        # Resource.find returns a generator
+        items = [{'_id': ObjectId(), '_etag': 'a', '_updated': datetime(2020, 5, 1)}]
+        with app.test_request_context('/'):
+            r = Paginator().make_response((item for item in items), 1)
+        assert r.status_code == 200
+        assert len(json.loads(r.get_data(as_text=True))['_items']) == 1
+        assert r.headers['ETag'].startswith('W/')
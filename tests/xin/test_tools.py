@@ -1,6 +1,10 @@
+import json
 import pytest
+from bson import ObjectId
+from datetime import datetime, date, timezone
 
-from vigiechiro.xin.tools import dict_projection
+from vigiechiro.xin.tools import (dict_projection, dumps_json, set_json_backend,
+                                  JSON_BACKENDS, orjson)
 
 
 class Test_dict_projection:
@@ -60,3 +64,62 @@ class Test_dict_projection:
         projection = {'a': False, 'b': {}}
         data = {'a': 'killme', 'b': {'bb': 'stillhere'}}
         assert dict_projection(data, projection) == {'b': {'bb': 'stillhere'}}
+
+
+def _build_payload():
+    now = datetime(2020, 6, 21, 22, 30, 12, 345000)
+    taxon = {'_id': ObjectId('5eefdfa91c8a2f0001c5a0e1'), 'libelle_court': 'Pippip', 'libelle_long': 'Pipistrelle commune'}
+    observations = [{'temps_debut': i * 0.5, 'temps_fin': i * 0.5 + 0.2,
+                     'frequence_mediane': 45.3, 'tadarida_taxon': taxon,
+                     'tadarida_probabilite': 0.87, 'tadarida_taxon_autre': [],
+                     'messages': [{'message': 'Chiroptère "à vérifier"\n\t\x1f',
+                                   'date': now.replace(tzinfo=timezone.utc)}]}
+                    for i in range(10)]
+    donnee = {'_id': ObjectId('5eefdfa91c8a2f0001c5a0e2'), '_created': now, '_updated': now, '_etag': 'etag',
+              'titre': 'Cir1-2020-Pass1-Tron1-Chiro_0_00000_000', 'publique': True,
+              'jour': date(2020, 6, 21), 'tags': {'a'}, 'observations': observations,
+              'position': {'type': 'Point', 'coordinates': [2.35, 48.85]}}
+    return {'_items': (d for d in [donnee, donnee]), '_meta': {'total': 2, 'page': 1,
+                                                            'next': None, 'exact': False}}
+
+
+@pytest.mark.skipif(not orjson, reason='orjson not installed')
+def test_json_backends_identical():
+    outputs = [JSON_BACKENDS[name](_build_payload()) for name in ('stdlib', 'orjson')]
+    assert outputs[0] == outputs[1]
+
+
+@pytest.mark.skipif(not orjson, reason='orjson not installed')
+def test_json_backends_edge_values():
+    stdlib, fast = JSON_BACKENDS['stdlib'], JSON_BACKENDS['orjson']
+    # Floats with an exponent are written differently but decoded the same
+    floats = [1e-05, 1e16, 1.5e300, -2.5e-10, 0.1, 45.3]
+    assert json.loads(stdlib(floats)) == json.loads(fast(floats)) == floats
+    assert stdlib([1e-05, 1e16]) == b'[1e-05,1e+16]'
+    assert fast([1e-05, 1e16]) == b'[0.00001,1e16]'
+    # NaN and infinity are not valid JSON, orjson writes null
+    assert stdlib([float('nan'), float('inf')]) == b'[NaN,Infinity]'
+    assert fast([float('nan'), float('inf')]) == b'[null,null]'
+    # orjson falls back on stdlib for the integers beyond 64 bits, including
+    # the iterators it already consumed
+    payload = {'a': (i for i in range(3)), 'b': 2 ** 64, 'c': -2 ** 63 - 1, 'd': ObjectId('5eefdfa91c8a2f0001c5a0e1')}
+    expected = b'{"a":[0,1,2],"b":18446744073709551616,"c":-9223372036854775809,"d":"5eefdfa91c8a2f0001c5a0e1"}'
+    assert fast(payload) == expected
+    payload['a'] = (i for i in range(3))
+    assert stdlib(payload) == expected
+    with pytest.raises(TypeError):
+        fast({'a': 2 ** 64, 'b': object()})
+
+
+def test_dumps_json():
+    for name in JSON_BACKENDS:
+        set_json_backend(name)
+        try:
+            payload = _build_payload()
+            donnee = next(payload['_items'])
+            loaded = json.loads(dumps_json(payload).decode('utf-8'))
+            assert loaded['_items'][0]['_id'] == str(donnee['_id'])
+            assert loaded['_items'][0]['_created'] == '2020-06-21T22:30:12.345000'
+            assert loaded['_items'][0]['tags'] == ['a']
+        finally:
+            set_json_backend('orjson' if orjson else 'stdlib')
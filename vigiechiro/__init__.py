@@ -2,11 +2,19 @@
 Backend of the vigiechiro project
 """
 
+from importlib import import_module
+
 __version__ = "0.1"
 
-# Monkeypatch to fix import in flask-cache
-from werkzeug.utils import import_string
-import werkzeug
-werkzeug.import_string = import_string
 
-from vigiechiro.app import app
+# The Flask application is loaded on first access to `vigiechiro.app`
+# this way light modules (settings, queuer...) can be imported without
+# paying the cost of the application initialization.
+def __getattr__(name):
+    if name != 'app':
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    app = import_module('.app', __name__).app
+    # Importing the submodule has set it as attribute of the package,
+    # provide the application instead
+    globals()['app'] = app
+    return app
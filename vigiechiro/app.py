@@ -1,5 +1,10 @@
 #! /usr/bin/env python3
 
+# Monkeypatch to fix import in flask-cache
+from werkzeug.utils import import_string
+import werkzeug
+werkzeug.import_string = import_string
+
 import requests
 from logging.config import dictConfig
 from os.path import abspath, dirname
@@ -12,8 +17,10 @@ from . import resources
 
 from .xin.mail import Mail
 from .xin.auth import auth_factory
-from .xin.tools import ObjectIdConverter
-from .xin.cors import add_cors_headers_factory
+from .xin.tools import ObjectIdConverter, set_json_backend
+from .xin.cors import add_cors_headers_factory, PreflightMiddleware
+from .xin.debug import (init_queries_count_header, init_queries_profiler,
+                        init_query_shapes_registry)
 
 
 def _monkeypatch_flask_cache():
@@ -77,7 +84,8 @@ def init_app():
         },
         'loggers': {
             'task': {'level': 'INFO'},
-            'requests': {'level': 'WARNING'}  # Avoid flooding in task_participation
+            'requests': {'level': 'WARNING'},  # Avoid flooding in task_participation
+            'vigiechiro.profiler': {'level': 'INFO'}
         }
     })
 
@@ -109,6 +117,14 @@ def init_app():
                     response.headers[key] = value
                 return response
             return send_from_directory('static', path)
+    if app.config['JSON_BACKEND']:
+        set_json_backend(app.config['JSON_BACKEND'])
+    if app.config['DEBUG_QUERIES_COUNT']:
+        init_queries_count_header(app)
+    if app.config['DEBUG_QUERIES_PROFILER']:
+        init_queries_profiler(app, app.config['SLOW_REQUEST_THRESHOLD'])
+    if app.config['DEBUG_QUERY_SHAPES']:
+        init_query_shapes_registry(app)
     app.data = PyMongo(app)
     # Add objectid as url variable type
     app.url_map.converters['objectid'] = ObjectIdConverter
@@ -125,7 +141,10 @@ def init_app():
     app.register_blueprint(resources.sites, url_prefix=url_prefix)
     app.register_blueprint(resources.participations, url_prefix=url_prefix)
     app.register_blueprint(resources.donnees, url_prefix=url_prefix)
+    app.register_blueprint(resources.monitoring, url_prefix=url_prefix)
+    app.register_blueprint(resources.campagnes, url_prefix=url_prefix)
     make_json_app(app)
+    app.wsgi_app = PreflightMiddleware(app)
     # Init Flask-Mail
     app.mail = Mail(app)
     return app
@@ -13,6 +13,8 @@ from .actualites import actualites
 from .sites import sites
 from .participations import participations
 from .donnees import donnees
+from .monitoring import monitoring
+from .campagnes import campagnes
 
 
 def strip_resource_fields(doc_type, data):
@@ -5,8 +5,9 @@
 """
 
 import logging
-from flask import g, request
+from flask import g, request, current_app
 from datetime import datetime
+from pymongo import IndexModel
 
 from ..xin import Resource, DocumentException
 from ..xin.auth import requires_auth
@@ -32,7 +33,11 @@ SCHEMA = {
 }
 
 
-actualites = Resource('actualites', __name__, schema=SCHEMA)
+actualites = Resource('actualites', __name__, schema=SCHEMA, indexes=[
+    IndexModel([('_updated', -1), ('_id', -1)]),
+    # Actualites followed by an utilisateur
+    IndexModel([('resources', 1), ('_updated', -1), ('_id', -1)])
+])
 
 
 def _create_actuality(lookup, document):
@@ -88,6 +93,12 @@ def create_actuality_nouvelle_participation(participation):
 
 def create_actuality_inscription_protocole_batch(sujet_id, protocoles, inscription_validee=False):
     now = datetime.utcnow()
+    # Actualities of a previous inscription are replaced, the others
+    # are inserted together
+    existing = {a['protocole'] for a in current_app.data.db.actualites.find(
+        {'action': 'INSCRIPTION_PROTOCOLE', 'sujet': sujet_id,
+         'protocole': {'$in': list(protocoles)}}, projection={'protocole': True})}
+    to_insert = []
     for protocole_id in protocoles:
         document = {
             'action': 'INSCRIPTION_PROTOCOLE',
@@ -102,7 +113,15 @@ def create_actuality_inscription_protocole_batch(sujet_id, protocoles, inscripti
         }
         if inscription_validee:
             document['date_validation'] = now
-        _create_actuality(lookup, document)
+        if protocole_id in existing:
+            _create_actuality(lookup, document)
+        else:
+            to_insert.append(document)
+    if to_insert:
+        _, errors = actualites.insert_many(to_insert)
+        for index, error in errors.items():
+            logging.error('error inserting actuality {} : {}'.format(
+                to_insert[index], error))
 
 
 def create_actuality_validation_protocole(protocole, utilisateur):
@@ -146,9 +165,7 @@ def get_user_actualites():
     following = g.request_user.get('actualites_suivies', [])
     following.append(g.request_user['_id'])
     lookup = {'resources': {'$in': following}}
-    found = actualites.find(lookup, sort=[('_updated', -1)],
-                            skip=pagination.skip,
-                            limit=pagination.max_results)
+    found = pagination.find(actualites, lookup, sort=[('_updated', -1)])
     return pagination.make_response(*found)
 
 
@@ -170,7 +187,5 @@ def get_actualites_validations():
     elif val_type != 'TOUS':
         abort(422, {'type': 'bad param type'})
     expend = ['sujet', 'protocole']
-    found = actualites.find(lookup, sort=[('_updated', -1)],
-                            skip=pagination.skip,
-                            limit=pagination.max_results)
+    found = pagination.find(actualites, lookup, sort=[('_updated', -1)])
     return pagination.make_response(*found)
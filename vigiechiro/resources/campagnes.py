@@ -0,0 +1,224 @@
+"""
+    Campagnes de traitement
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Reprocessing of a selection of participations (e.g. after a new
+    tadarida classifier has been deployed). The participations are
+    submitted progressively by `feed_campagnes` to avoid flooding the queue.
+"""
+
+import logging
+from flask import g, current_app
+from datetime import datetime, timedelta
+
+from ..xin import Resource, DocumentException
+from ..xin.tools import jsonify, abort
+from ..xin.auth import requires_auth
+from ..xin.schema import relation, choice
+from ..xin.snippets import Paginator, get_payload, get_if_match
+from .. import scripts
+from ..scripts import queuer
+from .participations import participations as participations_resource, build_version_key
+from .utilisateurs import utilisateurs as utilisateurs_resource
+
+
+SCHEMA = {
+    'titre': {'type': 'string', 'required': True},
+    'createur': relation('utilisateurs'),
+    # Selection criteria of the participations
+    'protocole': relation('protocoles'),
+    'date_debut_min': {'type': 'datetime'},
+    'date_debut_max': {'type': 'datetime'},
+    # Participations already processed with this classifier version are skipped
+    'version_tadarida_c': {'type': 'string', 'required': True},
+    # Throttling
+    'debit_par_heure': {'type': 'integer', 'min': 1},
+    'max_en_attente': {'type': 'integer', 'min': 1},
+    'etat': choice(['EN_COURS', 'PAUSE', 'FINI', 'ANNULE']),
+    # Progress, `curseur` is the last submitted participation
+    'curseur': {'type': 'objectid'},
+    'nb_selectionnees': {'type': 'integer'},
+    'nb_a_jour': {'type': 'integer'},
+    'nb_soumises': {'type': 'integer'},
+    'date_dernier_envoi': {'type': 'datetime'},
+    'date_fin': {'type': 'datetime'}
+}
+DEFAULT_DEBIT_PAR_HEURE = 60
+DEFAULT_MAX_EN_ATTENTE = 20
+
+
+campagnes = Resource('campagnes', __name__, schema=SCHEMA)
+
+
+def build_participations_lookup(campagne, up_to_date=False):
+    """Return the lookup of the participations selected by the campagne,
+    if `up_to_date` only those already processed with the wanted version
+    """
+    lookup = {}
+    if campagne.get('protocole'):
+        lookup['protocole'] = campagne['protocole']
+    date_debut = {}
+    if campagne.get('date_debut_min'):
+        date_debut['$gte'] = campagne['date_debut_min']
+    if campagne.get('date_debut_max'):
+        date_debut['$lte'] = campagne['date_debut_max']
+    if date_debut:
+        lookup['date_debut'] = date_debut
+    version = build_version_key(campagne['version_tadarida_c'])
+    if up_to_date:
+        lookup['traitement.version_tadarida_c_cle'] = {'$gte': version}
+    else:
+        lookup['traitement.version_tadarida_c_cle'] = {'$not': {'$gte': version}}
+    return lookup
+
+
+def backfill_version_keys():
+    """Set the version key of the participations processed before it
+    existed (see `build_version_key`)"""
+    collection = current_app.data.db[participations_resource.name]
+    lookup = {'traitement.version_tadarida_c': {'$exists': True},
+              'traitement.version_tadarida_c_cle': {'$exists': False}}
+    # Few distinct versions, each one is updated at once
+    for version in collection.distinct('traitement.version_tadarida_c', lookup):
+        collection.update_many(
+            dict(lookup, **{'traitement.version_tadarida_c': version}),
+            {'$set': {'traitement.version_tadarida_c_cle': build_version_key(version)}})
+
+
+def _campagne_jobs_lookup(campagne_id):
+    return {'name': 'process_participation', 'kwargs.campagne': campagne_id}
+
+
+def get_campagne_progress(campagne):
+    """Return the jobs counters and the throughput of the campagne"""
+    lookup = _campagne_jobs_lookup(campagne['_id'])
+    jobs = {'READY': 0, 'RESERVED': 0, 'DONE': 0, 'ERROR': 0}
+    for collection in (queuer.collection, queuer.archive_collection):
+        for item in collection.aggregate([
+                {'$match': lookup},
+                {'$group': {'_id': '$status', 'count': {'$sum': 1}}}]):
+            jobs[item['_id']] = jobs.get(item['_id'], 0) + item['count']
+    since = datetime.utcnow() - timedelta(hours=1)
+    last_hour = queuer.archive_collection.count_documents(
+        dict(lookup, status='DONE', finished_at={'$gte': since}))
+    return {
+        'attente': jobs['READY'],
+        'en_cours': jobs['RESERVED'],
+        'finies': jobs['DONE'],
+        'erreurs': jobs['ERROR'],
+        'restantes': campagne['nb_selectionnees'] - campagne['nb_soumises'],
+        'debit_derniere_heure': last_hour
+    }
+
+
+def feed_campagne(campagne):
+    """Submit the next participations of the campagne within its throttling
+    limits, returns the number of submitted jobs
+    """
+    now = datetime.utcnow()
+    queued = queuer.collection.count_documents(dict(
+        _campagne_jobs_lookup(campagne['_id']), status={'$in': ['READY', 'RESERVED']}))
+    # Rate is enforced by the time elapsed since the last submission
+    last_sent = campagne.get('date_dernier_envoi') or campagne['_created']
+    allowed_by_rate = int(campagne.get('debit_par_heure', DEFAULT_DEBIT_PAR_HEURE) *
+                          (now - last_sent).total_seconds() / 3600)
+    allowed = min(campagne.get('max_en_attente', DEFAULT_MAX_EN_ATTENTE) - queued,
+                  allowed_by_rate)
+    lookup = build_participations_lookup(campagne)
+    if campagne.get('curseur'):
+        lookup['_id'] = {'$gt': campagne['curseur']}
+    to_submit = []
+    if allowed > 0:
+        to_submit = list(participations_resource.find(
+            lookup, projection={'_id': True, 'observateur': True},
+            sort=[('_id', 1)], limit=allowed)[0])
+    if not to_submit:
+        if not queued and not participations_resource.find(lookup, limit=1)[1]:
+            campagnes.update(campagne['_id'], {'etat': 'FINI', 'date_fin': now},
+                             auto_abort=False)
+        return 0
+    observateurs_ids = list({p['observateur'] for p in to_submit})
+    publiques = {u['_id']: u.get('donnees_publiques', False) for u in
+                 utilisateurs_resource.find({'_id': {'$in': observateurs_ids}},
+                                            projection={'donnees_publiques': True})[0]}
+    for participation in to_submit:
+        # No notify_mail, users are not warned about campaigns' reprocessing
+        scripts.process_participation.delay(
+            participation['_id'], publique=publiques.get(participation['observateur'], False),
+            campagne=campagne['_id'])
+        try:
+            participations_resource.update(participation['_id'], payload={
+                'traitement': {'etat': 'PLANIFIE', 'date_planification': now}},
+                auto_abort=False)
+        except DocumentException as e:
+            logging.error('error planifying participation {} : {}'.format(
+                participation['_id'], e))
+    campagnes.update(campagne['_id'], {}, mongo_update={
+        '$set': {'curseur': to_submit[-1]['_id'], 'date_dernier_envoi': now},
+        '$inc': {'nb_soumises': len(to_submit)}}, auto_abort=False)
+    return len(to_submit)
+
+
+def feed_campagnes():
+    """Feed all the running campagnes, to be called periodically"""
+    found, _ = campagnes.find({'etat': 'EN_COURS'})
+    return {c['_id']: feed_campagne(c) for c in found}
+
+
+def create_campagne(payload):
+    payload['etat'] = 'EN_COURS'
+    payload.setdefault('debit_par_heure', DEFAULT_DEBIT_PAR_HEURE)
+    payload.setdefault('max_en_attente', DEFAULT_MAX_EN_ATTENTE)
+    payload['nb_soumises'] = 0
+    # Insert first to have the criteria validated and unserialized
+    campagne = campagnes.insert(payload)
+    backfill_version_keys()
+    counters = {}
+    for field, up_to_date in (('nb_selectionnees', False), ('nb_a_jour', True)):
+        _, counters[field] = participations_resource.find(
+            build_participations_lookup(campagne, up_to_date=up_to_date), limit=1)
+    return campagnes.update(campagne['_id'], counters)
+
+
+@campagnes.route('/campagnes', methods=['GET'])
+@requires_auth(roles='Administrateur')
+def list_campagnes():
+    pagination = Paginator()
+    found = pagination.find(campagnes, sort=[('_created', -1)])
+    return pagination.make_response(*found)
+
+
+@campagnes.route('/campagnes', methods=['POST'])
+@requires_auth(roles='Administrateur')
+def api_create_campagne():
+    payload = get_payload({'titre': True, 'protocole': False, 'date_debut_min': False,
+                           'date_debut_max': False, 'version_tadarida_c': True,
+                           'debit_par_heure': False, 'max_en_attente': False})
+    payload['createur'] = g.request_user['_id']
+    return create_campagne(payload), 201
+
+
+@campagnes.route('/campagnes/<objectid:campagne_id>', methods=['GET'])
+@requires_auth(roles='Administrateur')
+def display_campagne(campagne_id):
+    campagne = campagnes.find_one({'_id': campagne_id})
+    campagne['progression'] = get_campagne_progress(campagne)
+    return campagne
+
+
+@campagnes.route('/campagnes/<objectid:campagne_id>', methods=['PATCH'])
+@requires_auth(roles='Administrateur')
+def edit_campagne(campagne_id):
+    payload = get_payload({'titre': False, 'debit_par_heure': False,
+                           'max_en_attente': False, 'etat': False})
+    if payload.get('etat') not in (None, 'EN_COURS', 'PAUSE', 'ANNULE'):
+        abort(422, {'etat': 'only EN_COURS, PAUSE and ANNULE can be set'})
+    campagne = campagnes.find_one({'_id': campagne_id})
+    if payload.get('etat') and campagne['etat'] in ('FINI', 'ANNULE'):
+        abort(422, {'etat': 'campagne is over'})
+    result = campagnes.update(campagne_id, payload, if_match=get_if_match())
+    if payload.get('etat') == 'ANNULE':
+        # Jobs already running are left to finish
+        queuer.collection.delete_many(dict(
+            _campagne_jobs_lookup(campagne_id), status='READY'))
+    return jsonify(result)
@@ -9,6 +9,7 @@ from flask import request, current_app, g
 from datetime import datetime
 import re
 from bson import ObjectId
+from pymongo import IndexModel
 
 from ..xin import Resource
 from ..xin.tools import jsonify, abort
@@ -17,7 +18,7 @@ from ..xin.snippets import Paginator, get_payload, get_resource, get_url_params
 from ..xin.schema import relation, choice
 
 from .utilisateurs import utilisateurs as utilisateurs_resource
-from ..scripts import participation_generate_bilan
+from .. import scripts
 
 def validate_donnee_name(name):
     allow_extensions = ['wav', 'ta', 'tc', 'tac', 'tcc']
@@ -98,7 +99,14 @@ SCHEMA = {
 }
 
 
-donnees = Resource('donnees', __name__, schema=SCHEMA)
+donnees = Resource('donnees', __name__, schema=SCHEMA, indexes=[
+    IndexModel([('proprietaire', 1), ('publique', 1)]),
+    IndexModel([('participation', 1), ('titre', 1)]),
+    IndexModel([('participation', 1), ('_id', 1)]),
+    IndexModel([('observations.tadarida_taxon', 1),
+                ('observations.tadarida_probabilite', 1), ('_created', 1)]),
+    IndexModel([('observations.tadarida_taxon', 1), ('participation', 1)])
+])
 
 
 def update_donnees_publique(user_id, donnees_publiques):
@@ -130,13 +138,15 @@ def list_donnees():
     else:
         # Only show public and owned donnees
         lookup = {'$or': [{'publique': True}, {'proprietaire': g.request_user['_id']}]}
-    found = donnees.find(lookup, skip=pagination.skip, limit=pagination.max_results)
+    found = pagination.find(donnees, lookup)
     return pagination.make_response(*found)
 
 
 @donnees.route('/donnees/<objectid:donnee_id>', methods=['GET'])
 @requires_auth(roles='Observateur')
 def display_donnee(donnee_id):
+    # No `check_etag`, the access rights must be checked before answering 304
+    # (done by the route with the etag of the returned document)
     donnee_resource = donnees.get_resource(donnee_id)
     _check_access_rights(donnee_resource)
     return donnee_resource
@@ -163,7 +173,7 @@ def display_donnee_fichiers(donnee_id):
             mime += ALLOWED_MIMES_WAV
         lookup['mime'] = {'$in': mime}
     pagination = Paginator()
-    found = fichiers_resource.find(lookup, skip=pagination.skip, limit=pagination.max_results)
+    found = pagination.find(fichiers_resource, lookup)
     return pagination.make_response(*found)
 
 
@@ -181,8 +191,8 @@ def list_participation_donnees(participation_id):
     if 'tadarida_taxon' in request.args:
         observations['observations']['$elemMatch'].update({'tadarida_taxon': ObjectId(request.args['tadarida_taxon'])})
         lookup.update(observations)
-    found = donnees.find(lookup, skip=pagination.skip, limit=pagination.max_results,
-                         projection={'participation': False, 'proprietaire': False})
+    found = pagination.find(donnees, lookup,
+                            projection={'participation': False, 'proprietaire': False})
     return pagination.make_response(*found)
 
 
@@ -203,7 +213,7 @@ def create_donnee(participation_id):
         payload['publique'] = g.request_user.get('donnees_publiques', False)
     result = donnees.insert(payload)
     if 'observations' in payload and not request.args.get('no_bilan', False):
-        participation_generate_bilan.delay_singleton(participation_id)
+        scripts.participation_generate_bilan.delay_singleton(participation_id)
     return result, 201
 
 
@@ -221,7 +231,7 @@ def update_donnee(donnee_id):
         abort(403)
     result =  donnees.update(donnee_id, payload)
     if 'observations' in payload and not request.args.get('no_bilan', False):
-        participation_generate_bilan.delay_singleton(donnee_resource['participation'])
+        scripts.participation_generate_bilan.delay_singleton(donnee_resource['participation'])
     return result, 200
 
 
@@ -268,7 +278,7 @@ def edit_observation(donnee_id, observation_id):
     result = donnees.update(donnee_id, payload={'observations': [observation]},
                             mongo_update={'$set': mongo_update_observation})
     if not request.args.get('no_bilan', False):
-        participation_generate_bilan.delay_singleton(donnee_resource['participation'])
+        scripts.participation_generate_bilan.delay_singleton(donnee_resource['participation'])
     return result
 
 
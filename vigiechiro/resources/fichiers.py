@@ -20,6 +20,7 @@ import hmac
 from hashlib import sha1
 import uuid
 from flask import request, current_app, g, redirect
+from pymongo import IndexModel
 import requests
 import re
 
@@ -93,7 +94,11 @@ SCHEMA = {
 }
 
 
-fichiers = Resource('fichiers', __name__, schema=SCHEMA)
+fichiers = Resource('fichiers', __name__, schema=SCHEMA, indexes=[
+    IndexModel([('titre', 1), ('mime', 1)]),
+    IndexModel([('lien_participation', 1), ('mime', 1)]),
+    IndexModel([('lien_donnee', 1), ('mime', 1)])
+])
 
 
 def delete_fichier_and_s3(fichier):
@@ -204,6 +209,8 @@ def _sign_request(**kwargs):
 @fichiers.route('/fichiers/<objectid:fichier_id>', methods=['GET'])
 @requires_auth(roles='Observateur')
 def display_fichier(fichier_id):
+    # No `check_etag`, the access rights must be checked before answering 304
+    # (done by the route with the etag of the returned document)
     file_resource = fichiers.get_resource(fichier_id)
     _check_access_rights(file_resource)
     return file_resource
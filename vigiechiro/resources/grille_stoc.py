@@ -6,6 +6,7 @@
 """
 
 from flask import request, current_app
+from pymongo import IndexModel, GEOSPHERE
 
 from ..xin import Resource
 from ..xin.tools import jsonify, abort
@@ -20,7 +21,9 @@ SCHEMA = {
 }
 
 
-grille_stoc = Resource('grille_stoc', __name__, schema=SCHEMA)
+grille_stoc = Resource('grille_stoc', __name__, schema=SCHEMA, indexes=[
+    IndexModel([('centre', GEOSPHERE)])
+])
 
 
 @grille_stoc.route('/grille_stoc/rectangle', methods=['GET'])
@@ -0,0 +1,40 @@
+"""
+    Monitoring
+    ~~~~~~~~~~
+
+    Administration metrics about the backend and the jobs queue
+"""
+
+from ..xin import Resource
+from ..xin.auth import requires_auth
+from ..xin.cache import get_resources_cache_stats
+from ..xin.resource import get_updates_stats
+from ..scripts import queuer
+
+
+# No documents are stored for this resource
+SCHEMA = {}
+
+
+monitoring = Resource('monitoring', __name__, schema=SCHEMA)
+
+
+@monitoring.route('/monitoring/queuer', methods=['GET'])
+@requires_auth(roles='Administrateur')
+def display_queuer_stats():
+    """Return per task queue depth, latency percentiles and throughput"""
+    return queuer.get_stats()
+
+
+@monitoring.route('/monitoring/cache', methods=['GET'])
+@requires_auth(roles='Administrateur')
+def display_cache_stats():
+    """Return the hit rate of the resources and counts caches of this process"""
+    return get_resources_cache_stats()
+
+
+@monitoring.route('/monitoring/updates', methods=['GET'])
+@requires_auth(roles='Administrateur')
+def display_updates_stats():
+    """Return the updates' retries and conflicts of this process"""
+    return get_updates_stats()
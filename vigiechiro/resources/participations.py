@@ -7,13 +7,15 @@
 
 from flask import abort, current_app, g
 from datetime import datetime
+import re
+from pymongo import IndexModel
 
 from ..xin import Resource
 from ..xin.tools import abort, parse_id
 from ..xin.auth import requires_auth
 from ..xin.schema import relation, choice
 from ..xin.snippets import (Paginator, get_payload, get_resource,
-                            get_lookup_from_q, get_url_params)
+                            get_lookup_from_q, get_url_params, get_selection_params)
 
 from .actualites import create_actuality_nouvelle_participation
 from .fichiers import (fichiers as fichiers_resource, ALLOWED_MIMES_PHOTOS,
@@ -22,8 +24,7 @@ from .fichiers import (fichiers as fichiers_resource, ALLOWED_MIMES_PHOTOS,
 from .utilisateurs import utilisateurs as utilisateurs_resource, ensure_protocole_joined_and_validated
 from .donnees import donnees as donnees_resource
 
-from ..scripts import (process_participation, clean_deleted_participation,
-                       email_observations_csv)
+from .. import scripts
 
 
 def _validate_site(context, site):
@@ -34,6 +35,14 @@ def _validate_site(context, site):
         return "cannot create protocole on an unlocked site"
 
 
+def build_version_key(version):
+    """Return a key sorting the versions (e.g. of tadarida), numbers are
+    zero-padded to have "3.10" after "3.9" """
+    return '.'.join(part.zfill(VERSION_KEY_PADDING) if part.isdigit() else part
+                    for part in re.findall(r'\d+|[^\d.]+', version))
+
+
+VERSION_KEY_PADDING = 6
 SCHEMA = {
     'observateur': relation('utilisateurs', required=True),
     'protocole': relation('protocoles', required=True),
@@ -75,7 +84,11 @@ SCHEMA = {
             'date_planification': {'type': 'datetime'},
             'date_debut': {'type': 'datetime'},
             'date_fin': {'type': 'datetime'},
-            'message': {'type': 'string'}
+            'message': {'type': 'string'},
+            # Version of the classifier used to build the observations
+            'version_tadarida_c': {'type': 'string'},
+            # Key to compare the versions, see `build_version_key`
+            'version_tadarida_c_cle': {'type': 'string'}
         }
     },
     'bilan': {
@@ -120,7 +133,12 @@ SCHEMA = {
 }
 
 
-participations = Resource('participations', __name__, schema=SCHEMA)
+participations = Resource('participations', __name__, schema=SCHEMA, indexes=[
+    # Reprocessing campaigns selection
+    IndexModel([('protocole', 1), ('date_debut', 1)]),
+    IndexModel([('observateur', 1), ('_id', 1)]),
+    IndexModel([('site', 1), ('_id', 1)])
+])
 
 
 @participations.route('/participations', methods=['GET'])
@@ -128,8 +146,7 @@ participations = Resource('participations', __name__, schema=SCHEMA)
 def list_participations():
     pagination = Paginator()
     # Filter the result fields for perf...
-    found = participations.find(get_lookup_from_q(), skip=pagination.skip,
-        limit=pagination.max_results,
+    found = pagination.find(participations, get_lookup_from_q(),
         projection={'protocole': False, 'messages': False,
                 'logs': False, 'bilan': False})
     return pagination.make_response(*found)
@@ -141,8 +158,7 @@ def list_user_participations():
     pagination = Paginator()
     lookup = {'observateur': g.request_user['_id']}
     lookup.update(get_lookup_from_q() or {})
-    found = participations.find(lookup, skip=pagination.skip,
-        limit=pagination.max_results,
+    found = pagination.find(participations, lookup,
         projection={'observateur': False, 'protocole': False, 'messages': False,
                 'logs': False, 'bilan': False})
     return pagination.make_response(*found)
@@ -154,8 +170,7 @@ def list_site_participations(site_id):
     pagination = Paginator()
     lookup = {'site': site_id}
     lookup.update(get_lookup_from_q() or {})
-    found = participations.find(lookup, skip=pagination.skip,
-        limit=pagination.max_results,
+    found = pagination.find(participations, lookup,
         projection={'protocole': False, 'site': False,
                 'messages': False, 'logs': False, 'bilan': False})
     return pagination.make_response(*found)
@@ -164,7 +179,8 @@ def list_site_participations(site_id):
 @participations.route('/participations/<objectid:participation_id>', methods=['GET'])
 @requires_auth(roles='Observateur')
 def display_participation(participation_id):
-    document = participations.find_one(participation_id)
+    document = participations.find_one(participation_id, check_etag=True,
+                                       **get_selection_params())
     return document
 
 
@@ -173,7 +189,7 @@ def display_participation(participation_id):
 def delete_participation(participation_id):
     res = participations.remove({'_id': participation_id})
     if res.deleted_count:
-        clean_deleted_participation.delay(participation_id)
+        scripts.clean_deleted_participation.delay(participation_id)
         return {}, 204
     else:
         abort(404)
@@ -199,7 +215,7 @@ Vigiechiro
            p_date=p['date_debut'], p_id=participation_id,
            domain=current_app.config['FRONTEND_DOMAIN'])
     subject = """Observations de la participation du {p_date} sur le site {p_site}""".format(p_site=site_name, p_date=p['date_debut'])
-    email_observations_csv.delay(participation_id, recipient=g.request_user['email'], subject=subject, body=body)
+    scripts.email_observations_csv.delay(participation_id, recipient=g.request_user['email'], subject=subject, body=body)
     return {}, 200
 
 
@@ -235,7 +251,7 @@ def participation_trigger_compute(participation_id):
         if ((date_debut and (now - date_debut.replace(tzinfo=None)).days < 1) or
                 (date_planif and (now - date_planif.replace(tzinfo=None)).days < 1)):
             abort(400, {'etat': 'Already %s' % status})
-    process_participation.delay(participation_id,
+    scripts.process_participation.delay(participation_id,
         publique=participation_resource['observateur'].get('donnees_publiques', False),
         notify_mail=g.request_user['email'],
         notify_msg=_build_participation_notify_msg(participation_resource))
@@ -328,7 +344,7 @@ def add_pieces_jointes(participation_id):
         pjs_ids.append(pj_id)
     if errors:
         abort(422, {'pieces_jointes': errors})
-    process_participation.delay(participation_id, pjs_ids,
+    scripts.process_participation.delay(participation_id, pjs_ids,
         utilisateurs_resource.get_resource(
             participation_resource['observateur']['_id']).get(
                 'donnees_publiques', False),
@@ -372,8 +388,7 @@ def get_pieces_jointes(participation_id):
             if '$in' not in lookup['mime']:
                 lookup['mime']['$nin'] = []
             lookup['mime']['$in'] += mimes
-    found = fichiers_resource.find(lookup, skip=pagination.skip,
-        limit=pagination.max_results,
+    found = pagination.find(fichiers_resource, lookup,
         projection={'proprietaire': False, 'lien_participation': False,
                 'lien_donnee': False, 'lien_protocole': False})
     return pagination.make_response(*found)
@@ -7,13 +7,14 @@
 
 from flask import g, request
 from datetime import datetime
+from pymongo import IndexModel, TEXT
 
 from ..xin import Resource
 from ..xin.tools import jsonify, abort, dict_projection
 from ..xin.auth import requires_auth
 from ..xin.schema import relation, choice
 from ..xin.snippets import (Paginator, get_lookup_from_q, get_payload,
-                            get_if_match, get_url_params)
+                            get_if_match, get_url_params, get_selection_params)
 
 from .actualites import (create_actuality_validation_protocole,
                          create_actuality_inscription_protocole_batch,
@@ -45,7 +46,10 @@ SCHEMA = {
 }
 
 
-protocoles = Resource('protocoles', __name__, schema=SCHEMA)
+protocoles = Resource('protocoles', __name__, schema=SCHEMA, indexes=[
+    IndexModel([('titre', TEXT), ('tags', TEXT)],
+               default_language='french', name='protocolesTextIndex')
+])
 
 
 def check_configuration_participation(payload):
@@ -76,8 +80,7 @@ def check_configuration_participation(payload):
 @requires_auth(roles='Observateur')
 def list_protocoles():
     pagination = Paginator()
-    found = protocoles.find(get_lookup_from_q(), skip=pagination.skip,
-                            limit=pagination.max_results)
+    found = pagination.find(protocoles, get_lookup_from_q())
     return pagination.make_response(*found)
 
 
@@ -86,8 +89,7 @@ def list_protocoles():
 def list_user_protocoles():
     pagination = Paginator()
     joined_ids = [p['protocole'] for p in g.request_user.get('protocoles', [])]
-    found = protocoles.find({'_id': {'$in': joined_ids}},
-                            skip=pagination.skip, limit=pagination.max_results)
+    found = pagination.find(protocoles, {'_id': {'$in': joined_ids}})
     return pagination.make_response(*found)
 
 
@@ -115,7 +117,8 @@ def create_protocole():
 @protocoles.route('/protocoles/<objectid:protocole_id>', methods=['GET'])
 @requires_auth(roles='Observateur')
 def display_protocole(protocole_id):
-    return protocoles.find_one({'_id': protocole_id})
+    return protocoles.find_one({'_id': protocole_id}, check_etag=True,
+                               **get_selection_params())
 
 
 @protocoles.route('/protocoles/<objectid:protocole_id>', methods=['PATCH'])
@@ -141,9 +144,7 @@ def list_protocole_users(protocole_id):
         lookup['protocoles.valide'] = True
     elif val_type != 'TOUS':
         abort(422, {'type': 'bad param type'})
-    found = utilisateurs_resource.find(lookup or None,
-                                       skip=pagination.skip,
-                                       limit=pagination.max_results)
+    found = pagination.find(utilisateurs_resource, lookup or None)
     return pagination.make_response(*found)
 
 
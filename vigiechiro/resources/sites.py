@@ -8,19 +8,21 @@
 from flask import current_app, abort, jsonify, g, request
 from datetime import datetime
 from bson import ObjectId
+from pymongo import IndexModel, TEXT
 import logging
 
 from ..xin import Resource
 from ..xin.tools import jsonify, abort, parse_id
 from ..xin.auth import requires_auth
 from ..xin.schema import relation, choice
-from ..xin.snippets import Paginator, get_payload, get_resource, get_url_params
+from ..xin.snippets import (Paginator, get_payload, get_resource, get_url_params,
+                            get_selection_params)
 
 from .actualites import create_actuality_nouveau_site, create_actuality_verrouille_site
 from .protocoles import check_configuration_participation
 from .grille_stoc import grille_stoc
 from .utilisateurs import ensure_protocole_joined_and_validated
-from ..scripts import clean_deleted_site
+from .. import scripts
 
 
 STOC_SCHEMA = {
@@ -86,7 +88,11 @@ SCHEMA = {
 }
 
 
-sites = Resource('sites', __name__, schema=SCHEMA)
+sites = Resource('sites', __name__, schema=SCHEMA, indexes=[
+    IndexModel([('titre', TEXT)], default_language='french', name='sitesTextIndex'),
+    IndexModel([('titre', 1), ('_id', 1)]),
+    IndexModel([('protocole', 1)])
+])
 
 
 @sites.validator.attribute
@@ -117,7 +123,12 @@ def _sites_generic_list(params):
                              'observateur': {'type': ObjectId},
                              'grille_stoc': {'type': ObjectId},
                              'max_results': {'type': int},
-                             'page': {'type': int}},
+                             'page': {'type': int},
+                             'cursor': {'type': str},
+                             'total': {'type': str},
+                             'stream': {'type': str},
+                             'fields': {'type': str},
+                             'expand': {'type': str}},
                             args=params)
     lookup = {}
     if 'q' in params:
@@ -126,8 +137,7 @@ def _sites_generic_list(params):
         if field in params:
             lookup[field] = params[field]
     pagination = Paginator(args=params)
-    found = sites.find(lookup or None, sort=[('titre', 1)], skip=pagination.skip,
-                       limit=pagination.max_results)
+    found = pagination.find(sites, lookup or None, sort=[('titre', 1)])
     return pagination.make_response(*found)
 
 
@@ -162,7 +172,7 @@ def list_protocole_sites_grille_stoc(protocole_id):
         {'protocole': protocole_id}, {'grille_stoc': 1},
         skip=pagination.skip, limit=pagination.max_results)
     # Fetch all grilles stoc in one query to improve perfs
-    total = protocoles.count(with_limit_and_skip=False)
+    total = pagination.count(sites, {'protocole': protocole_id})
     protocoles = list(protocoles)
     grille_ids = [x['grille_stoc'] for x in protocoles]
     grilles_per_id = {x['_id']: x for x in grille_stoc.find({'_id': {'$in': grille_ids}})[0]}
@@ -176,8 +186,7 @@ def list_protocole_sites_grille_stoc(protocole_id):
 def list_protocole_sites_tracet(protocole_id):
     """Return a list of sites with tracet for a protocol"""
     pagination = Paginator(max_results_limit=2000)
-    found = sites.find({"protocole": protocole_id}, {"tracet": 1},
-                       skip=pagination.skip, limit=pagination.max_results)
+    found = pagination.find(sites, {"protocole": protocole_id}, {"tracet": 1})
     return pagination.make_response(*found)
 
 
@@ -236,7 +245,7 @@ def create_site():
 @sites.route('/sites/<objectid:site_id>', methods=['GET'])
 @requires_auth(roles='Observateur')
 def display_site(site_id):
-    return sites.find_one({'_id': site_id})
+    return sites.find_one({'_id': site_id}, check_etag=True, **get_selection_params())
 
 
 @sites.route('/sites/<objectid:site_id>', methods=['DELETE'])
@@ -244,7 +253,7 @@ def display_site(site_id):
 def delete_site(site_id):
     res = sites.remove({'_id': site_id})
     if res.deleted_count:
-        clean_deleted_site.delay(site_id)
+        scripts.clean_deleted_site.delay(site_id)
         return {}, 204
     else:
         abort(404)
@@ -5,11 +5,14 @@
     see: https://scille.atlassian.net/wiki/pages/viewpage.action?pageId=13893670
 """
 
+from pymongo import IndexModel, TEXT
+
 from ..xin import Resource
 from ..xin.tools import jsonify, abort, dict_projection
 from ..xin.auth import requires_auth
 from ..xin.schema import relation
-from ..xin.snippets import Paginator, get_payload, get_if_match, get_lookup_from_q
+from ..xin.snippets import (Paginator, get_payload, get_if_match, get_lookup_from_q,
+                            get_selection_params)
 
 
 SCHEMA = {
@@ -37,7 +40,11 @@ SCHEMA = {
 }
 
 
-taxons = Resource('taxons', __name__, schema=SCHEMA)
+taxons = Resource('taxons', __name__, schema=SCHEMA, indexes=[
+    IndexModel([('libelle_long', TEXT), ('libelle_court', TEXT), ('tags', TEXT)],
+               default_language='french', name='taxonsTextIndex'),
+    IndexModel([('libelle_long', 1), ('_id', 1)])
+])
 
 
 @taxons.validator.attribute
@@ -82,8 +89,7 @@ def expend_parents_libelles(document):
 @requires_auth(roles='Observateur')
 def list_taxons():
     pagination = Paginator()
-    found = taxons.find(get_lookup_from_q(), skip=pagination.skip,
-                        limit=pagination.max_results, sort=[('libelle_long', 1)])
+    found = pagination.find(taxons, get_lookup_from_q(), sort=[('libelle_long', 1)])
     return pagination.make_response(*found)
 
 
@@ -98,7 +104,7 @@ def create_taxon():
 @taxons.route('/taxons/<objectid:taxon_id>', methods=['GET'])
 @requires_auth(roles='Observateur')
 def display_taxon(taxon_id):
-    return taxons.find_one({'_id': taxon_id})
+    return taxons.find_one({'_id': taxon_id}, check_etag=True, **get_selection_params())
 
 
 @taxons.route('/taxons/<objectid:taxon_id>', methods=['PATCH'])
@@ -8,12 +8,14 @@
 from flask import current_app, request, g, abort
 from bson import ObjectId
 from bson.errors import InvalidId
+from pymongo import IndexModel, TEXT
 
 from ..xin import Resource
 from ..xin.tools import jsonify, dict_projection
 from ..xin.auth import requires_auth
 from ..xin.schema import relation, choice
-from ..xin.snippets import Paginator, get_resource, get_payload, get_lookup_from_q
+from ..xin.snippets import (Paginator, get_resource, get_payload, get_lookup_from_q,
+                            get_selection_params)
 
 
 SCHEMA = {
@@ -49,6 +51,18 @@ SCHEMA = {
         'hidden': True,
         'keyschema': {'type': 'datetime'}
     },
+    # Hashes of the tokens to look them up by index
+    'tokens_index': {
+        'type': 'list',
+        'hidden': True,
+        'schema': {
+            'type': 'dict',
+            'schema': {
+                'hash': {'type': 'string', 'required': True},
+                'expire': {'type': 'datetime', 'required': True}
+            }
+        }
+    },
     'protocoles': {
         'type': 'list',
         'schema': {
@@ -68,7 +82,17 @@ SCHEMA = {
 }
 
 
-utilisateurs = Resource('utilisateurs', __name__, schema=SCHEMA)
+utilisateurs = Resource('utilisateurs', __name__, schema=SCHEMA, indexes=[
+    IndexModel([('email', TEXT), ('pseudo', TEXT), ('nom', TEXT),
+                ('prenom', TEXT), ('organisation', TEXT), ('tag', TEXT)],
+               default_language='french', name='utilisateursTextIndex'),
+    IndexModel([('pseudo', 1), ('_id', 1)]),
+    # Observateurs of a protocole
+    IndexModel([('protocoles.protocole', 1)]),
+    # Authentication and expired tokens sweeping
+    IndexModel([('tokens_index.hash', 1)]),
+    IndexModel([('tokens_index.expire', 1)])
+])
 
 
 def get_payload_add_following(ids):
@@ -129,11 +153,9 @@ def non_macro_protocole(context):
 @requires_auth(roles='Observateur')
 def list_users():
     pagination = Paginator()
-    found = utilisateurs.find(get_lookup_from_q(),
-                               skip=pagination.skip,
-                               limit=pagination.max_results,
-                               additional_context=_hide_email(),
-                               sort=[('pseudo', 1)])
+    found = pagination.find(utilisateurs, get_lookup_from_q(),
+                            additional_context=_hide_email(),
+                            sort=[('pseudo', 1)])
     return pagination.make_response(*found)
 
 
@@ -141,13 +163,15 @@ def list_users():
 @requires_auth(roles='Observateur')
 def get_request_user_profile():
     return utilisateurs.find_one(g.request_user['_id'],
-                                 additional_context=_hide_email(False))
+                                 additional_context=_hide_email(False),
+                                 check_etag=True, **get_selection_params())
 
 
 @utilisateurs.route('/utilisateurs/<objectid:user_id>', methods=['GET'])
 @requires_auth(roles='Observateur')
 def get_user_profile(user_id):
-    return utilisateurs.find_one(user_id, additional_context=_hide_email())
+    return utilisateurs.find_one(user_id, additional_context=_hide_email(),
+                                 check_etag=True, **get_selection_params())
 
 
 def _utilisateur_patch(user, additional_context=None):
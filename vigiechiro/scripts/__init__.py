@@ -1,4 +1,21 @@
+from importlib import import_module
+
 from .queuer import queuer, task
-from .task_participation import participation_generate_bilan, process_participation
-from .task_deleter import clean_deleted_participation, clean_deleted_site
-from .task_observations_csv import email_observations_csv, participation_generate_observations_csv
+
+
+# Tasks are lazily imported given they require the whole application
+# (this also allows the resources to use them without circular imports)
+TASKS = {
+    'participation_generate_bilan': '.task_participation',
+    'process_participation': '.task_participation',
+    'clean_deleted_participation': '.task_deleter',
+    'clean_deleted_site': '.task_deleter',
+    'email_observations_csv': '.task_observations_csv',
+    'participation_generate_observations_csv': '.task_observations_csv',
+}
+
+
+def __getattr__(name):
+    if name not in TASKS:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    return getattr(import_module(TASKS[name], __name__), name)
@@ -2,10 +2,56 @@
 
 import logging
 logger = logging.getLogger(__name__)
-from flask import current_app
-from pymongo import ASCENDING
-from datetime import datetime
+from pymongo import ASCENDING, MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from bson import json_util
+from datetime import datetime, timedelta
 from traceback import format_exc
+from importlib import import_module
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from ..settings import (MONGO_HOST, QUEUER_LEASE_DURATION, QUEUER_HEARTBEAT_INTERVAL,
+                        QUEUER_DEFER_DELAY)
+
+
+# Modules defining the tasks, imported only when needed given they
+# require the whole application (resources, schemas etc.) to be loaded
+TASKS_MODULES = (
+    'vigiechiro.scripts.task_participation',
+    'vigiechiro.scripts.task_deleter',
+    'vigiechiro.scripts.task_observations_csv'
+)
+
+
+DEFAULT_LANE = 'default'
+STATS_WINDOWS = (('1h', timedelta(hours=1)),
+                 ('24h', timedelta(days=1)),
+                 ('7d', timedelta(days=7)))
+STATS_PERCENTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+
+
+def _percentiles_projection(field):
+    """Pick the percentiles from a sorted array of durations (in ms)"""
+    size = {'$size': '$' + field}
+    projection = {'count': size}
+    for label, ratio in STATS_PERCENTILES:
+        projection[label] = {'$cond': [
+            {'$eq': [size, 0]}, None,
+            {'$divide': [{'$arrayElemAt': ['$' + field, {'$floor': {
+                '$multiply': [ratio, {'$subtract': [size, 1]}]}}]}, 1000]}
+        ]}
+    return projection
+
+
+# Jobs reserved before leases were introduced are considered lost after
+# this delay (slurm kills the workers after 2 days anyway)
+LEGACY_RESERVATION_TIMEOUT = timedelta(days=3)
 
 
 class QueuerError(Exception):
@@ -16,37 +62,321 @@ class QueuerBadTaskError(QueuerError):
     pass
 
 
+class QueuerDeferJob(QueuerError):
+    """Raised by a task to put its job back in the queue, to be executed
+    again in `delay` seconds
+    """
+
+    def __init__(self, msg, delay=None):
+        super().__init__(msg)
+        self.delay = delay if delay is not None else QUEUER_DEFER_DELAY
+
+
+class QueuerLockedError(QueuerDeferJob):
+    """Lock already taken, the job is deferred if raised from a task"""
+
+
+_standalone_client = None
+
+
+def get_db():
+    """Return the application's database when inside a Flask application
+    context, otherwise connect directly to `MONGO_HOST` (this way simple
+    queue commands don't have to load the whole application)
+    """
+    flask = sys.modules.get('flask')
+    if flask and flask.has_app_context():
+        return flask.current_app.data.db
+    global _standalone_client
+    if _standalone_client is None:
+        _standalone_client = MongoClient(MONGO_HOST)
+    return _standalone_client.get_default_database()
+
+
+def get_cpu_time():
+    """Return the cpu time (in seconds) used by the current process and
+    its terminated children"""
+    return sum(u.ru_utime + u.ru_stime for u in (resource.getrusage(resource.RUSAGE_SELF),
+                                                 resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+
+def _reset_peak_rss():
+    """Reset the peak memory of the current process to its current
+    memory, return False if not supported (Linux only)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fd:
+            fd.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def _get_peak_rss():
+    """Return the peak memory (in KB) of the current process since the
+    last `_reset_peak_rss`"""
+    with open('/proc/self/status') as fd:
+        for line in fd:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+
+
+_executed_jobs_count = 0
+
+
+def start_memory_usage():
+    """Start measuring the peak memory of a job, see `get_memory_usage`"""
+    global _executed_jobs_count
+    _executed_jobs_count += 1
+    return {
+        'reset': _reset_peak_rss(),
+        'first_job': _executed_jobs_count == 1,
+        # ru_maxrss is in KB on Linux
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    }
+
+
+def get_memory_usage(started):
+    """Return the peak memory (in MB) used by the process and by the
+    children it has terminated since `start_memory_usage`, None if it
+    cannot be told apart from the peak of the previous jobs"""
+    if started['reset']:
+        self_peak = _get_peak_rss()
+    elif started['first_job']:
+        self_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    else:
+        return None
+    # Only the biggest child of the whole process is known, hence
+    # it belongs to the job only if it has grown during the job
+    children_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if children_peak == started['children']:
+        if children_peak > self_peak:
+            return None
+        children_peak = 0
+    return max(self_peak, children_peak) / 1024
+
+
+def get_worker_id():
+    """Identify the current process among all the workers"""
+    worker = '%s:%s' % (socket.gethostname(), os.getpid())
+    slurm_job_id = os.environ.get('SLURM_JOB_ID')
+    if slurm_job_id:
+        worker += ':%s' % slurm_job_id
+    return worker
+
+
+class LeaseHeartbeat(threading.Thread):
+    """Periodically renew a lease (i.e. the `field` expiration date of the
+    document matching `lookup`) until stopped or lost
+    """
+
+    def __init__(self, collection, lookup, field, name):
+        super().__init__(name='heartbeat-%s' % name, daemon=True)
+        self.collection = collection
+        self.lookup = lookup
+        self.field = field
+        self._stop_event = threading.Event()
+
+    def _renew(self, now):
+        return self.collection.update_one(self.lookup, {'$set': {
+            self.field: now + timedelta(seconds=QUEUER_LEASE_DURATION)}})
+
+    def run(self):
+        while not self._stop_event.wait(QUEUER_HEARTBEAT_INTERVAL):
+            try:
+                ret = self._renew(datetime.utcnow())
+            except Exception:
+                logger.exception('Cannot renew lease %s' % self.name)
+                continue
+            if not ret.matched_count:
+                logger.warning('Lease %s has been lost' % self.name)
+                return
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class JobHeartbeat(LeaseHeartbeat):
+    """Periodically renew the lease of a running job"""
+
+    def __init__(self, collection, job_id, worker):
+        super().__init__(collection, {'_id': job_id, 'status': 'RESERVED', 'worker': worker},
+                         'lease_expires_at', job_id)
+
+    def _renew(self, now):
+        return self.collection.update_one(self.lookup, {'$set': {
+            'heartbeat_at': now,
+            'lease_expires_at': now + timedelta(seconds=QUEUER_LEASE_DURATION)}})
+
+
 class Queuer:
-    def __init__(self, collection_name):
+    def __init__(self, collection_name, tasks_modules=()):
         self._collection_name = collection_name
+        self._tasks_modules = tasks_modules
+        self._tasks_loaded = False
         self._collection = None
+        self._archive_collection = None
+        self._stats_collection = None
+        self._locks_collection = None
         self.registered_tasks = {}
+        self.current_job_id = None
 
     def register_task(self, task):
         assert task.name not in self.registered_tasks
         self.registered_tasks[task.name] = task
 
+    def load_tasks(self):
+        """Import the tasks modules to have all the tasks registered"""
+        if self._tasks_loaded:
+            return
+        for module in self._tasks_modules:
+            import_module(module)
+        self._tasks_loaded = True
+
+    def get_task(self, name):
+        if name not in self.registered_tasks:
+            self.load_tasks()
+        return self.registered_tasks.get(name)
+
     @property
     def collection(self):
-        if not self._collection:
-            self._collection = current_app.data.db[self._collection_name]
-        return self._collection    
+        if self._collection is None:
+            self._collection = get_db()[self._collection_name]
+        return self._collection
+
+    @property
+    def archive_collection(self):
+        """Finished jobs, expired after `QUEUER_ARCHIVE_RETENTION_DAYS`"""
+        if self._archive_collection is None:
+            self._archive_collection = get_db()[self._collection_name + '_archive']
+        return self._archive_collection
+
+    @property
+    def stats_collection(self):
+        """Per task summary counters of the finished jobs"""
+        if self._stats_collection is None:
+            self._stats_collection = get_db()[self._collection_name + '_stats']
+        return self._stats_collection
+
+    @property
+    def locks_collection(self):
+        """Leases on resources shared between the jobs (see `lock`)"""
+        if self._locks_collection is None:
+            self._locks_collection = get_db()[self._collection_name + '_locks']
+        return self._locks_collection
+
+    def acquire_lock(self, key, owner):
+        """Take the lock `key` for `QUEUER_LEASE_DURATION` seconds unless
+        it is already held by another owner, returns True on success
+        """
+        now = datetime.utcnow()
+        try:
+            # The upsert fails on the `_id` unicity if the lock is held
+            self.locks_collection.update_one(
+                {'_id': key, '$or': [{'owner': owner}, {'expires_at': {'$lt': now}}]},
+                {'$set': {'owner': owner, 'acquired_at': now,
+                          'expires_at': now + timedelta(seconds=QUEUER_LEASE_DURATION)}},
+                upsert=True)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def release_lock(self, key, owner):
+        self.locks_collection.delete_one({'_id': key, 'owner': owner})
+
+    @contextmanager
+    def lock(self, key):
+        """Hold the lock `key` during the block, raises `QueuerLockedError`
+        if it is already taken.
+
+        The lock is a lease renewed by a heartbeat, so it is released
+        after `QUEUER_LEASE_DURATION` if the worker is lost.
+        """
+        owner = '%s:%s' % (get_worker_id(), self.current_job_id)
+        if not self.acquire_lock(key, owner):
+            raise QueuerLockedError('Lock %s is already taken' % key)
+        heartbeat = LeaseHeartbeat(self.locks_collection, {'_id': key, 'owner': owner},
+                                   'expires_at', key)
+        heartbeat.start()
+        try:
+            yield
+        finally:
+            heartbeat.stop()
+            self.release_lock(key, owner)
+
+    def _build_estimate(self, task, args, kwargs):
+        """Describe the job's inputs to be able to predict its needs"""
+        estimator = self.registered_tasks[task].inputs_estimator
+        if not estimator:
+            return {'inputs': {}}
+        try:
+            return {'inputs': estimator(*args, **kwargs)}
+        except Exception:
+            logger.exception('Cannot estimate inputs of task %s' % task)
+            return {'inputs': {}}
 
     def submit_job(self, task, *args, **kwargs):
         assert task in self.registered_tasks
         res = self.collection.insert_one({'name': task, 'args': args, 'kwargs': kwargs,
+                                          'lane': self.registered_tasks[task].lane,
+                                          'estimate': self._build_estimate(task, args, kwargs),
                                           'submitted': datetime.utcnow(), 'status': 'READY'})
         return res.inserted_id
 
-    def get_pending_jobs_count(self):
-        return self.collection.count_documents({'status': 'READY'})
+    def submit_singleton_job(self, task, args, kwargs, debounce=0):
+        """Submit a job unless an identical one is already waiting, in which
+        case the submission is merged into it.
+
+        Atomicity is guaranteed by the unique partial index on `coalesce_key`
+        (see `bin/init_db.py`). If `debounce` (in seconds) is provided, the
+        job won't be executed before no new submission has been merged for
+        this amount of time.
+        """
+        assert task in self.registered_tasks
+        now = datetime.utcnow()
+        coalesce_key = build_coalesce_key(task, args, kwargs)
+        update = {
+            '$setOnInsert': {'name': task, 'args': args, 'kwargs': kwargs,
+                             'lane': self.registered_tasks[task].lane,
+                             'estimate': self._build_estimate(task, args, kwargs),
+                             'submitted': now},
+            '$inc': {'submissions_count': 1}
+        }
+        if debounce:
+            update['$set'] = {'not_before': now + timedelta(seconds=debounce)}
+        while True:
+            try:
+                job = self.collection.find_one_and_update(
+                    {'coalesce_key': coalesce_key, 'status': 'READY'}, update,
+                    projection={'_id': True}, upsert=True,
+                    return_document=ReturnDocument.AFTER)
+                return job['_id']
+            except DuplicateKeyError:
+                # Concurrent submission has created the job first, retry
+                # to merge into it
+                continue
+
+    def _pending_jobs_lookup(self, lanes=None):
+        # Debounced jobs are not pending until their delay is over
+        lookup = {'status': 'READY', 'not_before': {'$not': {'$gt': datetime.utcnow()}}}
+        if lanes:
+            lanes = list(lanes)
+            if DEFAULT_LANE in lanes:
+                # Jobs submitted before lanes existed
+                lanes.append(None)
+            lookup['lane'] = {'$in': lanes}
+        return lookup
 
-    def get_pending_jobs(self):
-        return self.collection.find({'status': 'READY'}).sort([('submitted', ASCENDING)])
+    def get_pending_jobs_count(self, lanes=None):
+        return self.collection.count_documents(self._pending_jobs_lookup(lanes))
 
-    def execute_next_job(self):
+    def get_pending_jobs(self, lanes=None):
+        return self.collection.find(self._pending_jobs_lookup(lanes)).sort([('submitted', ASCENDING)])
+
+    def execute_next_job(self, lanes=None):
+        """Execute the oldest pending job, optionally restricted to some lanes"""
         while True:
-            next_job = list(self.get_pending_jobs()[:1])
+            next_job = list(self.get_pending_jobs(lanes)[:1])
             if not next_job:
                 raise QueuerError('No task to execute')
             else:
@@ -57,41 +387,312 @@ class Queuer:
                     # Task has been taken by somebody else
                     continue
 
+    def get_inflight_jobs_count(self):
+        return self.collection.count_documents(
+            {'status': 'RESERVED', 'lease_expires_at': {'$gte': datetime.utcnow()}})
+
     def execute_job(self, job_id):
         # First try to reserve the task
+        worker = get_worker_id()
+        now = datetime.utcnow()
         ret = self.collection.update_one({'_id': job_id, 'status': 'READY'},
-            {'$set': {'status': 'RESERVED', 'reserved_at': datetime.utcnow()}})
-        if ret.matched_count != 1:
-            raise RuntimeError('Error trying to reserve the task %s: %s' % (job_id, ret))
-        elif ret.modified_count == 0:
+            {'$set': {'status': 'RESERVED', 'reserved_at': now, 'worker': worker,
+                      'lease_expires_at': now + timedelta(seconds=QUEUER_LEASE_DURATION)},
+             '$inc': {'attempts': 1}})
+        if ret.matched_count == 0 or ret.modified_count == 0:
             raise QueuerBadTaskError("Task %s doesn't exist or already taken" % job_id)
         job = self.collection.find_one({'_id': job_id})
-        assert job['name'] in self.registered_tasks
-        task = self.registered_tasks[job['name']]
+        task = self.get_task(job['name'])
+        assert task, 'Unknown task %s' % job['name']
         logger.info('Executing job %s' % job)
+        heartbeat = JobHeartbeat(self.collection, job_id, worker)
+        heartbeat.start()
+        self.current_job_id = job_id
+        cpu_time_start = get_cpu_time()
+        memory_usage = start_memory_usage()
+        deferred = None
         try:
             ret = task(*job['args'], **job['kwargs'])
+        except QueuerDeferJob as exc:
+            deferred = exc
         except:
             print('Error executing job %s:\n%s' % (job_id, format_exc()))
-            self.collection.update_one(
-                {'_id': job_id},
-                {'$set': {'status': 'ERROR', 'errored_at': datetime.utcnow(), 'error': format_exc()}}
-            )
+            update = {'status': 'ERROR', 'errored_at': datetime.utcnow(), 'error': format_exc()}
         else:
-            self.collection.update_one(
-                {'_id': job_id},
-                {'$set': {'status': 'DONE', 'done_at': datetime.utcnow()}}
-            )
+            update = {'status': 'DONE', 'done_at': datetime.utcnow()}
+        finally:
+            heartbeat.stop()
+            self.current_job_id = None
+        if deferred:
+            logger.info('Job %s deferred for %ss: %s' % (job_id, deferred.delay, deferred))
+            self._defer_job(job, worker, deferred.delay)
+            return None
+        update['metrics.cpu_time'] = get_cpu_time() - cpu_time_start
+        # Named after `max_rss_mb` which was the peak of the whole worker process
+        job_max_rss = get_memory_usage(memory_usage)
+        if job_max_rss is not None:
+            update['metrics.job_max_rss_mb'] = job_max_rss
+        # Only the lease owner is allowed to close the job
+        if not self._close_job({'_id': job_id, 'status': 'RESERVED', 'worker': worker}, update):
+            logger.warning('Job %s lease has been lost, cannot mark it as %s' %
+                           (job_id, update['status']))
         return ret
 
+    def _defer_job(self, job, worker, delay):
+        """Put back a running job in the queue, without counting an attempt"""
+        lookup = {'_id': job['_id'], 'status': 'RESERVED', 'worker': worker}
+        now = datetime.utcnow()
+        try:
+            self.collection.update_one(lookup, {
+                '$set': {'status': 'READY', 'deferred_at': now,
+                         'not_before': now + timedelta(seconds=delay)},
+                '$unset': {'worker': True, 'lease_expires_at': True},
+                '$inc': {'attempts': -1, 'deferrals_count': 1}
+            })
+        except DuplicateKeyError:
+            # A similar singleton job is already waiting, merge into it
+            self._merge_into_waiting_job(job, lookup)
+
+    def _merge_into_waiting_job(self, job, lookup):
+        """Replace the job by the similar singleton job waiting in the queue,
+        return False if the job no longer matches the lookup"""
+        if not self.collection.delete_one(lookup).deleted_count:
+            return False
+        self.collection.update_one(
+            {'coalesce_key': job['coalesce_key'], 'status': 'READY'},
+            {'$inc': {'submissions_count': job.get('submissions_count', 1)}})
+        return True
+
+    def _close_job(self, lookup, update):
+        """Mark the job as finished and move it to the archive"""
+        update['finished_at'] = update.get('done_at') or update.get('errored_at')
+        job = self.collection.find_one_and_update(
+            lookup, {'$set': update, '$unset': {'lease_expires_at': True}},
+            return_document=ReturnDocument.AFTER)
+        if job:
+            self._archive_job(job)
+        return job
+
+    def _archive_job(self, job):
+        try:
+            self.archive_collection.insert_one(job)
+        except DuplicateKeyError:
+            # Already archived, don't count it twice
+            pass
+        else:
+            counters = {job['status']: 1}
+            if job.get('reserved_at'):
+                counters['run_time_total'] = (job['finished_at'] - job['reserved_at']).total_seconds()
+            self.stats_collection.update_one(
+                {'_id': job['name']},
+                {'$inc': counters, '$max': {'last_finished_at': job['finished_at']}},
+                upsert=True)
+        self.collection.delete_one({'_id': job['_id']})
+
+    def archive_finished_jobs(self):
+        """Move to the archive the finished jobs left in the queue
+        (e.g. jobs finished before the archive existed)
+        """
+        count = 0
+        for job in self.collection.find({'status': {'$in': ['DONE', 'ERROR']}}):
+            if not job.get('finished_at'):
+                job['finished_at'] = job.get('done_at') or job.get('errored_at') or datetime.utcnow()
+            self._archive_job(job)
+            count += 1
+        return count
+
+    def get_summary_counters(self):
+        """Return per task the number of DONE and ERROR jobs since ever"""
+        counters = {}
+        for item in self.stats_collection.find():
+            counters[item.pop('_id')] = item
+        return counters
+
+    def run_worker(self, lanes=None, should_stop=lambda: False, idle_wait=10):
+        """Execute jobs one after another until `should_stop` returns True
+
+        If provided, `lanes` are consumed by order of priority.
+        """
+        lookups = [[lane] for lane in lanes] if lanes else [None]
+        while not should_stop():
+            for lookup in lookups:
+                try:
+                    self.execute_next_job(lookup)
+                    break
+                except QueuerError:
+                    continue
+            else:
+                # No job available, wait for new ones
+                for _ in range(idle_wait):
+                    if should_stop():
+                        break
+                    time.sleep(1)
+
+    def record_job_metrics(self, **metrics):
+        """Store metrics about the job being executed (if any)"""
+        if not self.current_job_id:
+            return
+        self.collection.update_one(
+            {'_id': self.current_job_id},
+            {'$set': {'metrics.%s' % key: value for key, value in metrics.items()}})
+
+    def get_queue_depth(self):
+        """Return per task the number of waiting and running jobs"""
+        depth = {}
+        for item in self.collection.aggregate([
+                {'$match': {'status': {'$in': ['READY', 'RESERVED']}}},
+                {'$group': {'_id': {'name': '$name', 'status': '$status'},
+                            'count': {'$sum': 1}}}]):
+            task_depth = depth.setdefault(item['_id']['name'], {'READY': 0, 'RESERVED': 0})
+            task_depth[item['_id']['status']] = item['count']
+        return depth
+
+    def get_window_stats(self, since):
+        """Return per task the wait and run time percentiles (in seconds),
+        throughput and error rate of the jobs finished since the given date
+        """
+        hours = (datetime.utcnow() - since).total_seconds() / 3600
+        pipeline = [
+            {'$match': {'finished_at': {'$gte': since}}},
+            {'$facet': {
+                'wait': [
+                    {'$project': {'name': True, 'duration': {
+                        '$subtract': ['$reserved_at', '$submitted']}}},
+                    {'$sort': {'duration': 1}},
+                    {'$group': {'_id': '$name', 'durations': {'$push': '$duration'}}},
+                    {'$project': _percentiles_projection('durations')}
+                ],
+                'run': [
+                    {'$project': {
+                        'name': True,
+                        'errored': {'$cond': [{'$eq': ['$status', 'ERROR']}, 1, 0]},
+                        'duration': {'$subtract': ['$finished_at', '$reserved_at']}}},
+                    {'$sort': {'duration': 1}},
+                    {'$group': {'_id': '$name', 'durations': {'$push': '$duration'},
+                                'errors': {'$sum': '$errored'}}},
+                    {'$project': dict(_percentiles_projection('durations'),
+                                      errors=True)}
+                ]
+            }}
+        ]
+        facets = next(self.archive_collection.aggregate(pipeline))
+        stats = {}
+        for item in facets['wait']:
+            name = item.pop('_id')
+            stats.setdefault(name, {})['wait'] = item
+        for item in facets['run']:
+            name = item.pop('_id')
+            errors = item.pop('errors')
+            task_stats = stats.setdefault(name, {})
+            task_stats['run'] = item
+            task_stats['throughput_per_hour'] = item['count'] / hours
+            task_stats['error_rate'] = errors / item['count']
+        return stats
+
+    def get_stats(self):
+        """Return per task the queue depth and the statistics over
+        the `STATS_WINDOWS` sliding windows
+        """
+        now = datetime.utcnow()
+        stats = {name: {'depth': depth, 'windows': {}}
+                 for name, depth in self.get_queue_depth().items()}
+        def get_task_stats(name):
+            return stats.setdefault(name, {'depth': {'READY': 0, 'RESERVED': 0},
+                                           'windows': {}})
 
-queuer = Queuer('queuer_jobs')
+        for label, delta in STATS_WINDOWS:
+            for name, window_stats in self.get_window_stats(now - delta).items():
+                get_task_stats(name)['windows'][label] = window_stats
+        for name, counters in self.get_summary_counters().items():
+            get_task_stats(name)['totals'] = counters
+        return {'date': now, 'tasks': stats}
+
+    def reap_expired_jobs(self):
+        """Recover the jobs whose worker stopped sending heartbeats.
+
+        Expired jobs are put back in the queue if their task allows another
+        attempt (or merged into the similar singleton job already waiting,
+        status MERGED), otherwise they are marked as ERROR.
+        Returns the list of (job id, new status).
+        """
+        now = datetime.utcnow()
+        reaped = []
+        expired_jobs = self.collection.find({'status': 'RESERVED', '$or': [
+            {'lease_expires_at': {'$lt': now}},
+            {'lease_expires_at': {'$exists': False},
+             'reserved_at': {'$lt': now - LEGACY_RESERVATION_TIMEOUT}}
+        ]})
+        for job in expired_jobs:
+            task = self.get_task(job['name'])
+            max_retry = task.max_retry if task else 0
+            requeue = job.get('attempts', 1) - 1 < max_retry
+            # Match on the lease to make sure the job hasn't been renewed meanwhile
+            lookup = {'_id': job['_id'], 'status': 'RESERVED',
+                      'lease_expires_at': job.get('lease_expires_at')}
+            error = 'Lease expired (worker %s)' % job.get('worker')
+            if requeue:
+                status = 'READY'
+                try:
+                    ret = self.collection.update_one(lookup, {
+                        '$set': {'status': 'READY', 'requeued_at': now, 'error': error},
+                        '$unset': {'worker': True, 'lease_expires_at': True}
+                    })
+                except DuplicateKeyError:
+                    # A similar singleton job is already waiting, merge into it
+                    status = 'MERGED'
+                    if not self._merge_into_waiting_job(job, lookup):
+                        continue
+                else:
+                    if not ret.modified_count:
+                        continue
+            else:
+                status = 'ERROR'
+                if not self._close_job(lookup, {'status': 'ERROR', 'errored_at': now,
+                                                'error': error}):
+                    continue
+            logger.warning('Job %s: %s, marked as %s' % (job['_id'], error, status))
+            reaped.append((job['_id'], status))
+            if task and task.lease_expired_callback:
+                try:
+                    task.lease_expired_callback(job, requeue)
+                except Exception:
+                    logger.exception('Error in lease expired callback of job %s' % job['_id'])
+        # Jobs whose worker died between closing and archiving
+        self.archive_finished_jobs()
+        return reaped
+
+
+def build_coalesce_key(task, args, kwargs):
+    """Deterministic key identifying a task called with given arguments"""
+    return '%s:%s' % (task, json_util.dumps([args, kwargs], sort_keys=True))
+
+
+queuer = Queuer('queuer_jobs', tasks_modules=TASKS_MODULES)
 
 
 class Task:
-    def __init__(self, function):
+    def __init__(self, function, debounce=0, max_retry=0, lane=DEFAULT_LANE):
         self.function = function
         self.name = function.__name__
+        self.debounce = debounce
+        self.max_retry = max_retry
+        self.lane = lane
+        self.lease_expired_callback = None
+        self.inputs_estimator = None
+
+    def on_lease_expired(self, callback):
+        """Decorator to register a `callback(job, requeued)` called
+        when a job of this task has been reaped
+        """
+        self.lease_expired_callback = callback
+        return callback
+
+    def estimate_inputs(self, estimator):
+        """Decorator to register an `estimator(*args, **kwargs)` returning
+        the size of the inputs of a job, used to predict its resources needs
+        """
+        self.inputs_estimator = estimator
+        return estimator
 
     def delay(self, *args, **kwargs):
         """Register the function as a job and returns job id
@@ -100,12 +701,11 @@ class Task:
 
     def delay_singleton(self, *args, **kwargs):
         """Register as a job if the function with thoses arguments
-        has is not already is database.
+        is not already waiting in database, otherwise merge with it.
+        Returns job id.
         """
-        if not queuer.collection.find_one(
-                {'name': self.name, 'args': args, 'kwargs': kwargs, 'status': 'READY'},
-                projection={}):
-            return queuer.submit_job(self.name, *args, **kwargs)
+        return queuer.submit_singleton_job(self.name, args, kwargs,
+                                           debounce=self.debounce)
 
     def __call__(self, *args, **kwargs):
         """Call the function synchronously
@@ -113,9 +713,20 @@ class Task:
         return self.function(*args, **kwargs)
 
 
-def task(f):
+def task(f=None, debounce=0, max_retry=0, lane=DEFAULT_LANE):
     """Decorator to allow a function to be queued as job
+
+    Can be used as `@task` or `@task(debounce=<seconds>, max_retry=<count>,
+    lane=<name>)`, `debounce` delaying singleton jobs until submissions
+    settle down, `max_retry` allowing a job to be requeued when its worker
+    is lost and `lane` allowing workers to cap the concurrency of a family
+    of jobs.
     """
-    t = Task(f)
-    queuer.register_task(t)
-    return t
+    def decorator(f):
+        t = Task(f, debounce=debounce, max_retry=max_retry, lane=lane)
+        queuer.register_task(t)
+        return t
+
+    if f is None:
+        return decorator
+    return decorator(f)
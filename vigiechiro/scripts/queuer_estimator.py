@@ -0,0 +1,133 @@
+# Predict the resources needed by the pending jobs to size the slurm allocations
+
+import math
+from datetime import datetime
+
+
+# Allocation used when there is not enough history to predict anything
+# (i.e. the historical `check_queue.sh` worker options)
+DEFAULT_TIME = 2 * 24 * 3600
+DEFAULT_MEM_MB = 32 * 1024
+DEFAULT_CPUS = 1
+MAX_TIME = 2 * 24 * 3600
+MAX_MEM_MB = 32 * 1024
+MAX_CPUS = 8
+MIN_TIME = 30 * 60
+MIN_MEM_MB = 2 * 1024
+# Predictions are multiplied by those margins to limit the risk of
+# having the job killed by slurm
+TIME_MARGIN = 2
+MEM_MARGIN = 1.5
+# Number of finished jobs used to fit the models
+HISTORY_SIZE = 500
+
+
+def solve_least_squares(rows, targets, ridge=1e-6):
+    """Return the coefficients minimizing `|rows * coefs - targets|`
+
+    Normal equations are solved by Gaussian elimination, the (small)
+    ridge term keeps the system solvable with colinear features.
+    """
+    size = len(rows[0])
+    matrix = [[sum(row[i] * row[j] for row in rows) + (ridge if i == j else 0)
+               for j in range(size)] + [sum(row[i] * t for row, t in zip(rows, targets))]
+              for i in range(size)]
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda r: abs(matrix[r][col]))
+        matrix[col], matrix[pivot] = matrix[pivot], matrix[col]
+        if not matrix[col][col]:
+            continue
+        for r in range(size):
+            if r != col:
+                factor = matrix[r][col] / matrix[col][col]
+                matrix[r] = [a - factor * b for a, b in zip(matrix[r], matrix[col])]
+    return [matrix[i][size] / matrix[i][i] if matrix[i][i] else 0 for i in range(size)]
+
+
+class LinearModel:
+    """Linear regression of a target over the inputs of the jobs"""
+
+    def __init__(self, features, coefs):
+        self.features = features
+        self.coefs = coefs
+
+    @classmethod
+    def fit(cls, samples):
+        """`samples` is a list of (inputs dict, target value)"""
+        features = sorted({key for inputs, _ in samples for key in inputs})
+        rows = [[1] + [inputs.get(f, 0) for f in features] for inputs, _ in samples]
+        coefs = solve_least_squares(rows, [target for _, target in samples])
+        return cls(features, coefs)
+
+    def predict(self, inputs):
+        values = [1] + [inputs.get(f, 0) for f in self.features]
+        return max(sum(c * v for c, v in zip(self.coefs, values)), 0)
+
+
+def fit_task_models(queuer, task_name):
+    """Fit time, memory and cpu models from the last finished jobs of the
+    task, returns None if the history is too small
+    """
+    samples = {'time': [], 'mem': [], 'cpu_time': []}
+    jobs = queuer.archive_collection.find(
+        {'name': task_name, 'status': 'DONE', 'metrics': {'$exists': True}},
+        projection={'estimate': True, 'metrics': True, 'reserved_at': True,
+                    'finished_at': True}
+    ).sort([('finished_at', -1)]).limit(HISTORY_SIZE)
+    for job in jobs:
+        # Use the inputs known at submission time, like for the pending jobs
+        inputs = job.get('estimate', {}).get('inputs') or job['metrics'].get('inputs', {})
+        duration = (job['finished_at'] - job['reserved_at']).total_seconds()
+        samples['time'].append((inputs, duration))
+        # Memory is not known for all the jobs (see `get_memory_usage`)
+        if 'job_max_rss_mb' in job['metrics']:
+            samples['mem'].append((inputs, job['metrics']['job_max_rss_mb']))
+        samples['cpu_time'].append((inputs, job['metrics'].get('cpu_time', 0)))
+    features_count = len({key for inputs, _ in samples['time'] for key in inputs})
+    if len(samples['time']) < features_count + 2:
+        return None
+    # Memory model is left out without enough history, see `recommend_resources`
+    return {target: LinearModel.fit(target_samples)
+            if len(target_samples) >= features_count + 2 else None
+            for target, target_samples in samples.items()}
+
+
+def recommend_resources(models, inputs):
+    """Return the recommended time (in seconds), memory (in MB) and cpus"""
+    if not models:
+        return {'time': DEFAULT_TIME, 'mem': DEFAULT_MEM_MB, 'cpus': DEFAULT_CPUS}
+    duration = models['time'].predict(inputs)
+    cpus = math.ceil(models['cpu_time'].predict(inputs) / duration) if duration else 1
+    return {
+        'time': int(min(max(duration * TIME_MARGIN, MIN_TIME), MAX_TIME)),
+        'mem': int(min(max(models['mem'].predict(inputs) * MEM_MARGIN, MIN_MEM_MB), MAX_MEM_MB))
+               if models['mem'] else DEFAULT_MEM_MB,
+        'cpus': min(max(cpus, 1), MAX_CPUS)
+    }
+
+
+def format_sbatch_options(recommended):
+    days, remain = divmod(recommended['time'], 24 * 3600)
+    hours, remain = divmod(remain, 3600)
+    minutes, seconds = divmod(remain, 60)
+    return '--time=%s-%02d:%02d:%02d --mem=%sMB --cpus-per-task=%s' % (
+        days, hours, minutes, seconds, recommended['mem'], recommended['cpus'])
+
+
+def estimate_pending_jobs(queuer):
+    """Store on each pending job its recommended resources,
+    returns the list of (job, recommended resources)
+    """
+    models_per_task = {}
+    estimated = []
+    for job in queuer.get_pending_jobs():
+        if job['name'] not in models_per_task:
+            models_per_task[job['name']] = fit_task_models(queuer, job['name'])
+        inputs = job.get('estimate', {}).get('inputs', {})
+        recommended = recommend_resources(models_per_task[job['name']], inputs)
+        queuer.collection.update_one({'_id': job['_id']}, {'$set': {
+            'estimate.recommended': recommended,
+            'estimate.date': datetime.utcnow()
+        }})
+        estimated.append((job, recommended))
+    return estimated
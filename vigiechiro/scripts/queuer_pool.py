@@ -0,0 +1,124 @@
+# Local supervisor running several queuer workers, for use outside of slurm
+
+import logging
+logger = logging.getLogger(__name__)
+import signal
+import subprocess
+import time
+
+
+# A worker running for longer than this is considered healthy, hence
+# its restart backoff is reset
+HEALTHY_WORKER_UPTIME = 60
+MAX_RESTART_BACKOFF = 60
+
+
+def build_slots(workers, lanes, lane_caps):
+    """Return for each worker the lanes (by priority) it should consume
+
+    Only the first `cap` workers are allowed to consume a capped lane, which
+    guarantees the cap without any coordination between the workers.
+    """
+    uncapped = [lane for lane in lanes if lane not in lane_caps]
+    slots = []
+    for i in range(workers):
+        capped = [lane for lane, cap in sorted(lane_caps.items()) if i < cap]
+        slot_lanes = capped + uncapped
+        if slot_lanes:
+            slots.append(slot_lanes)
+        else:
+            logger.warning('Worker %s would have no lane to consume, skipping it' % i)
+    return slots
+
+
+class GracefulStop:
+    """Turn SIGTERM/SIGINT into a flag checked between jobs"""
+
+    def __init__(self):
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        logger.info('Received signal %s, stopping after the current job' % signum)
+        self.stopping = True
+
+    def __call__(self):
+        return self.stopping
+
+
+class WorkerPool:
+    """Spawn a process per slot running `worker_cmd + [<lanes>]`, restart
+    the crashed ones and drain them on SIGTERM/SIGINT (a second signal
+    kills them).
+    """
+
+    def __init__(self, worker_cmd, workers, lanes, lane_caps=None):
+        self.worker_cmd = worker_cmd
+        self.slots = build_slots(workers, lanes, lane_caps or {})
+        self.processes = {}
+        self.started_at = {}
+        self.backoffs = {}
+        self.restarts_at = {}
+        self.draining = False
+
+    def _on_signal(self, signum, frame):
+        if self.draining:
+            logger.warning('Received signal %s again, killing workers' % signum)
+            self._send_signal(signal.SIGKILL)
+        else:
+            logger.info('Received signal %s, draining workers' % signum)
+            self.draining = True
+            self._send_signal(signal.SIGTERM)
+
+    def _send_signal(self, signum):
+        for process in self.processes.values():
+            try:
+                process.send_signal(signum)
+            except ProcessLookupError:
+                pass
+
+    def _spawn(self, slot):
+        cmd = self.worker_cmd + [','.join(self.slots[slot])]
+        logger.info('Starting worker %s: %s' % (slot, ' '.join(cmd)))
+        self.processes[slot] = subprocess.Popen(cmd)
+        self.started_at[slot] = time.monotonic()
+
+    def _schedule_restart(self, slot):
+        uptime = time.monotonic() - self.started_at[slot]
+        if uptime > HEALTHY_WORKER_UPTIME:
+            backoff = 1
+        else:
+            backoff = min(self.backoffs.get(slot, 0.5) * 2, MAX_RESTART_BACKOFF)
+        self.backoffs[slot] = backoff
+        self.restarts_at[slot] = time.monotonic() + backoff
+
+    def poll(self):
+        """Check the workers' status, returns False once all are stopped"""
+        for slot, process in list(self.processes.items()):
+            returncode = process.poll()
+            if returncode is None:
+                continue
+            del self.processes[slot]
+            if self.draining:
+                logger.info('Worker %s stopped (code %s)' % (slot, returncode))
+            else:
+                logger.warning('Worker %s exited with code %s, restarting it' %
+                               (slot, returncode))
+                self._schedule_restart(slot)
+        if self.draining:
+            self.restarts_at.clear()
+        now = time.monotonic()
+        for slot, restart_at in list(self.restarts_at.items()):
+            if restart_at <= now:
+                del self.restarts_at[slot]
+                self._spawn(slot)
+        return bool(self.processes or self.restarts_at)
+
+    def run(self, poll_interval=1):
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        for slot in range(len(self.slots)):
+            self._spawn(slot)
+        while self.poll():
+            time.sleep(poll_interval)
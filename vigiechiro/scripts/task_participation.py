@@ -30,6 +30,7 @@ from ..settings import (BACKEND_DOMAIN, SCRIPT_WORKER_TOKEN, TADARIDA_D_OPTS,
                         TASK_PARTICIPATION_EXTRACT_BACKEND,
                         TASK_PARTICIPATION_GENERATE_OBSERVATION_CSV,
                         TASK_PARTICIPATION_SETTLE_DB_SLEEP,
+                        TASK_PARTICIPATION_BILAN_DEBOUNCE,
                         REQUESTS_TIMEOUT,
 )
 from ..resources.fichiers import (fichiers as f_resource,
@@ -39,7 +40,7 @@ from ..resources.fichiers import (fichiers as f_resource,
                                   ALLOWED_MIMES_WAV, ALLOWED_MIMES_ZIPPED,
                                   detect_mime,
                                   delete_fichier_and_s3, get_file_from_s3, _sign_request)
-from .queuer import task
+from .queuer import task, queuer, get_db
 from .task_observations_csv import email_observations_csv, ensure_observations_csv_is_available
 
 
@@ -242,7 +243,7 @@ class Bilan:
         return payload
 
 
-@task
+@task(debounce=TASK_PARTICIPATION_BILAN_DEBOUNCE)
 def participation_generate_bilan(participation_id):
     participation_id = str(participation_id)
     bilan = Bilan()
@@ -347,6 +348,7 @@ def extract_zipped_files_in_participation(participation):
 
         # Now individuly store each file present in the zip
         counts = {}
+        payloads = []
         for root, _, files in os.walk(wdir):
             for file_name in files:
                 file_path = '/'.join((root, file_name))
@@ -356,7 +358,7 @@ def extract_zipped_files_in_participation(participation):
                     logger.warning('Unknown file {} in zip {} ({}), skipping...'.format(
                         file_name, zippj['_id'], pj_titre))
                     continue
-                f_resource.insert({
+                payloads.append({
                     'titre': file_name,
                     'mime': mime,
                     'proprietaire': zippj['proprietaire'],
@@ -365,6 +367,11 @@ def extract_zipped_files_in_participation(participation):
                 })
                 obj = Fichier(participation, titre=file_name, path=file_path, mime=mime)
                 obj.force_populate_datastore()
+        for i in range(0, len(payloads), TASK_PARTICIPATION_BATCH_SIZE):
+            batch = payloads[i:i + TASK_PARTICIPATION_BATCH_SIZE]
+            _, errors = f_resource.insert_many(batch)
+            for index, error in errors.items():
+                logger.error('Cannot create fichier {} : {}'.format(batch[index]['titre'], error))
 
         logger.info('Archive contained: %s' % counts)
 
@@ -377,10 +384,14 @@ def extract_zipped_files_in_participation(participation):
     return wdirs
 
 
-@task
+@task(max_retry=TASK_PARTICIPATION_MAX_RETRY, lane='heavy')
 def process_participation(participation_id, extra_pjs_ids=[], publique=True,
-                          notify_mail=None, notify_msg=None, retry_count=0):
-    from ..resources.participations import participations as p_resource
+                          notify_mail=None, notify_msg=None, retry_count=0,
+                          campagne=None):
+    """`campagne` is the reprocessing campaign the job belongs to (if any),
+    only used to track its progress
+    """
+    from ..resources.participations import participations as p_resource, build_version_key
 
     participation_id = ObjectId(participation_id)
     extra_pjs_ids = [ObjectId(x) for x in extra_pjs_ids]
@@ -388,31 +399,39 @@ def process_participation(participation_id, extra_pjs_ids=[], publique=True,
         'protocole': False, 'messages': False, 'logs': False, 'bilan': False})
     if not p:
         raise RuntimeError(f"Unknown participation `{participation_id}`")
-    traitement = {'etat': 'EN_COURS', 'date_debut': datetime.utcnow()}
-    p_resource.update(participation_id, {'traitement': traitement}, auto_abort=False)
-    try:
-        _process_participation(participation_id, extra_pjs_ids=extra_pjs_ids, publique=publique)
-    except Exception:
-        msg = format_exc()
-        logger.error(msg)
-        if retry_count < TASK_PARTICIPATION_MAX_RETRY:
-            process_participation.delay(participation_id, extra_pjs_ids, publique,
-                                        notify_mail, notify_msg, retry_count + 1)
-            traitement['etat'] = 'RETRY'
-            traitement['retry'] = retry_count + 1
-            traitement['date_fin'] = datetime.utcnow()
-            traitement['message'] = msg
-            p_resource.update(participation_id, {'traitement': traitement}, auto_abort=False)
+    # Jobs of the same participation must not run in parallel, if the lock
+    # is taken this job is deferred until the running one is over
+    with queuer.lock('participation:%s' % participation_id):
+        traitement = {'etat': 'EN_COURS', 'date_debut': datetime.utcnow()}
+        p_resource.update(participation_id, {'traitement': traitement}, auto_abort=False)
+        try:
+            version_tadarida_c = _process_participation(
+                participation_id, extra_pjs_ids=extra_pjs_ids, publique=publique)
+        except Exception:
+            msg = format_exc()
+            logger.error(msg)
+            if retry_count < TASK_PARTICIPATION_MAX_RETRY:
+                process_participation.delay(participation_id, extra_pjs_ids, publique,
+                                            notify_mail, notify_msg, retry_count + 1,
+                                            campagne=campagne)
+                traitement['etat'] = 'RETRY'
+                traitement['retry'] = retry_count + 1
+                traitement['date_fin'] = datetime.utcnow()
+                traitement['message'] = msg
+                p_resource.update(participation_id, {'traitement': traitement}, auto_abort=False)
+            else:
+                traitement['etat'] = 'ERREUR'
+                traitement['date_fin'] = datetime.utcnow()
+                traitement['message'] = msg
+                p_resource.update(participation_id, {'traitement': traitement}, auto_abort=False)
+                raise
         else:
-            traitement['etat'] = 'ERREUR'
+            traitement['etat'] = 'FINI'
             traitement['date_fin'] = datetime.utcnow()
-            traitement['message'] = msg
+            if version_tadarida_c:
+                traitement['version_tadarida_c'] = version_tadarida_c
+                traitement['version_tadarida_c_cle'] = build_version_key(version_tadarida_c)
             p_resource.update(participation_id, {'traitement': traitement}, auto_abort=False)
-            raise
-    else:
-        traitement['etat'] = 'FINI'
-        traitement['date_fin'] = datetime.utcnow()
-        p_resource.update(participation_id, {'traitement': traitement}, auto_abort=False)
 
     mail_subject = "Votre participation vient d'être traitée !"
     if not notify_msg:
@@ -431,6 +450,55 @@ def process_participation(participation_id, extra_pjs_ids=[], publique=True,
             current_app.mail.send(recipient=notify_mail, subject=mail_subject, body=notify_msg)
 
 
+@process_participation.on_lease_expired
+def _process_participation_lease_expired(job, requeued):
+    from ..resources.participations import participations as p_resource
+
+    participation_id = ObjectId(job['args'][0] if job['args'] else job['kwargs']['participation_id'])
+    traitement = {
+        'etat': 'RETRY' if requeued else 'ERREUR',
+        'date_debut': job['reserved_at'],
+        'date_fin': datetime.utcnow(),
+        'message': 'Worker %s has been lost' % job.get('worker')
+    }
+    if requeued:
+        traitement['retry'] = job.get('attempts', 1)
+    p_resource.update(participation_id, {'traitement': traitement}, auto_abort=False)
+
+
+_FICHIER_TYPES = {}
+for _type, _mimes in (('wav', ALLOWED_MIMES_WAV), ('ta', ALLOWED_MIMES_TA),
+                      ('tc', ALLOWED_MIMES_TC), ('zip', ALLOWED_MIMES_ZIPPED)):
+    _FICHIER_TYPES.update({mime: _type for mime in _mimes})
+
+
+def _count_fichiers_by_type(participation_id, extra_pjs_ids=()):
+    lookup = {'$or': [{'lien_participation': ObjectId(participation_id)},
+                      {'_id': {'$in': [ObjectId(x) for x in extra_pjs_ids]}}]}
+    counts = defaultdict(int)
+    for item in get_db().fichiers.aggregate([
+            {'$match': lookup},
+            {'$group': {'_id': '$mime', 'count': {'$sum': 1}}}]):
+        counts[_FICHIER_TYPES.get(item['_id'], 'autre')] += item['count']
+    return dict(counts)
+
+
+def _get_dirs_size(paths):
+    size = 0
+    for path in paths:
+        for root, _, files in os.walk(path):
+            for name in files:
+                file_path = os.path.join(root, name)
+                if not os.path.islink(file_path):
+                    size += os.path.getsize(file_path)
+    return size
+
+
+@process_participation.estimate_inputs
+def _process_participation_estimate_inputs(participation_id, extra_pjs_ids=[], *args, **kwargs):
+    return _count_fichiers_by_type(participation_id, extra_pjs_ids)
+
+
 def _process_participation(participation_id, extra_pjs_ids=[], publique=True):
     participation_id = str(participation_id)
     wdir = _create_working_dir(('D', 'C'))
@@ -444,13 +512,29 @@ def _process_participation(participation_id, extra_pjs_ids=[], publique=True):
         logger.error(e)
         return
 
-    zipwdirs = extract_zipped_files_in_participation(participation)
+    # Keep track of the time spent in each stage to estimate the next jobs
+    stages = {}
+    last_stage_end = time.monotonic()
+
+    def end_stage(name):
+        nonlocal last_stage_end
+        now = time.monotonic()
+        stages[name] = now - last_stage_end
+        last_stage_end = now
 
+    zipwdirs = extract_zipped_files_in_participation(participation)
+    end_stage('extract')
     participation.reset_pjs_state()
     participation.load_pjs()
+    end_stage('load')
     run_tadaridaD(wdir + '/D', participation)
+    end_stage('tadaridaD')
     run_tadaridaC(wdir + '/C', participation)
+    end_stage('tadaridaC')
     participation.save()
+    end_stage('save')
+    queuer.record_job_metrics(stages=stages, bytes=_get_dirs_size([wdir] + zipwdirs),
+                              inputs=_count_fichiers_by_type(participation_id))
     if not TASK_PARTICIPATION_KEEP_TMP_DIR:
         for zipwdir in zipwdirs:
             logger.info('Cleaning workdir %s' % zipwdir)
@@ -458,6 +542,7 @@ def _process_participation(participation_id, extra_pjs_ids=[], publique=True):
         logger.info('Cleaning workdir %s' % wdir)
         shutil.rmtree(wdir)
     participation_generate_bilan(participation_id)
+    return participation.version_tadarida_c
 
 
 class Fichier:
@@ -619,6 +704,7 @@ class Donnee:
         self.wav = None
         self.tc = None
         self.ta = None
+        self.version_c = None
 
     def insert(self, fichier):
         fichier.donnee = self
@@ -640,6 +726,8 @@ class Donnee:
                 taxons = []
                 obs = {}
                 for head, cell in zip(headers, line):
+                    if head == 'VersionC':
+                        self.version_c = cell
                     if head in ['Group.1', 'Order', 'Ordre', 'OrderNum', 'OrderInit','VersionD',
                                 'VersionC', 'Version', 'FreqP', 'FreqC', 'NbCris', 'DurMed',
                                 'Dur90', 'Ampm50', 'Ampm90', 'AmpSMd', 'DiffME', 'SR', 'Ind',
@@ -672,22 +760,18 @@ class Donnee:
                     self.observations.append(obs)
 
 
-    def save(self, participation_id, proprietaire_id, publique):
-        from ..resources.donnees import donnees as d_resource
-
-        if self.id:
-            return
+    def build_payload(self, participation_id, proprietaire_id, publique):
         self._build_observations()
-        payload = {
+        return {
             'titre': self.basename,
             'participation': participation_id,
             'proprietaire': proprietaire_id,
             'publique': publique,
             'observations': self.observations
         }
-        inserted = d_resource.insert(payload)
-        self.id = inserted['_id']
-        logger.debug('Creating donnee {} ({})'.format(self.id, self.basename))
+
+    def save_fichiers(self, participation_id, proprietaire_id):
+        """Save the fichiers once the donnee is inserted"""
         for fichier in (self.wav, self.tc, self.ta):
             if not fichier:
                 continue
@@ -805,13 +889,29 @@ class Participation:
                 yield d.wav
 
     def save(self):
-        from ..resources.participations import participations as p_resource
+        from ..resources.participations import participations as p_resource, build_version_key
+        from ..resources.donnees import donnees as d_resource
 
-        def save_donnee(d):
-            d.save(self.participation['_id'],
-                   self.participation['observateur'],
-                   self.publique)
-        parallel_executor(save_donnee, self.donnees.values())
+        participation_id = self.participation['_id']
+        proprietaire_id = self.participation['observateur']
+        to_insert = [d for d in self.donnees.values() if not d.id]
+        for i in range(0, len(to_insert), TASK_PARTICIPATION_BATCH_SIZE):
+            batch = to_insert[i:i + TASK_PARTICIPATION_BATCH_SIZE]
+            payloads = [d.build_payload(participation_id, proprietaire_id, self.publique)
+                        for d in batch]
+            _, errors = d_resource.insert_many(payloads)
+            for index, (d, payload) in enumerate(zip(batch, payloads)):
+                if index in errors:
+                    logger.error('Cannot create donnee {} : {}'.format(d.basename, errors[index]))
+                else:
+                    d.id = payload['_id']
+                    logger.debug('Creating donnee {} ({})'.format(d.id, d.basename))
+
+        def save_fichiers(d):
+            d.save_fichiers(participation_id, proprietaire_id)
+        parallel_executor(save_fichiers, [d for d in to_insert if d.id])
+        versions = {d.version_c for d in self.donnees.values() if d.version_c}
+        self.version_tadarida_c = max(versions, key=build_version_key) if versions else None
         logger.debug('Saving %s logs items in participation' % len(logger.LOGS))
         titre = 'participation-%s-logs' % (self.participation['_id'])
         new_logs = _create_fichier(titre, 'text/plain',
@@ -6,7 +6,6 @@
 """
 
 from os import environ
-from authomatic.providers import oauth2
 
 
 # RFC 1123 (ex RFC 822)
@@ -49,21 +48,33 @@ REQUESTS_TIMEOUT = int(environ.get('REQUESTS_TIMEOUT', 90))
 ### MongoDB ###
 MONGO_HOST = MONGO_URI = environ.get('MONGO_HOST', 'mongodb://localhost:27017/vigiechiro')
 
+### Queuer ###
+# into seconds, a running job is considered lost if no heartbeat is
+# received during the lease duration
+QUEUER_LEASE_DURATION = int(environ.get('QUEUER_LEASE_DURATION', 10 * 60))
+QUEUER_HEARTBEAT_INTERVAL = int(environ.get('QUEUER_HEARTBEAT_INTERVAL', 60))
+assert QUEUER_HEARTBEAT_INTERVAL < QUEUER_LEASE_DURATION
+# Delay before retrying a job deferred because its resource is locked
+QUEUER_DEFER_DELAY = int(environ.get('QUEUER_DEFER_DELAY', 5 * 60))
+# Finished jobs are kept in the archive for this number of days
+QUEUER_ARCHIVE_RETENTION_DAYS = int(environ.get('QUEUER_ARCHIVE_RETENTION_DAYS', 30))
+
 ### CORS ###
 X_DOMAINS = environ.get('CORS_ORIGIN', FRONTEND_DOMAIN)
 X_HEADERS = ['Accept', 'Content-type', 'Authorization', 'If-Match', 'If-None-Match', 'Cache-Control']
-X_EXPOSE_HEADERS = X_HEADERS
+X_EXPOSE_HEADERS = ['ETag']
 
 ### Authomatic ###
 AUTHOMATIC = {
     'google': {
-        'class_': oauth2.Google,
+        # Providers given by path to avoid loading authomatic with the settings
+        'class_': 'authomatic.providers.oauth2.Google',
         'consumer_key': environ.get('GOOGLE_API_KEY', ''),
         'consumer_secret': environ.get('GOOGLE_API_SECRET', ''),
-        'scope': oauth2.Google.user_info_scope
+        # No scope: the provider's `user_info_scope` is used (see xin.auth)
     },
     'facebook': {
-        'class_': oauth2.Facebook,
+        'class_': 'authomatic.providers.oauth2.Facebook',
         'consumer_key': environ.get('FACEBOOK_API_KEY', ''),
         'consumer_secret': environ.get('FACEBOOK_API_SECRET', ''),
         # 'scope': oauth2.Facebook.user_info_scope
@@ -76,6 +87,40 @@ AWS_S3_BUCKET = environ.get('AWS_S3_BUCKET', '')
 AWS_ACCESS_KEY_ID = environ.get('AWS_ACCESS_KEY_ID', '')
 AWS_SECRET_ACCESS_KEY = environ.get('AWS_SECRET_ACCESS_KEY', '')
 
+### Resources cache ###
+# Rarely modified resources cached by each process (comma separated)
+RESOURCES_CACHE = [r for r in environ.get(
+    'RESOURCES_CACHE', 'taxons,protocoles,grille_stoc,utilisateurs').split(',') if r]
+RESOURCES_CACHE_SIZE = int(environ.get('RESOURCES_CACHE_SIZE', 10000))
+RESOURCES_CACHE_TTL = int(environ.get('RESOURCES_CACHE_TTL', 600))
+# Delay (in seconds) between the checks of modifications done by other processes
+RESOURCES_CACHE_CHECK_INTERVAL = int(environ.get('RESOURCES_CACHE_CHECK_INTERVAL', 5))
+# Lifetime (in seconds) of the list requests' totals, 0 to disable
+COUNT_CACHE_TTL = int(environ.get('COUNT_CACHE_TTL', 30))
+COUNT_CACHE_SIZE = int(environ.get('COUNT_CACHE_SIZE', 1000))
+
+### Authentication ###
+# Lifetime (in seconds) of the token to utilisateur cache of each process, 0 to disable
+# (modifications of the utilisateurs are detected every RESOURCES_CACHE_CHECK_INTERVAL)
+AUTH_CACHE_TTL = int(environ.get('AUTH_CACHE_TTL', 300))
+AUTH_CACHE_SIZE = int(environ.get('AUTH_CACHE_SIZE', 10000))
+
+### JSON ###
+# Force the JSON serialization backend (`stdlib` or `orjson`), by default
+# orjson is used if installed
+JSON_BACKEND = environ.get('JSON_BACKEND')
+
+### Debug ###
+# Provide the number of mongodb queries of each request in a header
+DEBUG_QUERIES_COUNT = environ.get('DEBUG_QUERIES_COUNT', 'false').lower() == 'true'
+# Time the mongodb queries of each request, provided in a `Server-Timing`
+# header and logged with the slowest queries' shape
+DEBUG_QUERIES_PROFILER = environ.get('DEBUG_QUERIES_PROFILER', 'false').lower() == 'true'
+# Requests longer than this (in ms) are logged as warnings by the profiler
+SLOW_REQUEST_THRESHOLD = float(environ.get('SLOW_REQUEST_THRESHOLD', 1000))
+# Record the shape of the lookups done by each route, see `bin/index_advisor.py`
+DEBUG_QUERY_SHAPES = environ.get('DEBUG_QUERY_SHAPES', 'false').lower() == 'true'
+
 ### Flask Mail ###
 MAIL_SERVER = environ.get('MAIL_SERVER')
 MAIL_PORT = environ.get('MAIL_PORT')
@@ -96,3 +141,5 @@ TASK_PARTICIPATION_EXTRACT_BACKEND = environ.get("TASK_PARTICIPATION_EXTRACT_BAC
 assert TASK_PARTICIPATION_EXTRACT_BACKEND in ("unzip", "7zip")
 TASK_PARTICIPATION_GENERATE_OBSERVATION_CSV = environ.get('TASK_PARTICIPATION_GENERATE_OBSERVATION_CSV', 'false').lower() == 'true'
 TASK_PARTICIPATION_SETTLE_DB_SLEEP = int(environ.get('TASK_PARTICIPATION_SETTLE_DB_SLEEP', 0))
+# into seconds, wait for the donnees edits to settle before computing the bilan
+TASK_PARTICIPATION_BILAN_DEBOUNCE = int(environ.get('TASK_PARTICIPATION_BILAN_DEBOUNCE', 0))
@@ -9,12 +9,15 @@ from functools import wraps
 from datetime import datetime, timedelta
 import bson
 from uuid import uuid4
+from hashlib import sha256
+from threading import Lock
 
 from flask import Blueprint, redirect, g, Response
 from flask import app, current_app, request, abort
 # from authomatic.extras.flask import FlaskAuthomatic
 
 from .tools import jsonify
+from .cache import ResourceCache, register_dependent_cache
 from .. import settings
 
 
@@ -24,6 +27,7 @@ from .. import settings
 from authomatic.adapters import WerkzeugAdapter
 from flask import make_response, session
 from authomatic import Authomatic
+from authomatic.core import resolve_provider_class
 from functools import wraps
 class FlaskAuthomatic(Authomatic):
 
@@ -94,6 +98,55 @@ def get_request_user():
     return g.request_user if hasattr(g, "request_user") else {}
 
 
+def hash_token(token):
+    return sha256(token.encode()).hexdigest()
+
+
+def build_token_index(token, expire):
+    """Entry of the token in the `tokens_index` field of the utilisateur"""
+    return {'hash': hash_token(token), 'expire': expire}
+
+
+_auth_cache = None
+_auth_cache_lock = Lock()
+
+
+def get_auth_cache():
+    """Return the process-wide cache of the utilisateurs by token hash,
+    None if disabled (see `AUTH_CACHE_TTL` setting)
+
+    Like the resources cache, it is invalidated each time an utilisateur
+    is modified (role, logout...) by this process or another one
+    """
+    global _auth_cache
+    config = current_app.config
+    if not config.get('AUTH_CACHE_TTL'):
+        return None
+    if not _auth_cache:
+        with _auth_cache_lock:
+            if not _auth_cache:
+                _auth_cache = ResourceCache(
+                    'utilisateurs', max_size=config['AUTH_CACHE_SIZE'],
+                    ttl=config['AUTH_CACHE_TTL'],
+                    check_interval=config['RESOURCES_CACHE_CHECK_INTERVAL'])
+                register_dependent_cache('utilisateurs', _auth_cache)
+    _auth_cache.check_watermark(current_app.data.db)
+    return _auth_cache
+
+
+def _find_token_owner(accounts, token, now):
+    """Return the utilisateur owning the unexpired token and the token's
+    expiration date, or (None, None)"""
+    # The tokens' index serves the lookup, `tokens` remains the reference
+    token_field = 'tokens.{}'.format(token)
+    account = accounts.find_one({'tokens_index.hash': hash_token(token), token_field: {'$gt': now}},
+                                projection={'tokens_index': False})
+    if not account:
+        return None, None
+    # Dates are in UTC, whether the client is timezone aware or not
+    return account, account.pop('tokens')[token].replace(tzinfo=None)
+
+
 def check_auth(token, allowed_roles):
     """
         Token-based authentication with role filtering
@@ -108,23 +161,29 @@ def check_auth(token, allowed_roles):
                 # Return the user profile
                 return jsonify(g.request_user)
     """
-    accounts = current_app.data.db['utilisateurs']
-    account = accounts.find_one({'tokens.{}'.format(token): {'$exists': True}})
-    if account:
-        if account['tokens'][token] < datetime.now(bson.utc):
-            # Out of date token
+    cache = get_auth_cache()
+    token_hash = hash_token(token)
+    now = datetime.utcnow()
+    cached = cache.get(token_hash) if cache else None
+    if cached and cached['expire'] > now:
+        account = cached['utilisateur']
+    else:
+        generation = cache.generation if cache else None
+        account, expire = _find_token_owner(current_app.data.db['utilisateurs'], token, now)
+        if not account:
             return False
-        if allowed_roles:
-            # Role are handled using least privilege, thus a higher
-            # privileged role also include it lower roles.
-            role = account['role']
-            if not next((True for r in current_app.config['ROLE_RULES'][role]
-                         if r in allowed_roles), False):
-                abort(403)
-        # Keep request user account in local context, could be useful later
-        g.request_user = account
-        return True
-    return False
+        if cache:
+            cache.set(token_hash, {'utilisateur': account, 'expire': expire}, generation)
+    if allowed_roles:
+        # Role are handled using least privilege, thus a higher
+        # privileged role also include it lower roles.
+        role = account['role']
+        if not next((True for r in current_app.config['ROLE_RULES'][role]
+                     if r in allowed_roles), False):
+            abort(403)
+    # Keep request user account in local context, could be useful later
+    g.request_user = account
+    return True
 
 
 def requires_auth(roles=[]):
@@ -147,6 +206,18 @@ def requires_auth(roles=[]):
     return decorator
 
 
+def build_authomatic_config(config):
+    """
+    Providers without scope get their `user_info_scope` (settings give
+    the providers by path to avoid loading authomatic)
+    """
+    config = {name: dict(provider) for name, provider in config.items()}
+    for provider in config.values():
+        if 'scope' not in provider:
+            provider['scope'] = list(resolve_provider_class(provider['class_']).user_info_scope)
+    return config
+
+
 def auth_factory(services, mock_provider=False):
     """Generate flask blueprint of login endpoints
        :params services: list of services to generate endpoints
@@ -160,7 +231,7 @@ def auth_factory(services, mock_provider=False):
        >>> [url.rule for url in f.url_map.iter_rules()]
        ['/login/github', '/login/google', '/logout', '/static/<path:filename>']
     """
-    authomatic = FlaskAuthomatic(config=settings.AUTHOMATIC,
+    authomatic = FlaskAuthomatic(config=build_authomatic_config(settings.AUTHOMATIC),
                                  secret=settings.SECRET_KEY)
     auth_blueprint = Blueprint('auth', __name__)
 
@@ -191,10 +262,18 @@ def auth_factory(services, mock_provider=False):
             token = request.authorization['username']
             users = current_app.data.db['utilisateurs']
             token_field = 'tokens.{}'.format(token)
-            lookup = {token_field: {'$exists': True}}
-            res = users.update_one(lookup, {'$unset': {token_field: ""}})
+            lookup = {'_id': g.request_user['_id'], token_field: {'$exists': True}}
+            # Updating `_updated` invalidates the auth cache of the other processes
+            res = users.update_one(lookup, {
+                '$unset': {token_field: ""},
+                '$pull': {'tokens_index': {'hash': hash_token(token)}},
+                '$set': {'_etag': uuid4().hex,
+                         '_updated': datetime.utcnow().replace(microsecond=0)}})
             if not res.modified_count:
                 abort(404)
+            cache = get_auth_cache()
+            if cache:
+                cache.delete(hash_token(token))
             logging.info('Destroying token {}'.format(token))
         return jsonify({'_status': 'Disconnected'})
     return auth_blueprint
@@ -238,11 +317,17 @@ def login(authomatic, provider_name):
                                }
                 now = datetime.now(bson.utc)
                 unset = []
+                indexed = {i['hash'] for i in document.get('tokens_index', [])}
+                to_index = [build_token_index(new_token, new_token_expire)]
                 for token, token_expire in document.get('tokens', {}).items():
                     if now > token_expire:
                         unset.append(token)
+                    elif hash_token(token) not in indexed:
+                        to_index.append(build_token_index(token, token_expire))
                 if unset:
                     mongo_update['$unset'] = {'tokens.{}'.format(t): True for t in unset}
+                # Expired entries of the index are left to `sweep_expired_tokens`
+                mongo_update['$push'] = {'tokens_index': {'$each': to_index}}
                 users_db.update_one({'_id': document['_id']}, mongo_update)
                 logging.info('user auth : {}'.format(user.email))
             else:
@@ -255,6 +340,7 @@ def login(authomatic, provider_name):
                     'pseudo': user.name,
                     'email': user.email,
                     'tokens': {new_token: new_token_expire},
+                    'tokens_index': [build_token_index(new_token, new_token_expire)],
                     'role': 'Observateur',
                     'donnees_publiques': True
                 }
@@ -266,6 +352,30 @@ def login(authomatic, provider_name):
         return authomatic.response
 
 
+def sweep_expired_tokens(db):
+    """Remove the expired tokens of the utilisateurs and index the tokens
+    created before the tokens index, return the number of utilisateurs
+    modified"""
+    accounts = db['utilisateurs']
+    now = datetime.utcnow()
+    lookup = {'$or': [{'tokens_index.expire': {'$lt': now}},
+                      {'tokens': {'$exists': True}, 'tokens_index': {'$exists': False}}]}
+    modified = 0
+    for account in accounts.find(lookup, projection={'tokens': True, 'tokens_index': True}):
+        # Dates are in UTC, whether the client is timezone aware or not
+        tokens = {t: e.replace(tzinfo=None) for t, e in account.get('tokens', {}).items()}
+        expired = {'tokens.{}'.format(t): True for t, e in tokens.items() if e < now}
+        if 'tokens_index' in account:
+            mongo_update = {'$pull': {'tokens_index': {'expire': {'$lt': now}}}}
+        else:
+            mongo_update = {'$set': {'tokens_index': [
+                build_token_index(t, e) for t, e in tokens.items() if e >= now]}}
+        if expired:
+            mongo_update['$unset'] = expired
+        modified += accounts.update_one({'_id': account['_id']}, mongo_update).modified_count
+    return modified
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -0,0 +1,184 @@
+"""
+    Resources cache
+    ~~~~~~~~~~~~~~~
+
+    Process-wide LRU/TTL cache of the rarely modified resources (taxons,
+    protocoles etc.) used by `get_resource` and `get_resources`.
+
+    Writes done through `Resource` invalidate the cache of the current
+    process, the other processes detect them by periodically comparing the
+    collection's watermark (most recently updated document and documents
+    count) with the one seen at the last check.
+
+    The totals of the list requests are also kept for a short time to
+    avoid counting the same lookup for each page.
+"""
+
+import time
+from copy import deepcopy
+from threading import Lock, RLock
+from collections import OrderedDict
+from flask import current_app
+
+
+class LRUCache:
+    """Thread safe LRU cache with a time to live on the items"""
+
+    def __init__(self, max_size=10000, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._items = OrderedDict()
+        self._lock = RLock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item and item[0] > time.monotonic():
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item:
+                del self._items[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def invalidate(self):
+        with self._lock:
+            self._items.clear()
+            self.invalidations += 1
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._items),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+            'invalidations': self.invalidations
+        }
+
+
+class ResourceCache(LRUCache):
+    """LRU cache of the documents of a single resource"""
+
+    def __init__(self, resource, max_size=10000, ttl=600, check_interval=5):
+        super().__init__(max_size=max_size, ttl=ttl)
+        self.resource = resource
+        self.check_interval = check_interval
+        # Incremented by each invalidation, documents fetched before
+        # an invalidation must not be cached
+        self.generation = 0
+        self._watermark = None
+        self._next_check = 0
+
+    def get(self, key):
+        """Return a copy of the cached document or None"""
+        document = super().get(key)
+        # Copy to protect the cache against the caller's modifications
+        return deepcopy(document) if document is not None else None
+
+    def set(self, key, document, generation):
+        with self._lock:
+            if generation == self.generation:
+                super().set(key, deepcopy(document))
+
+    def invalidate(self):
+        with self._lock:
+            super().invalidate()
+            self.generation += 1
+
+    def check_watermark(self, db):
+        """Invalidate the cache if the collection has been modified by
+        another process since the last check"""
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        collection = db[self.resource]
+        last = collection.find_one({}, projection={'_updated': True, '_etag': True},
+                                   sort=[('_updated', -1)])
+        watermark = (last.get('_updated'), last.get('_etag')) if last else None
+        watermark = (watermark, collection.estimated_document_count())
+        if self._watermark is not None and watermark != self._watermark:
+            self.invalidate()
+        self._watermark = watermark
+
+
+_caches = {}
+_count_caches = {}
+# Other caches holding documents of a resource (e.g. the auth cache)
+_dependent_caches = {}
+_caches_lock = Lock()
+
+
+def get_resource_cache(resource):
+    """Return the cache of the resource, None if it is not configured
+    to be cached (see `RESOURCES_CACHE` setting)
+    """
+    config = current_app.config
+    if resource not in config.get('RESOURCES_CACHE', ()):
+        return None
+    cache = _caches.get(resource)
+    if not cache:
+        with _caches_lock:
+            cache = _caches.get(resource)
+            if not cache:
+                cache = ResourceCache(
+                    resource, max_size=config['RESOURCES_CACHE_SIZE'],
+                    ttl=config['RESOURCES_CACHE_TTL'],
+                    check_interval=config['RESOURCES_CACHE_CHECK_INTERVAL'])
+                _caches[resource] = cache
+    cache.check_watermark(current_app.data.db)
+    return cache
+
+
+def get_count_cache(resource):
+    """Return the cache of the lookups' counts of the resource, None
+    if disabled (see `COUNT_CACHE_TTL` setting)
+    """
+    config = current_app.config
+    if not config.get('COUNT_CACHE_TTL'):
+        return None
+    cache = _count_caches.get(resource)
+    if not cache:
+        with _caches_lock:
+            cache = _count_caches.setdefault(resource, LRUCache(
+                max_size=config['COUNT_CACHE_SIZE'], ttl=config['COUNT_CACHE_TTL']))
+    return cache
+
+
+def register_dependent_cache(resource, cache):
+    """Invalidate `cache` along with the resource's cache"""
+    with _caches_lock:
+        _dependent_caches.setdefault(resource, []).append(cache)
+
+
+def invalidate_resource_cache(resource):
+    """To be called each time a document of the resource is modified"""
+    for caches in (_caches, _count_caches):
+        cache = caches.get(resource)
+        if cache:
+            cache.invalidate()
+    for cache in _dependent_caches.get(resource, ()):
+        cache.invalidate()
+
+
+def get_resources_cache_stats():
+    return {
+        'resources': {resource: cache.get_stats() for resource, cache in _caches.items()},
+        'counts': {resource: cache.get_stats() for resource, cache in _count_caches.items()}
+    }
@@ -8,6 +8,7 @@
 from datetime import timedelta
 from flask import make_response, request, current_app, abort
 from functools import update_wrapper, wraps
+from werkzeug.exceptions import HTTPException
 
 from .. import settings
 
@@ -21,25 +22,45 @@ def add_cors_headers_factory(origin=None, methods=None, headers=None, max_age=21
         origin = ', '.join(origin)
     if isinstance(max_age, timedelta):
         max_age = max_age.total_seconds()
-    if not get_methods:
-        if isinstance(methods, list):
-            methods = ', '.join(sorted(x.upper() for x in methods))
-        def get_methods():
-            if methods != None:
-                return methods
-            options_resp = current_app.make_default_options_response()
-            return options_resp.headers.get('allow')
+    if isinstance(methods, list):
+        methods = ', '.join(sorted(x.upper() for x in methods))
+    # Headers common to all the responses are computed once
+    static_headers = [('Access-Control-Allow-Credentials', 'true'),
+                      ('Access-Control-Allow-Origin', origin),
+                      ('Access-Control-Max-Age', str(max_age))]
+    if headers is not None:
+        static_headers.append(('Access-Control-Allow-Headers', headers))
+    static_headers.append(('Access-Control-Expose-Headers', ', '.join(settings.X_EXPOSE_HEADERS)))
+    methods_per_rule = {}
+
+    def get_rule_methods(url_map, rule):
+        """Methods of the route, computed on first use given all the
+        routes must have been registered"""
+        if methods is not None:
+            return methods
+        if rule is None:
+            # Request not matching any route (e.g. 405 error), the allowed
+            # methods depend on the path
+            return current_app.make_default_options_response().headers.get('allow')
+        if rule.rule not in methods_per_rule:
+            if get_methods:
+                methods_per_rule[rule.rule] = get_methods()
+            else:
+                methods_per_rule[rule.rule] = ', '.join(sorted(set().union(
+                    *(r.methods for r in url_map.iter_rules() if r.rule == rule.rule))))
+        return methods_per_rule[rule.rule]
+
+    def build_cors_headers(url_map, rule, method):
+        return static_headers + [('Access-Control-Allow-Methods',
+                                  get_rule_methods(url_map, rule) or method)]
 
     def add_cors_headers(resp):
         h = resp.headers
-        h['Access-Control-Allow-Credentials'] = 'true'
-        h['Access-Control-Allow-Origin'] = origin
-        h['Access-Control-Allow-Methods'] = get_methods() or request.method
-        h['Access-Control-Max-Age'] = str(max_age)
-        if headers is not None:
-            h['Access-Control-Allow-Headers'] = headers
+        for field, value in build_cors_headers(current_app.url_map, request.url_rule, request.method):
+            h[field] = value
         return resp
 
+    add_cors_headers.build_cors_headers = build_cors_headers
     return add_cors_headers
 
 
@@ -59,5 +80,51 @@ def crossdomain(origin=None, methods=None, headers=None, max_age=21600,
             return add_cors_headers(resp)
         f.required_methods = ['OPTIONS']
         f.provide_automatic_options = False
-        return update_wrapper(wrapped_function, f)
+        update_wrapper(wrapped_function, f)
+        if automatic_options:
+            # Preflight can be answered by `PreflightMiddleware`
+            wrapped_function.build_cors_headers = add_cors_headers.build_cors_headers
+        return wrapped_function
     return decorator
+
+
+class PreflightMiddleware:
+    """
+        WSGI middleware answering the CORS preflight requests of the routes
+        decorated by `crossdomain` before the flask dispatch, other requests
+        are passed to the application
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self._allow_per_rule = {}
+
+    def __call__(self, environ, start_response):
+        if (environ['REQUEST_METHOD'] == 'OPTIONS' and
+                'HTTP_ACCESS_CONTROL_REQUEST_METHOD' in environ):
+            headers = self.get_preflight_headers(environ)
+            if headers is not None:
+                start_response('200 OK', headers)
+                return [b'']
+        return self.wsgi_app(environ, start_response)
+
+    def get_preflight_headers(self, environ):
+        """Return the headers of the preflight response, None if the
+        request must be handled by the application"""
+        url_map = self.app.url_map
+        adapter = url_map.bind_to_environ(environ, server_name=self.app.config['SERVER_NAME'])
+        try:
+            rule, _ = adapter.match(method='OPTIONS', return_rule=True)
+        except HTTPException:
+            # Not found, redirection etc.
+            return None
+        build_cors_headers = getattr(self.app.view_functions.get(rule.endpoint),
+                                     'build_cors_headers', None)
+        if not build_cors_headers:
+            return None
+        allow = self._allow_per_rule.get(rule.rule)
+        if allow is None:
+            allow = self._allow_per_rule[rule.rule] = ', '.join(sorted(adapter.allowed_methods()))
+        return [('Content-Type', 'text/html; charset=utf-8'), ('Content-Length', '0'),
+                ('Allow', allow)] + build_cors_headers(url_map, rule, 'OPTIONS')
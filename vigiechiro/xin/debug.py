@@ -0,0 +1,357 @@
+"""
+    Debug tools
+    ~~~~~~~~~~~
+
+    Count and profile the mongodb queries done by each request, record
+    their shapes to find the missing indexes
+"""
+
+import re
+import json
+import time
+import heapq
+import logging
+from hashlib import sha1
+from threading import Lock
+from collections import Counter
+from flask import g, request, current_app, has_request_context
+from pymongo import monitoring
+from pymongo.errors import OperationFailure
+from bson import SON
+
+
+QUERIES_COUNT_HEADER = 'X-Debug-Queries-Count'
+# Number of slowest queries kept by the profiler
+PROFILER_SLOWEST_COUNT = 5
+# Collection where the query shapes are recorded
+QUERY_SHAPES_COLLECTION = 'query_shapes'
+# Commands whose query shape is recorded
+QUERY_SHAPES_COMMANDS = ('find', 'count', 'distinct', 'aggregate')
+
+# Fields whose sub-fields names are values (e.g. `tokens.<token>`)
+DYNAMIC_FIELDS = ('tokens',)
+# Path segments looking like an id or a token
+DYNAMIC_SEGMENT_REGEX = re.compile(r'^[0-9a-fA-F]{24,}$')
+# Values replacing the hidden ones to explain a query shape, by operator
+PLACEHOLDERS = {'$exists': True, '$regex': '^', '$options': '', '$size': 0,
+                '$type': 'string', '$mod': [1, 0]}
+DEFAULT_PLACEHOLDER = 0
+
+logger = logging.getLogger('vigiechiro.profiler')
+
+
+class QueriesCounter(monitoring.CommandListener):
+    """Count the commands sent to mongodb during the current request"""
+
+    def started(self, event):
+        if has_request_context():
+            g._queries_count = getattr(g, '_queries_count', 0) + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def init_queries_count_header(app):
+    """Provide the number of queries done by each request in an header,
+    must be called before the mongodb client is created
+    """
+    monitoring.register(QueriesCounter())
+
+    @app.after_request
+    def add_queries_count_header(response):
+        response.headers[QUERIES_COUNT_HEADER] = str(getattr(g, '_queries_count', 0))
+        return response
+
+
+def _shape_key(key):
+    """Hide the values used as field names (e.g. `tokens.*`)"""
+    segments = key.split('.')
+    if len(segments) > 1 and segments[0] in DYNAMIC_FIELDS:
+        return segments[0] + '.*'
+    return '.'.join('*' if DYNAMIC_SEGMENT_REGEX.match(segment) else segment
+                    for segment in segments)
+
+
+def _shape(value):
+    """Keep the structure of a filter but hide its values"""
+    if isinstance(value, dict):
+        return {_shape_key(key): _shape(sub_value) for key, sub_value in value.items()}
+    elif isinstance(value, (list, tuple)):
+        # Keep all the clauses of `$and`/`$or`, a single value otherwise
+        if value and all(isinstance(sub_value, dict) for sub_value in value):
+            return [_shape(sub_value) for sub_value in value]
+        return [_shape(sub_value) for sub_value in value[:1]]
+    return '?'
+
+
+def _command_query(command_name, command):
+    """Return the filter of a command"""
+    query = command.get('filter', command.get('query'))
+    for bulk_field, query_field in (('updates', 'q'), ('deletes', 'q')):
+        if command.get(bulk_field):
+            query = command[bulk_field][0].get(query_field)
+    if command_name == 'aggregate':
+        query = next((stage['$match'] for stage in command.get('pipeline', [])
+                      if '$match' in stage), None)
+    return query
+
+
+def _command_shape(command_name, command):
+    """Return the collection, filter shape and sort of a command"""
+    collection = command.get(command_name)
+    if command_name == 'getMore':
+        collection = command.get('collection')
+    query = _command_query(command_name, command)
+    shape = {
+        'command': command_name,
+        'collection': collection if isinstance(collection, str) else None,
+        'filter': _shape(query) if query is not None else None,
+        'sort': ({_shape_key(key): direction for key, direction in dict(command['sort']).items()}
+                 if command.get('sort') else None)
+    }
+    if command_name == 'distinct':
+        shape['key'] = _shape_key(command.get('key', ''))
+    return shape
+
+
+def _new_profile():
+    return {'started_at': time.perf_counter(), 'count': 0, 'duration': 0,
+            'commands': Counter(), 'slowest': [], 'pending': {}}
+
+
+class QueriesProfiler(monitoring.CommandListener):
+    """Time the commands sent to mongodb during the current request and
+    keep the slowest ones"""
+
+    def started(self, event):
+        profile = has_request_context() and getattr(g, '_queries_profile', None)
+        if profile:
+            profile['pending'][event.request_id] = _command_shape(
+                event.command_name, event.command)
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+    def _finished(self, event):
+        profile = has_request_context() and getattr(g, '_queries_profile', None)
+        if not profile:
+            return
+        shape = profile['pending'].pop(event.request_id, None)
+        if not shape:
+            return
+        duration = event.duration_micros / 1000
+        profile['count'] += 1
+        profile['duration'] += duration
+        profile['commands'][shape['command']] += 1
+        # Min-heap on the duration, the id breaks ties between equal durations
+        item = (duration, event.request_id, shape)
+        if len(profile['slowest']) < PROFILER_SLOWEST_COUNT:
+            heapq.heappush(profile['slowest'], item)
+        else:
+            heapq.heappushpop(profile['slowest'], item)
+
+
+def build_server_timing(profile, duration):
+    return 'db;desc="{} queries";dur={:.1f}, total;dur={:.1f}'.format(
+        profile['count'], profile['duration'], duration)
+
+
+def _log_profile(profile, route, method, path, status, slow_request_threshold):
+    duration = (time.perf_counter() - profile['started_at']) * 1000
+    slowest = [dict(shape, duration=round(d, 1))
+               for d, _, shape in sorted(profile['slowest'], reverse=True)]
+    logger.info(json.dumps({
+        'route': route, 'method': method, 'path': path, 'status': status,
+        'duration': round(duration, 1), 'queries': profile['count'],
+        'queries_duration': round(profile['duration'], 1),
+        'commands': profile['commands'], 'slowest': slowest}))
+    if slow_request_threshold and duration > slow_request_threshold:
+        logger.warning('Slow request {} ({} {}) : {:.1f}ms, {} queries ({:.1f}ms), '
+                       'slowest : {}'.format(route, method, path, duration, profile['count'],
+                                             profile['duration'], json.dumps(slowest)))
+
+
+def init_queries_profiler(app, slow_request_threshold=None):
+    """
+        Time the mongodb queries done by each request, provide them in a
+        `Server-Timing` header and log a summary at the end of the request
+        (with a warning if it took more than `slow_request_threshold` ms),
+        must be called before the mongodb client is created
+    """
+    monitoring.register(QueriesProfiler())
+
+    @app.before_request
+    def start_queries_profile():
+        g._queries_profile = _new_profile()
+
+    @app.after_request
+    def add_server_timing_header(response):
+        profile = getattr(g, '_queries_profile', None)
+        if profile is None:
+            return response
+        duration = (time.perf_counter() - profile['started_at']) * 1000
+        response.headers['Server-Timing'] = build_server_timing(profile, duration)
+        # Streamed responses keep querying after this point, hence the
+        # summary is logged once the response is over
+        args = (profile, request.endpoint, request.method, request.path,
+                response.status_code, slow_request_threshold)
+        response.call_on_close(lambda: _log_profile(*args))
+        return response
+
+
+_known_query_shapes = set()
+_known_query_shapes_lock = Lock()
+
+
+class QueryShapesRecorder(monitoring.CommandListener):
+    """Keep the shapes of the lookups done during the current request
+    not yet recorded by the process"""
+
+    def started(self, event):
+        shapes = has_request_context() and getattr(g, '_query_shapes', None)
+        if shapes is None or event.command_name not in QUERY_SHAPES_COMMANDS:
+            return
+        shape = _command_shape(event.command_name, event.command)
+        if not shape['collection'] or shape['collection'] == QUERY_SHAPES_COLLECTION:
+            return
+        # Only the shape is kept, the values of the lookups (tokens,
+        # personal data...) are never stored
+        key = sha1(json.dumps([shape['command'], shape['collection'], shape['filter'],
+                               shape['sort'], shape.get('key')],
+                              sort_keys=True).encode()).hexdigest()
+        with _known_query_shapes_lock:
+            if (key, request.endpoint) in _known_query_shapes:
+                return
+            _known_query_shapes.add((key, request.endpoint))
+        shapes.append((key, shape, request.endpoint))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def _save_query_shapes(collection, shapes):
+    for key, shape, route in shapes:
+        try:
+            collection.update_one({'_id': key}, {
+                '$setOnInsert': {
+                    'command': shape['command'],
+                    'collection': shape['collection'],
+                    # Stored as JSON given its fields can be operators
+                    'filter': json.dumps(shape['filter'], sort_keys=True),
+                    'sort': list(shape['sort'].items()) if shape['sort'] else None,
+                    'key': shape.get('key')
+                },
+                '$addToSet': {'routes': route}
+            }, upsert=True)
+        except Exception:
+            logger.exception('Cannot record query shape {}'.format(shape))
+
+
+def init_query_shapes_registry(app):
+    """
+        Record in the `query_shapes` collection the shape of the lookups done
+        by each route to be replayed by `explain_query_shapes`, must be called
+        before the mongodb client is created
+    """
+    monitoring.register(QueryShapesRecorder())
+
+    @app.before_request
+    def start_query_shapes():
+        g._query_shapes = []
+
+    @app.after_request
+    def save_query_shapes(response):
+        shapes = getattr(g, '_query_shapes', None)
+        if shapes is not None:
+            collection = current_app.data.db[QUERY_SHAPES_COLLECTION]
+            # Streamed responses keep querying after this point
+            response.call_on_close(lambda: _save_query_shapes(collection, shapes))
+        return response
+
+
+def _plan_stages(plan):
+    """Yield the stages of an explained query plan"""
+    yield plan.get('stage')
+    for field in ('inputStage', 'queryPlan'):
+        if plan.get(field):
+            yield from _plan_stages(plan[field])
+    for sub_plan in plan.get('inputStages', []):
+        yield from _plan_stages(sub_plan)
+
+
+def check_query_plan(plan):
+    """Return the issues of an explained query plan"""
+    stages = set(_plan_stages(plan))
+    issues = []
+    if 'COLLSCAN' in stages:
+        issues.append('collection scan')
+    if 'SORT' in stages:
+        issues.append('in-memory sort')
+    return issues
+
+
+def build_placeholder_query(value, operator=None):
+    """Rebuild a query from its shape, the hidden values are replaced
+    by placeholders (see `PLACEHOLDERS`)"""
+    if isinstance(value, dict):
+        return {key: build_placeholder_query(sub_value, key) for key, sub_value in value.items()}
+    elif isinstance(value, list):
+        if operator in PLACEHOLDERS:
+            return PLACEHOLDERS[operator]
+        return [build_placeholder_query(sub_value, operator) for sub_value in value]
+    return PLACEHOLDERS.get(operator, DEFAULT_PLACEHOLDER)
+
+
+def build_explain_command(shape):
+    """Return the command replaying a recorded query shape"""
+    command = shape.get('command', 'find')
+    collection = shape['collection']
+    query = build_placeholder_query(json.loads(shape['filter']) or {})
+    sort = SON([tuple(s) for s in shape['sort']]) if shape.get('sort') else None
+    if command == 'count':
+        return SON([('count', collection), ('query', query)])
+    elif command == 'distinct':
+        return SON([('distinct', collection), ('key', shape['key']), ('query', query)])
+    elif command == 'aggregate':
+        pipeline = [{'$match': query}] + ([{'$sort': sort}] if sort else [])
+        return SON([('aggregate', collection), ('pipeline', pipeline), ('cursor', {})])
+    find = SON([('find', collection), ('filter', query)])
+    if sort:
+        find['sort'] = sort
+    return find
+
+
+def _winning_plan(explained):
+    if 'queryPlanner' in explained:
+        return explained['queryPlanner']['winningPlan']
+    # Aggregations explain the query of their first stage
+    for stage in explained.get('stages', []):
+        if '$cursor' in stage:
+            return stage['$cursor']['queryPlanner']['winningPlan']
+    return {}
+
+
+def explain_query_shapes(db):
+    """Explain the recorded query shapes, return the ones with issues
+    as a list of (query shape document, issues)"""
+    results = []
+    for shape in db[QUERY_SHAPES_COLLECTION].find():
+        try:
+            explained = db.command('explain', build_explain_command(shape),
+                                   verbosity='queryPlanner')
+        except OperationFailure as exc:
+            results.append((shape, ['cannot be explained ({})'.format(exc)]))
+            continue
+        issues = check_query_plan(_winning_plan(explained))
+        if issues:
+            results.append((shape, issues))
+    return results
@@ -1,20 +1,114 @@
 from functools import wraps
 
 from flask import Flask, Blueprint, current_app, abort, make_response
+from pymongo import UpdateOne, IndexModel
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 from datetime import datetime
 from bson import ObjectId
+from collections import defaultdict, Counter
 import logging
+import random
+import re
+import time
 from uuid import uuid4
 
 from .cors import crossdomain
-from .schema import Validator, Unserializer
-from .tools import build_etag, jsonify
+from .schema import Validator, Unserializer, RelationsBatch, ERROR_UNIQUE_FIELD
+from .tools import build_etag, jsonify, is_not_modified, make_not_modified_response
 from .snippets import get_resource
+from .cache import invalidate_resource_cache
 
 
 RESERVED_FIELD = {'_id', '_created', '_updated', '_etag'}
+# Number of documents unserialized together by `Resource.find`
+UNSERIALIZE_BATCH_SIZE = 100
+# Updates by id using only those operators don't read the document first
+SKIP_READ_UPDATE_OPERATORS = {'$set', '$push'}
+# Retries of an update in case of concurrent modification, the delay
+# before each retry is random up to an exponentially growing limit
+UPDATE_MAX_RETRIES = 5
+UPDATE_RETRY_DELAY = 0.01
+UPDATE_RETRY_MAX_DELAY = 0.5
+# Errors of an index conflicting with an existing one on the same key
+INDEX_CONFLICT_CODES = (85, 86)
+
+_updates_stats = defaultdict(Counter)
+
+
+def get_updates_stats():
+    """Return per resource the number of updates, skipped reads, retries
+    and conflicts (i.e. updates aborted after too many retries) of this
+    process"""
+    return {name: dict(stats) for name, stats in _updates_stats.items()}
+
 
 class DocumentException(Exception): pass
+
+
+def _walk_schema(schema, prefix='', hidden_path=None):
+    """Yield the path of each field of the schema with the path of the
+    hidden field containing it (if any) and whether it is a data relation,
+    list elements share the path of their list"""
+    for field, field_schema in schema.items():
+        yield from _walk_field(field_schema, prefix + field, hidden_path)
+
+
+def _walk_field(field_schema, path, hidden_path):
+    if not hidden_path and field_schema.get('hidden'):
+        hidden_path = path
+    yield path, hidden_path, 'data_relation' in field_schema
+    sub_schema = field_schema.get('schema')
+    if not isinstance(sub_schema, dict):
+        return
+    if field_schema.get('type') == 'dict':
+        yield from _walk_schema(sub_schema, path + '.', hidden_path)
+    elif field_schema.get('type') in ('list', 'set'):
+        yield from _walk_field(sub_schema, path, hidden_path)
+
+
+def _split_param(value):
+    if isinstance(value, str):
+        value = value.split(',')
+    return {v.strip() for v in value if v.strip()}
+
+
+def _is_covered(path, paths):
+    """Check if the path or one of its parents is among the paths"""
+    return any(path == p or path.startswith(p + '.') for p in paths)
+
+
+def _collapse_paths(paths):
+    """Remove the paths whose parent is among the paths (mongodb rejects
+    the projections with such collisions)"""
+    return {path for path in paths if not _is_covered(path, paths - {path})}
+
+
+def _unique_errors(details, document):
+    """Translate the details of a duplicate key error into the errors
+    returned by the validator"""
+    key_value = details.get('keyValue')
+    if not key_value:
+        # Server older than 4.2, retrieve the field from the index's name
+        match = re.search(r'index: (\S+)_unique ', details.get('errmsg', ''))
+        field = match.group(1) if match else None
+        key_value = {field: document.get(field) if field else None}
+    return {field: ERROR_UNIQUE_FIELD % value for field, value in key_value.items()}
+
+
+def _index_from_info(name, info):
+    """Rebuild an index from its `index_information` entry"""
+    options = {k: v for k, v in info.items() if k not in ('key', 'v', 'ns')}
+    return IndexModel(info['key'], name=name, **options)
+
+
+class NotModified(Exception):
+    """Interrupt the route to answer 304, see `Resource.find_one`"""
+
+    def __init__(self, etag):
+        super().__init__(etag)
+        self.etag = etag
+
+
 class SchemaException(Exception): pass
 
 class Resource(Blueprint):
@@ -26,12 +120,15 @@ class Resource(Blueprint):
         :param name: name of the resource, will determine the mongodb
                      collection to work on
         :param schema: schema to use to validate the resources
+        :param indexes: list of `pymongo.IndexModel` to create on the
+                        collection (see `ensure_indexes`)
     """
 
-    def __init__(self, name, *args, schema=None, **kwargs):
+    def __init__(self, name, *args, schema=None, indexes=None, **kwargs):
         super().__init__(name, *args, **kwargs)
         self.name = name
         self.schema = schema
+        self.indexes = indexes or []
         # Add default fields to the schema
         if RESERVED_FIELD - set(schema.keys()) != RESERVED_FIELD:
             raise SchemaException('Schema should not contain fields {}'.format(RESERVED_FIELD))
@@ -41,6 +138,15 @@ class Resource(Blueprint):
         schema['_etag'] = {'type': 'string', 'readonly': True}
         self.validator = Validator(schema)
         self.unserializer = Unserializer(schema)
+        self.validator.compile()
+        self.unserializer.compile()
+        # Fields which can be selected with `fields` and `expand` params
+        self._hidden_paths = {}
+        self._relation_paths = set()
+        for path, hidden_path, is_relation in _walk_schema(schema):
+            self._hidden_paths.setdefault(path, hidden_path)
+            if is_relation:
+                self._relation_paths.add(path)
         # Need to keep trace to provide consistent OPTIONS response in case
         # a route is registered more than one time with different methods
         self.methods_per_route = {}
@@ -70,11 +176,19 @@ class Resource(Blueprint):
             @cors_decorator
             @wraps(f)
             def wrapper(*args, **kwargs):
-                result = f(*args, **kwargs)
+                try:
+                    result = f(*args, **kwargs)
+                except NotModified as exc:
+                    return make_not_modified_response(exc.etag)
                 # if result contains a dict, assume the response is json
                 if isinstance(result, dict):
-                    payload = result
-                    return jsonify(**result)
+                    etag = result.get('_etag')
+                    if is_not_modified(etag):
+                        return make_not_modified_response(etag)
+                    response = jsonify(**result)
+                    if etag:
+                        response.set_etag(etag)
+                    return response
                 elif isinstance(result, tuple) and isinstance(result[0], dict):
                     response = jsonify(**result[0])
                     if len(result) >= 2:
@@ -105,29 +219,165 @@ class Resource(Blueprint):
         payload['_created'] = payload['_updated'] = datetime.utcnow().replace(microsecond=0)
         payload['_etag'] = uuid4().hex
         # Finally do the actual insert in db
-        insert_result = current_app.data.db[self.name].insert_one(payload)
+        try:
+            insert_result = current_app.data.db[self.name].insert_one(payload)
+        except DuplicateKeyError as exc:
+            errors = _unique_errors(exc.details, payload)
+            if auto_abort:
+                abort(422, errors)
+            else:
+                raise DocumentException(errors)
         payload['_id'] = insert_result.inserted_id
+        invalidate_resource_cache(self.name)
         return payload
 
+    def insert_many(self, payloads, additional_context=None):
+        """
+            Insert in database a batch of new documents of the resource,
+            the data relations of the whole batch are checked together and
+            the valid documents are written with a single unordered bulk
+            insert
+
+            :return: the inserted documents and a dict of the errors (as
+                     `(code, msg)`) by index of the rejected payloads
+        """
+        relations_batch = RelationsBatch()
+        additional_context = dict(additional_context or {}, resource=self,
+                                  relations_batch=relations_batch)
+        results = [self.validator.run(payload, additional_context=additional_context)
+                   for payload in payloads]
+        relations_batch.check()
+        errors = {}
+        to_insert = []
+        now = datetime.utcnow().replace(microsecond=0)
+        for index, (payload, result) in enumerate(zip(payloads, results)):
+            if result.errors:
+                errors[index] = (422, result.errors)
+                continue
+            payload['_created'] = payload['_updated'] = now
+            payload['_etag'] = uuid4().hex
+            to_insert.append((index, payload))
+        if not to_insert:
+            return [], errors
+        try:
+            current_app.data.db[self.name].insert_many(
+                [payload for _, payload in to_insert], ordered=False)
+        except BulkWriteError as exc:
+            for write_error in exc.details['writeErrors']:
+                index, payload = to_insert[write_error['index']]
+                errors[index] = self._write_error(write_error, payload)
+        invalidate_resource_cache(self.name)
+        return [payload for index, payload in to_insert if index not in errors], errors
+
+    def bulk_update(self, updates, additional_context=None):
+        """
+            Update in database a batch of documents of the resource with a
+            single unordered bulk write, validation is done as for `update`
+            without reading the documents (hence the lookups must be by id)
+
+            :param updates: list of `(lookup, payload)` or
+                            `(lookup, payload, mongo_update)`, `lookup` being
+                            an ObjectId or a dict containing `_id` (and
+                            optionally the expected `_etag`)
+            :return: the new etags of the updated documents and the errors
+                     (as `(code, msg)`), both as dicts by index of the updates
+        """
+        relations_batch = RelationsBatch()
+        base_context = dict(additional_context or {}, resource=self,
+                            relations_batch=relations_batch)
+        results = []
+        for lookup, payload, *mongo_update in updates:
+            if isinstance(lookup, ObjectId):
+                lookup = {'_id': lookup}
+            if not isinstance(lookup, dict) or not isinstance(lookup.get('_id'), ObjectId):
+                raise ValueError("lookup must be ObjectId or dict with an ObjectId `_id`")
+            context = dict(base_context, old_document={'_id': lookup['_id']})
+            results.append((lookup, payload, mongo_update[0] if mongo_update else None,
+                            self.validator.run(payload, is_update=True,
+                                               additional_context=context)))
+        relations_batch.check()
+        errors = {}
+        etags = {}
+        operations = []
+        now = datetime.utcnow().replace(microsecond=0)
+        for index, (lookup, payload, mongo_update, result) in enumerate(results):
+            if result.errors:
+                errors[index] = (422, result.errors)
+                continue
+            mongo_update = dict(mongo_update or {'$set': payload})
+            mongo_update['$set'] = dict(mongo_update.get('$set', {}),
+                                        _updated=now, _etag=uuid4().hex)
+            etags[index] = mongo_update['$set']['_etag']
+            operations.append((index, UpdateOne(lookup, mongo_update)))
+        if not operations:
+            return {}, errors
+        resource_db = current_app.data.db[self.name]
+        try:
+            result = resource_db.bulk_write([op for _, op in operations], ordered=False)
+            matched_count = result.matched_count
+        except BulkWriteError as exc:
+            for write_error in exc.details['writeErrors']:
+                index = operations[write_error['index']][0]
+                errors[index] = self._write_error(write_error, results[index][1])
+                del etags[index]
+            matched_count = exc.details['nMatched']
+        if matched_count < len(etags):
+            # Updated documents are the ones bearing the new etags
+            ids = [results[index][0]['_id'] for index in etags]
+            found = {doc['_id']: doc.get('_etag') for doc in resource_db.find(
+                {'_id': {'$in': ids}}, projection={'_etag': True})}
+            for index, etag in list(etags.items()):
+                document_id = results[index][0]['_id']
+                if document_id not in found:
+                    errors[index] = (404, )
+                elif found[document_id] != etag:
+                    errors[index] = (412, 'If-Match condition has failed')
+                else:
+                    continue
+                del etags[index]
+        invalidate_resource_cache(self.name)
+        return etags, errors
+
+    @staticmethod
+    def _write_error(write_error, document):
+        if write_error['code'] == 11000:
+            return (422, _unique_errors(write_error, document))
+        return (500, write_error['errmsg'])
+
+    def _can_skip_read(self, lookup, mongo_update, if_match):
+        """Validation only needs the id of the updated document, hence it
+        doesn't have to be read when the update is done by id with
+        operators applying the validated payload (no read-modify-write)
+        and without etag to check against"""
+        if if_match or not isinstance(lookup.get('_id'), ObjectId):
+            return False
+        operators = set(mongo_update) if mongo_update else {'$set'}
+        return operators <= SKIP_READ_UPDATE_OPERATORS
+
     def _atomic_update(self, lookup, payload, mongo_update=None,
                        if_match=False, additional_context=None):
-        # Retrieve previous version of the document
         if isinstance(lookup, ObjectId):
             lookup = {'_id': lookup}
         if not isinstance(lookup, dict):
             raise ValueError("lookup must be ObjectId or dict")
         resource_db = current_app.data.db[self.name]
-        document = resource_db.find_one(lookup)
-        if not document:
-            return (404, )
-        old_etag = document.get('_etag', None)
-        if not old_etag:
-            logging.error('Errors in document {} {} : missing field _etag'.format(
-                self.name, document['_id']))
-            abort(500)
-        # Check for race condition
-        if if_match and old_etag != if_match:
-            return (412, 'If-Match condition has failed')
+        skip_read = self._can_skip_read(lookup, mongo_update, if_match)
+        if skip_read:
+            _updates_stats[self.name]['reads_skipped'] += 1
+            document = {'_id': lookup['_id']}
+        else:
+            # Retrieve previous version of the document
+            document = resource_db.find_one(lookup)
+            if not document:
+                return (404, )
+            old_etag = document.get('_etag', None)
+            if not old_etag:
+                logging.error('Errors in document {} {} : missing field _etag'.format(
+                    self.name, document['_id']))
+                abort(500)
+            # Check for race condition
+            if if_match and old_etag != if_match:
+                return (412, 'If-Match condition has failed')
         # Provide to the validator additional data needed for some validatations
         additional_context = additional_context or {}
         additional_context['resource'] = self
@@ -147,13 +397,19 @@ class Resource(Blueprint):
         # Finally do the actual update in db using again the _etag
         # field in the lookup to prevent race condition
         lookup = lookup.copy()
-        if '_etag' not in lookup:
+        if '_etag' not in lookup and not skip_read:
             lookup['_etag'] = old_etag
-        new_document = resource_db.find_and_modify(
-            query=lookup,
-            update=mongo_update, new=True)
+        try:
+            new_document = resource_db.find_and_modify(
+                query=lookup,
+                update=mongo_update, new=True)
+        except DuplicateKeyError as exc:
+            return (422, _unique_errors(exc.details, payload))
         if not new_document:
+            if skip_read:
+                return (404, )
             return (412, 'If-Match condition has failed')
+        invalidate_resource_cache(self.name)
         return (200, new_document)
 
     def insert_or_replace(self, lookup, payload, auto_abort=True):
@@ -171,11 +427,15 @@ class Resource(Blueprint):
         if not isinstance(lookup, dict):
             raise ValueError("lookup must be ObjectId or dict")
         resource_db = current_app.data.db[self.name]
-        new_document = resource_db.find_and_modify(
-            query=lookup,
-            update=mongo_update, new=True, upsert=True)
+        try:
+            new_document = resource_db.find_and_modify(
+                query=lookup,
+                update=mongo_update, new=True, upsert=True)
+        except DuplicateKeyError as exc:
+            return error(422, _unique_errors(exc.details, payload))
         if not new_document:
             return error(412, 'If-Match condition has failed')
+        invalidate_resource_cache(self.name)
         return self._unserialize_document(new_document).document
 
     def update(self, lookup, payload, mongo_update=None, if_match=False,
@@ -187,7 +447,8 @@ class Resource(Blueprint):
                                  to use to update in database instead of using
                                  {'$set': payload}
             :param if_match: race condition politic, if if_match is False the
-                             update will be repeatedly tried until accepted,
+                             update will be tried again (up to
+                             UPDATE_MAX_RETRIES times) until accepted,
                              if if_match is an etag, the update will be rejected
                              if it differs from the document's etag
         """
@@ -196,14 +457,26 @@ class Resource(Blueprint):
                 abort(code, msg)
             else:
                 raise DocumentException((code, msg))
+        stats = _updates_stats[self.name]
+        stats['updates'] += 1
         if not if_match:
-            # No if_match, in case of race condition, repeatedly try the update
-            while True:
+            # No if_match, in case of race condition, retry the update
+            # after a random delay to spread the concurrent attempts
+            for attempt in range(UPDATE_MAX_RETRIES + 1):
+                if attempt:
+                    stats['retries'] += 1
+                    time.sleep(random.uniform(0, min(UPDATE_RETRY_MAX_DELAY,
+                                                     UPDATE_RETRY_DELAY * 2 ** attempt)))
                 result = self._atomic_update(lookup, payload.copy(),
                                              mongo_update=mongo_update,
                                              additional_context=additional_context)
                 if result[0] != 412:
                     break
+            else:
+                stats['conflicts'] += 1
+                logging.warning('Too many concurrent updates on {} {}'.format(
+                    self.name, lookup))
+                result = (409, 'Too many concurrent updates, retry later')
         else:
             # Else abort in case of race condition
             result = self._atomic_update(lookup, payload, if_match=if_match,
@@ -213,25 +486,104 @@ class Resource(Blueprint):
         # Unserialize and return our new document
         return self._unserialize_document(result[1]).document
 
-    def find(self, *args, additional_context=None, **kwargs):
+    def _apply_selection(self, args, kwargs, additional_context, fields, expand):
+        """
+            Restrict the projection to the `fields` and the expended relations
+            to `expand` (both list or comma-separated string of field paths),
+            fields excluded by the projection of the route are never returned
+        """
+        if fields is None and expand is None:
+            return args, kwargs, additional_context
+        additional_context = dict(additional_context or {})
+        errors = {}
+        if fields is not None:
+            args = list(args)
+            projection = args.pop(1) if len(args) > 1 else kwargs.pop('projection', None)
+            requested = _split_param(fields)
+            for path in requested:
+                if path not in self._hidden_paths:
+                    errors.setdefault('fields', {})[path] = 'unknown field'
+                elif self._is_hidden(path, additional_context):
+                    errors.setdefault('fields', {})[path] = 'hidden field'
+            # Fields needed for the sort (e.g. cursor pagination) and metadata
+            requested |= RESERVED_FIELD | {f for f, _ in kwargs.get('sort') or []}
+            if projection:
+                included = {f for f, v in projection.items() if v}
+                excluded = {f for f, v in projection.items() if not v}
+                requested = {path for path in requested
+                             if not _is_covered(path, excluded) and
+                             not any(_is_covered(e, [path]) for e in excluded)}
+                if included:
+                    requested = ({path for path in requested if _is_covered(path, included)} |
+                                 {path for path in included if _is_covered(path, requested)})
+            kwargs['projection'] = {path: True for path in _collapse_paths(requested)}
+        if expand is not None:
+            requested = _split_param(expand)
+            for path in requested - self._relation_paths:
+                errors.setdefault('expand', {})[path] = 'not a data relation'
+            expend = additional_context.get('expend', {})
+            if isinstance(expend, dict):
+                additional_context['expend'] = dict(
+                    {path: path in requested for path in self._relation_paths}, **expend)
+        if errors:
+            abort(422, errors)
+        return args, kwargs, additional_context
+
+    def _is_hidden(self, path, additional_context):
+        """Same rules than the `hidden` attribute of the `Unserializer`"""
+        hidden_path = self._hidden_paths.get(path)
+        if not hidden_path or additional_context.get('internal', False):
+            return False
+        return (additional_context.get('hidden') or {}).get(hidden_path, True)
+
+    def find(self, *args, additional_context=None, count=True,
+             fields=None, expand=None, **kwargs):
+        """
+            Return the unserialized documents and their total (without
+            limit and skip), total is None if `count` is False
+
+            :param fields: restrict the returned fields (see `get_selection_params`)
+            :param expand: restrict the expended data relations
+        """
+        args, kwargs, additional_context = self._apply_selection(
+            args, kwargs, additional_context, fields, expand)
         cursor = current_app.data.db[self.name].find(*args, **kwargs)
 
-        _lazy_fetch_and_unserialize = (
-            self._unserialize_document(
-                document,
-                additional_context=additional_context
-            ).document
-            for document in cursor
-        )
+        def _lazy_fetch_and_unserialize():
+            # Unserialize by batches to share the data relations' queries
+            batch = []
+            for document in cursor:
+                batch.append(document)
+                if len(batch) == UNSERIALIZE_BATCH_SIZE:
+                    for result in self._unserialize_documents(batch, additional_context):
+                        yield result.document
+                    batch = []
+            for result in self._unserialize_documents(batch, additional_context):
+                yield result.document
 
-        return _lazy_fetch_and_unserialize, cursor.count(with_limit_and_skip=False)
+        total = cursor.count(with_limit_and_skip=False) if count else None
+        return _lazy_fetch_and_unserialize(), total
 
     def remove(self, *args, **kwargs):
-        return current_app.data.db[self.name].delete_one(*args, **kwargs)
+        result = current_app.data.db[self.name].delete_one(*args, **kwargs)
+        invalidate_resource_cache(self.name)
+        return result
 
-    def find_one(self, *args, additional_context=None, auto_abort=True, **kwargs):
+    def find_one(self, *args, additional_context=None, auto_abort=True,
+                 check_etag=False, fields=None, expand=None, **kwargs):
+        """
+            :param check_etag: if the document is the one returned by the route,
+            answer 304 without unserializing (and expanding the relations of)
+            the document when its etag matches the If-None-Match header
+            :param fields: restrict the returned fields (see `get_selection_params`)
+            :param expand: restrict the expended data relations
+        """
+        args, kwargs, additional_context = self._apply_selection(
+            args, kwargs, additional_context, fields, expand)
         document = current_app.data.db[self.name].find_one(*args, **kwargs)
         if document:
+            if check_etag and is_not_modified(document.get('_etag')):
+                raise NotModified(document['_etag'])
             # Provide to the validator additional data needed for some validatations
             result = self._unserialize_document(document,
                 additional_context=additional_context)
@@ -241,21 +593,72 @@ class Resource(Blueprint):
         return document
 
     def _unserialize_document(self, document, additional_context=None):
+        return self._unserialize_documents([document], additional_context)[0]
+
+    def _unserialize_documents(self, documents, additional_context=None):
+        """Unserialize the documents, their data relations are expended
+        with a single query per related resource"""
         # Provide to the validator additional data needed for some validatations
-        additional_context = additional_context or {}
-        additional_context['resource'] = self
-        result = self.unserializer.run(document,
-                                       additional_context=additional_context)
-        if result.errors:
-            logging.error('Errors in document {} {} : {}'.format(
-                self.name, result.document['_id'], result.errors))
-        return result
+        relations_batch = RelationsBatch()
+        additional_context = dict(additional_context or {}, resource=self,
+                                  relations_batch=relations_batch)
+        results = [self.unserializer.run(document, additional_context=additional_context)
+                   for document in documents]
+        relations_batch.expend()
+        for result in results:
+            if result.errors:
+                logging.error('Errors in document {} {} : {}'.format(
+                    self.name, result.document['_id'], result.errors))
+        return results
 
     def get_resource(self, obj_id, auto_abort=True, projection=None):
         """Retrieve object from database with it ID and resource name"""
         return get_resource(self.name, obj_id, auto_abort=auto_abort,
                             projection=projection)
 
-    def build_db_indexes(clean=False):
-        """Initialize the database with the given indexes"""
-        pass
+    def get_indexes(self):
+        """Indexes of the resource, i.e. the declared ones and a unique index
+        per `unique` field of the schema (documents without the field are
+        not indexed)"""
+        return self.indexes + [
+            IndexModel([(field, 1)], unique=True, name='%s_unique' % field,
+                       partialFilterExpression={field: {'$exists': True}})
+            for field, field_schema in self.schema.items()
+            if field_schema.get('unique')]
+
+    def ensure_indexes(self, db=None):
+        """Create the indexes of the resource if they don't exist yet,
+        a non-unique index on a unique field is replaced once the unique
+        index is created, return the names of the indexes not created"""
+        collection = (db if db is not None else current_app.data.db)[self.name]
+        existing = {tuple(info['key']): (name, info)
+                    for name, info in collection.index_information().items()}
+        failed = []
+        for index in self.get_indexes():
+            spec = index.document
+            name, info = existing.get(tuple(spec['key'].items()), (None, None))
+            if info and (info.get('unique', False) or not spec.get('unique', False)):
+                continue
+            try:
+                try:
+                    collection.create_indexes([index])
+                except OperationFailure as exc:
+                    if not info or exc.code not in INDEX_CONFLICT_CODES:
+                        raise
+                    # Server refusing two indexes on the same key, the old
+                    # one is restored if the unique one cannot be created
+                    collection.drop_index(name)
+                    try:
+                        collection.create_indexes([index])
+                    except OperationFailure:
+                        collection.create_indexes([_index_from_info(name, info)])
+                        raise
+                else:
+                    if info:
+                        collection.drop_index(name)
+            except OperationFailure as exc:
+                # Most likely the collection already contains duplicates
+                logging.error('Cannot create index {} on {} : {}'.format(
+                    spec['name'], self.name, exc))
+                failed.append(spec['name'])
+        return failed
@@ -6,13 +6,15 @@
 """
 
 import re
+import json
+from copy import deepcopy
 from flask import request, g, current_app
 from bson import ObjectId
 from datetime import datetime
 from collections import Mapping, Sequence
 
 from .tools import str_to_date, parse_id
-from .snippets import get_resource
+from .snippets import get_resource, get_resources
 from .geo import (Point, MultiPoint, LineString, Polygon,
                   MultiLineString, MultiPolygon, GeometryCollection)
 
@@ -96,9 +98,10 @@ class SchemaRunnerContext:
         return '.'.join(f for f in [f for _, f, _ in self._stack[1:]] + [self.field]
                         if isinstance(f, str))
 
-    def add_error(self, msg):
+    def add_error(self, msg, path=None):
         self.is_valid = False
-        path = self.get_current_path()
+        if path is None:
+            path = self.get_current_path()
         if path not in self.errors:
             self.errors[path] = msg
         elif isinstance(self.errors[path], list):
@@ -110,6 +113,82 @@ class SchemaRunnerContext:
 class SchemaRunnerException(Exception): pass
 
 
+class RelationsBatch:
+    """
+        Collect the data relations to expend while unserializing documents
+        (see `Unserializer`) or to check while validating them (see
+        `Validator`), then fetch them with a single query per resource
+        instead of one query per relation
+    """
+
+    def __init__(self):
+        self._relations = []
+        self._checks = []
+
+    def defer_check(self, context, resource_name, field):
+        self._checks.append((context, context.get_current_path(),
+                             resource_name, field, context.value))
+
+    def check(self):
+        to_fetch = {}
+        for _, _, resource_name, field, obj_id in self._checks:
+            to_fetch.setdefault((resource_name, field), set()).add(obj_id)
+        fetched = {(resource_name, field): get_resources(resource_name, obj_ids, field=field)
+                   for (resource_name, field), obj_ids in to_fetch.items()}
+        for context, str_path, resource_name, field, obj_id in self._checks:
+            if obj_id not in fetched[(resource_name, field)]:
+                context.add_error("value '%s' must exist in resource"
+                                  " '%s', field '%s'." %
+                                  (obj_id, resource_name, field), path=str_path)
+        self._checks = []
+
+    def defer(self, context, resource_name, field, projection):
+        path = [f for _, f, _ in context._stack[1:]] + [context.field]
+        self._relations.append((context, path, context.get_current_path(),
+                                resource_name, field, projection, context.value))
+
+    def expend(self):
+        from ..resources import strip_resource_fields
+        to_fetch = {}
+        for _, _, _, resource_name, field, projection, obj_id in self._relations:
+            key = (resource_name, field, json.dumps(projection))
+            to_fetch.setdefault(key, (projection, set()))[1].add(obj_id)
+        fetched = {}
+        for (resource_name, field, projection_key), (projection, obj_ids) in to_fetch.items():
+            found = get_resources(resource_name, obj_ids, field=field, projection=projection)
+            fetched[(resource_name, field, projection_key)] = {
+                obj_id: strip_resource_fields(resource_name, obj)
+                for obj_id, obj in found.items()}
+        for context, path, str_path, resource_name, field, projection, obj_id in self._relations:
+            data_relation = fetched[(resource_name, field, json.dumps(projection))].get(obj_id)
+            if not data_relation:
+                context.add_error("value '%s' must exist in resource"
+                                  " '%s', field '%s'." %
+                                  (obj_id, resource_name, field), path=str_path)
+                continue
+            # Documents may have been altered since (e.g. hidden fields removed)
+            try:
+                parent = context.document
+                for key in path[:-1]:
+                    parent = parent[key]
+                if parent[path[-1]] == obj_id:
+                    # Each occurrence gets its own copy, the document may be
+                    # altered afterward
+                    parent[path[-1]] = deepcopy(data_relation)
+            except (KeyError, IndexError, TypeError):
+                continue
+        self._relations = []
+
+
+def _schema_error(msg):
+    """Defer the error of a bad schema until it is run against a value,
+    `{path}` in `msg` is replaced by the path of the value
+    """
+    def raise_schema_error(context):
+        raise SchemaRunnerException(msg.format(path=context.get_current_path()))
+    return raise_schema_error
+
+
 class SchemaRunner:
     def __init__(self, schema, partial=False):
         """
@@ -118,6 +197,7 @@ class SchemaRunner:
         """
         self.schema = schema.copy()
         self.partial = partial
+        self._compiled = None
 
     def type(self, validate_function, serializer=None, name=None):
         """Decorator, register a validate type based on function name"""
@@ -125,108 +205,174 @@ class SchemaRunner:
             name = validate_function.__name__
         setattr(self, '_run_type_' + name, validate_function)
         setattr(self, '_run_serializer_type_' + name, serializer)
+        # Takes precedence over the builtin type of the same name
+        setattr(self, '_compile_type_' + name, None)
+        self._compiled = None
 
     def attribute(self, validate_function, name=None):
         """Decorator, register a validate attribute based on function name"""
         if not name:
             name = validate_function.__name__
         setattr(self, '_run_attribute_' + name, validate_function)
+        # Takes precedence over the builtin attribute of the same name
+        setattr(self, '_compile_attribute_' + name, None)
+        self._compiled = None
+
+    def compile(self):
+        """
+            Turn the schema into a tree of closures to avoid walking through
+            the schema dict for each document. Done at first run if needed,
+            and again if a type or an attribute is registered afterward.
+        """
+        self._root_schema = {'type': 'dict', 'schema': self.schema}
+        self._compiled = self._compile_schema(self._root_schema)
 
     def run(self, document, is_update=False, additional_context=None):
-        context = SchemaRunnerContext({'type': 'dict', 'schema': self.schema},
-                                      document, is_update=is_update,
+        if self._compiled is None:
+            self.compile()
+        context = SchemaRunnerContext(self._root_schema, document,
+                                      is_update=is_update,
                                       additional_context=additional_context)
-        self._run_schema(context)
+        self._compiled(context)
         return context
 
-    def _run_schema(self, context):
+    def _compile_schema(self, schema):
         # A schema must containt a type, which is guaranteed to be applied first
-        if 'type' not in context.schema:
-            raise SchemaRunnerException('{} : schema must contain a `type`'.format(
-                context.get_current_path()))
-        self._run_attribute_type(context)
+        if 'type' not in schema:
+            return _schema_error('{path} : schema must contain a `type`')
+        steps = [self._compile_type(schema)]
         # Apply the rest of the attributes
-        for attribute in context.schema.keys():
-            if attribute == 'type':
-                continue
-            validate_attribute = getattr(self, "_run_attribute_" + attribute, None)
-            if not validate_attribute:
-                if self.partial:
-                    continue
-                raise SchemaRunnerException('{} : unknown attribute `{}`'.format(
-                    context.get_current_path(), attribute))
-            validate_attribute(context)
-
-    def _run_attribute_type(self, context):
-        type_name = context.schema['type']
+        for attribute in schema.keys():
+            if attribute != 'type':
+                steps.append(self._compile_attribute(schema, attribute))
+        steps = [step for step in steps if step]
+        if len(steps) == 1:
+            return steps[0]
+
+        def run_schema(context):
+            for step in steps:
+                step(context)
+        return run_schema
+
+    def _compile_type(self, schema):
+        """Return the validate function of the schema's type, types needing
+        a specialized closure provide a `_compile_type_<name>(schema)` method
+        """
+        type_name = schema['type']
+        compile_type = getattr(self, "_compile_type_" + type_name, None)
+        if compile_type:
+            return compile_type(schema)
         # Retrieve the validate function among object's methods
         validate_type = getattr(self, "_run_type_" + type_name, None)
         if not validate_type:
             if self.partial:
-                return
-            raise SchemaRunnerException('{} : unknown type `{}`'.format(
-                context.get_current_path(), type_name))
-        validate_type(context)
+                return None
+            return _schema_error('{path} : unknown type `%s`' % type_name)
+        return validate_type
 
-    def _run_type_dict(self, context):
-        if not isinstance(context.value, dict):
-            context.add_error(ERROR_BAD_TYPE % 'dict')
-            return
-        # Check for unexpected fields
-        dict_schema = context.schema.get('schema', None)
-        dict_keyschema = context.schema.get('keyschema', None)
+    def _compile_attribute(self, schema, attribute):
+        """Same as `_compile_type` for attributes, a None return means
+        there is nothing to do for this attribute
+        """
+        compile_attribute = getattr(self, "_compile_attribute_" + attribute, None)
+        if compile_attribute:
+            return compile_attribute(schema)
+        validate_attribute = getattr(self, "_run_attribute_" + attribute, None)
+        if not validate_attribute:
+            if self.partial:
+                return None
+            return _schema_error('{path} : unknown attribute `%s`' % attribute)
+        return validate_attribute
+
+    def _compile_type_dict(self, schema):
+        dict_schema = schema.get('schema', None)
+        dict_keyschema = schema.get('keyschema', None)
         if not dict_schema and not dict_keyschema:
-            raise SchemaRunnerException('Dict must have a `schema` or a `keyschema` attribute')
+            return _schema_error('Dict must have a `schema` or a `keyschema` attribute')
         if dict_schema and dict_keyschema:
-            raise SchemaRunnerException('Dict cannot have both `schema` or `keyschema` attributes')
-        if dict_schema:
-            dict_schema_keys = set(dict_schema.keys())
-            value_keys = set(context.value.keys())
-            unexpected_fiels = value_keys - dict_schema_keys
-            for field in unexpected_fiels:
-                value = context.value.pop(field)
-                context.push(None, field, value)
+            return _schema_error('Dict cannot have both `schema` or `keyschema` attributes')
+        if dict_keyschema:
+            return self._compile_keyschema_dict(dict_keyschema)
+        fields = {field: (field_schema, self._compile_schema(field_schema))
+                  for field, field_schema in dict_schema.items()}
+        required_fields = [(field, field_schema) for field, field_schema in dict_schema.items()
+                           if field_schema.get('required', False)]
+
+        def run_dict(context):
+            value = context.value
+            if not isinstance(value, dict):
+                context.add_error(ERROR_BAD_TYPE % 'dict')
+                return
+            # Check for unexpected fields
+            for field in value.keys() - fields.keys():
+                context.push(None, field, value.pop(field))
                 context.add_error(ERROR_UNKNOWN_FIELD)
                 context.pop()
             # Check for missing required fields
             if not context.is_update:
-                missing_fields = dict_schema_keys - value_keys
-                for field in missing_fields:
-                    if dict_schema[field].get('required', False):
-                        context.push(dict_schema[field], field, None)
+                for field, field_schema in required_fields:
+                    if field not in value:
+                        context.push(field_schema, field, None)
                         context.add_error(ERROR_REQUIRED_FIELD)
                         context.pop()
             # Now recursively validate each field
-            for field, value in context.value.items():
-                context.push(dict_schema[field], field, value)
-                self._run_schema(context)
+            for field, field_value in value.items():
+                field_schema, run_field = fields[field]
+                context.push(field_schema, field, field_value)
+                run_field(context)
                 context.pop()
             # If a field containe None as value, it should be skipped
-            no_none_dict = {k: v for k, v in context.value.items() if v != None}
-            if len(context._stack) > 0:
-                s, f, v = context.pop()
-                context.value[f] = no_none_dict
-                context.push(s, f, no_none_dict)
-            else:
-                context.value = context.document = no_none_dict
-        if dict_keyschema:
+            if None in value.values():
+                no_none_dict = {k: v for k, v in value.items() if v is not None}
+                if len(context._stack) > 0:
+                    s, f, v = context.pop()
+                    context.value[f] = no_none_dict
+                    context.push(s, f, no_none_dict)
+                else:
+                    context.value = context.document = no_none_dict
+        return run_dict
+
+    def _compile_keyschema_dict(self, dict_keyschema):
+        run_item = self._compile_schema(dict_keyschema)
+
+        def run_keyschema_dict(context):
+            if not isinstance(context.value, dict):
+                context.add_error(ERROR_BAD_TYPE % 'dict')
+                return
             # Just recursively validate each sub item
             for field, value in context.value.items():
                 context.push(dict_keyschema, field, value)
-                self._run_schema(context)
+                run_item(context)
                 context.pop()
+        return run_keyschema_dict
 
-    def _run_type_list(self, context):
-        if not isinstance(context.value, list):
-            context.add_error(ERROR_BAD_TYPE % 'list')
-            return
-        list_schema = context.schema.get('schema', None)
+    def _compile_type_list(self, schema):
+        list_schema = schema.get('schema', None)
         if not list_schema:
-            raise SchemaRunnerException('List must have a `schema` attribute')
-        for i, elem in enumerate(context.value):
-            context.push(list_schema, i, elem)
-            self._run_schema(context)
-            context.pop()
+            return _schema_error('List must have a `schema` attribute')
+        run_elem = self._compile_schema(list_schema)
+
+        def run_list(context):
+            if not isinstance(context.value, list):
+                context.add_error(ERROR_BAD_TYPE % 'list')
+                return
+            for i, elem in enumerate(context.value):
+                context.push(list_schema, i, elem)
+                run_elem(context)
+                context.pop()
+        return run_list
+
+
+def _is_hidden_disabled(context):
+    """Hidden fields are visible in internal mode or if explicitly
+    specified in the additional_context
+    """
+    if context.additional_context.get('internal', False):
+        return True
+    hidden_additional = context.additional_context.get('hidden')
+    if hidden_additional:
+        return not hidden_additional.get(context.get_current_path(), True)
+    return False
 
 
 class Unserializer(SchemaRunner):
@@ -241,35 +387,40 @@ class Unserializer(SchemaRunner):
             kwargs['is_update'] = True
         return super().run(*args, **kwargs)
 
-    def _run_type_set(self, context):
-        set_schema = context.schema.get('schema', None)
+    def _compile_type_set(self, schema):
+        set_schema = schema.get('schema', None)
         if not set_schema:
-            raise SchemaRunnerException('Set must have a `schema` attribute')
-        if isinstance(context.value, list):
-            unserialized = set(context.value)
-            schema, field, _ = context.pop()
-            context.value[field] = unserialized
-            context.push(schema, field, unserialized)
-            for i, elem in enumerate(context.value):
-                context.push(set_schema, i, elem)
-                self._run_schema(context)
-                context.pop()
-        else:
-            context.add_error(ERROR_STORAGE_TYPE % ('set', 'list'))
+            return _schema_error('Set must have a `schema` attribute')
+        run_elem = self._compile_schema(set_schema)
 
-    def _run_attribute_hidden(self, context):
+        def run_set(context):
+            if isinstance(context.value, list):
+                unserialized = set(context.value)
+                schema, field, _ = context.pop()
+                context.value[field] = unserialized
+                context.push(schema, field, unserialized)
+                for i, elem in enumerate(context.value):
+                    context.push(set_schema, i, elem)
+                    run_elem(context)
+                    context.pop()
+            else:
+                context.add_error(ERROR_STORAGE_TYPE % ('set', 'list'))
+        return run_set
+
+    def _compile_attribute_hidden(self, schema):
         """Remove current element from the unserialized document"""
-        # Don't hide the element if we are in internal mode or if the
-        # field is explicitly specified in the additional_context
-        if context.additional_context.get('internal', False):
-            return
-        hidden_additional = context.additional_context.get('hidden', {})
-        if not hidden_additional.get(context.get_current_path(), True):
-            return
-        if context.schema['hidden']:
+        if not schema['hidden']:
+            return None
+
+        def run_hidden(context):
+            # Don't hide the element if we are in internal mode or if the
+            # field is explicitly specified in the additional_context
+            if _is_hidden_disabled(context):
+                return
             schema, field, _ = context.pop()
             context.value[field] = None
             context.push(schema, field, None)
+        return run_hidden
 
     def _run_attribute_expend(self, context):
         # Stub, handled in `_run_attribute_data_relation`
@@ -283,7 +434,9 @@ class Unserializer(SchemaRunner):
         # Expend relation if asked for
         expend_additional = context.additional_context.get('expend', {})
         if isinstance(expend_additional, dict):
-            expend = expend_additional.get(context.get_current_path(), data_relation.get('expend', False))
+            expend = data_relation.get('expend', False)
+            if expend_additional:
+                expend = expend_additional.get(context.get_current_path(), expend)
         else:
             expend = expend_additional
         if expend:
@@ -293,6 +446,10 @@ class Unserializer(SchemaRunner):
             if not resource_name or not field:
                 raise SchemaRunnerException("`data_relation` requires"
                                             " `field` and `resource` fiels")
+            relations_batch = context.additional_context.get('relations_batch')
+            if relations_batch:
+                relations_batch.defer(context, resource_name, field, projection)
+                return
             data_relation = get_resource(resource_name, context.value, field=field,
                                          projection=projection, auto_abort=False)
             if not data_relation:
@@ -331,25 +488,28 @@ class GenericValidator(SchemaRunner):
         if context.schema['read_only']:
             context.add_error(ERROR_READONLY_FIELD)
 
-    def _run_attribute_hidden(self, context):
+    def _compile_attribute_hidden(self, schema):
         """Consider the current element as unknown"""
-        # Don't hide the element if we are in internal mode or if the
-        # field is explicitly specified in the additional_context
-        if context.additional_context.get('internal', False):
-            return
-        hidden_additional = context.additional_context.get('hidden', {})
-        if not hidden_additional.get(context.get_current_path(), True):
-            return
-        if context.schema['hidden']:
-            context.add_error(ERROR_UNKNOWN_FIELD)
+        if not schema['hidden']:
+            return None
 
-    def _run_attribute_regex(self, context):
-        regex = context.schema['regex']
-        pattern = re.compile(regex)
-        if not isinstance(context.value, str):
-            context.add_error(ERROR_BAD_TYPE % 'string')
-        elif not pattern.match(context.value):
-            context.add_error(ERROR_REGEX % regex)
+        def run_hidden(context):
+            # Don't hide the element if we are in internal mode or if the
+            # field is explicitly specified in the additional_context
+            if not _is_hidden_disabled(context):
+                context.add_error(ERROR_UNKNOWN_FIELD)
+        return run_hidden
+
+    def _compile_attribute_regex(self, schema):
+        regex = schema['regex']
+        match = re.compile(regex).match
+
+        def run_regex(context):
+            if not isinstance(context.value, str):
+                context.add_error(ERROR_BAD_TYPE % 'string')
+            elif not match(context.value):
+                context.add_error(ERROR_REGEX % regex)
+        return run_regex
 
     def _run_type_datetime(self, context):
         # If value is not a datetime object, try to unserialize it
@@ -441,34 +601,38 @@ class GenericValidator(SchemaRunner):
         # Stub, required is handled in `_run_type_dict`
         pass
 
-    def _run_type_set(self, context):
-        set_schema = context.schema.get('schema', None)
+    def _compile_type_set(self, schema):
+        set_schema = schema.get('schema', None)
         if not set_schema:
-            raise SchemaRunnerException('Set must have a `schema` attribute')
-        error = lambda: context.add_error(ERROR_BAD_TYPE % 'set')
-        if isinstance(context.value, set):
-            # Given set is not supported in mongodb, it is stored as a list
-            serialized = list(context.value)
-            schema, field, _ = context.pop()
-            context.value[field] = serialized
-            context.push(schema, field, serialized)
-        elif isinstance(context.value, list):
-            # Try to convert list into set then make sure it's
-            # a valid set (i.e. each element is unique)
-            try:
-                set_value = set(context.value)
-                # Make sure we didn't loose any element
-                if len(set_value) != len(context.value):
+            return _schema_error('Set must have a `schema` attribute')
+        run_elem = self._compile_schema(set_schema)
+
+        def run_set(context):
+            error = lambda: context.add_error(ERROR_BAD_TYPE % 'set')
+            if isinstance(context.value, set):
+                # Given set is not supported in mongodb, it is stored as a list
+                serialized = list(context.value)
+                schema, field, _ = context.pop()
+                context.value[field] = serialized
+                context.push(schema, field, serialized)
+            elif isinstance(context.value, list):
+                # Try to convert list into set then make sure it's
+                # a valid set (i.e. each element is unique)
+                try:
+                    set_value = set(context.value)
+                    # Make sure we didn't loose any element
+                    if len(set_value) != len(context.value):
+                        return error()
+                except TypeError:
                     return error()
-            except TypeError:
+            else:
+                # No other convertion possible...
                 return error()
-        else:
-            # No other convertion possible...
-            return error()
-        for i, elem in enumerate(context.value):
-            context.push(set_schema, i, elem)
-            self._run_schema(context)
-            context.pop()
+            for i, elem in enumerate(context.value):
+                context.push(set_schema, i, elem)
+                run_elem(context)
+                context.pop()
+        return run_set
 
     def _run_type_geometrycollection(self, context):
         try:
@@ -582,6 +746,10 @@ class Validator(GenericValidator):
             context.value[field] = serialized
             context.push(schema, field, serialized)
         else:
+            relations_batch = context.additional_context.get('relations_batch')
+            if relations_batch and not context.schema['data_relation'].get('validator'):
+                relations_batch.defer_check(context, resource_name, field)
+                return
             data_relation = get_resource(resource_name, context.value,
                                          field=field, auto_abort=False)
             if not data_relation:
@@ -595,13 +763,5 @@ class Validator(GenericValidator):
 
 
     def _run_attribute_unique(self, context):
-        if not context.schema['unique']:
-            return
-        query = {context.field: context.value}
-        old_document = context.additional_context.get('old_document', {})
-        document_id = old_document.get('_id', None)
-        if document_id:
-            query['_id'] = {'$ne': document_id}
-        resource_name = context.additional_context['resource'].name
-        if current_app.data.db[resource_name].find_one(query):
-            context.add_error(ERROR_UNIQUE_FIELD % context.value)
+        # Stub, enforced by the unique indexes (see `Resource.ensure_indexes`)
+        pass
@@ -1,38 +1,263 @@
-from flask import request, abort, current_app, g
+from flask import request, abort, current_app, g, Response, stream_with_context
 from pymongo.cursor import Cursor
+import base64
+import hashlib
 import json
+import bson
+import bson.errors
 
-from .tools import jsonify, parse_id
+from .tools import (jsonify, parse_id, dumps_json, is_not_modified,
+                    make_not_modified_response)
+from .cache import get_resource_cache, get_count_cache
+
+
+# Number of documents retrieved by each query of a streamed response
+STREAM_BATCH_SIZE = 500
+# Minimal size (in bytes) of the chunks of a streamed response
+STREAM_CHUNK_SIZE = 64 * 1024
 
 
 class Paginator:
-    """Pagination heavy lifting"""
+    """
+        Pagination heavy lifting
+
+        Two modes are available:
+         - page number (default): `page` and `max_results` params
+         - cursor: `cursor` param (empty for the first page), the response
+           provides in `_meta.next` the cursor of the next page. Instead of
+           skipping the previous pages, the query starts after the last
+           returned document (sort fields must then be present in all
+           the documents), use `find` to benefit of it.
+
+        The `total` param controls the total returned (only provided on
+        demand in cursor mode):
+         - true (default): estimated for unfiltered lookups, otherwise
+           counted or retrieved from the counts cache
+         - exact: always counted
+         - false: not provided
+        `_meta.total_kind` tells which kind of total is returned.
+
+        The `stream` param (`ndjson` or `json`) returns instead all the
+        documents (or the first `max_results` ones) in a chunked response,
+        documents are serialized as soon as they are read from the database.
+    """
     def __init__(self, max_results_limit=100, args=None):
         args = args if args else request.args
+        self.stream = args.get('stream')
+        if self.stream not in (None, 'ndjson', 'json'):
+            abort(422, {'stream': 'must be ndjson or json'})
         # Check request params
         try:
-            self.max_results = int(args.get('max_results', 20))
-            self.page = int(args.get('page', 1))
+            if self.stream:
+                # No limit by default when streaming
+                self.max_results = int(args.get('max_results', 0))
+                self.page = 1
+            else:
+                self.max_results = int(args.get('max_results', 20))
+                self.page = int(args.get('page', 1))
             self.skip = (self.page - 1) * self.max_results
-            if self.skip < 0:
+            if self.skip < 0 or self.max_results < 0:
                 abort(422, 'page params must be > 0')
-            if self.max_results > max_results_limit:
+            if self.max_results > max_results_limit and not self.stream:
                 abort(422, 'max_results params must be < {}'.format(
                     max_results_limit))
         except ValueError:
             abort(422, 'Invalid max_results and/or page params')
+        self.cursor_mode = 'cursor' in args
+        if self.cursor_mode and self.stream:
+            abort(422, {'stream': 'cannot be used with cursor'})
+        self.cursor = decode_cursor(args['cursor']) if args.get('cursor') else None
+        self.sort = None
+        # Total is not provided by default in cursor mode
+        self.total_mode = args.get('total', 'false' if self.cursor_mode else 'true').lower()
+        if self.total_mode not in ('true', 'exact', 'false'):
+            abort(422, {'total': 'must be true, exact or false'})
+        self.total_kind = None
+        self.selection = get_selection_params(args)
+
+    def count(self, resource, lookup=None):
+        """Return the total of documents of the lookup according to
+        the `total` param"""
+        if self.total_mode == 'false':
+            self.total_kind = 'disabled'
+            return None
+        collection = current_app.data.db[resource.name]
+        if not lookup and self.total_mode != 'exact':
+            self.total_kind = 'estimated'
+            return collection.estimated_document_count()
+        counts_cache = get_count_cache(resource.name)
+        key = None
+        if counts_cache:
+            try:
+                key = bson.BSON.encode(lookup or {})
+            except bson.errors.InvalidDocument:
+                pass
+        if key and self.total_mode != 'exact':
+            total = counts_cache.get(key)
+            if total is not None:
+                self.total_kind = 'cached'
+                return total
+        total = collection.count_documents(lookup or {})
+        if key:
+            counts_cache.set(key, total)
+        self.total_kind = 'exact'
+        return total
+
+    def find(self, resource, lookup=None, *args, sort=None, **kwargs):
+        """Call `resource.find` with the pagination and selection parameters"""
+        kwargs = dict(self.selection, **kwargs)
+        if self.stream:
+            return resource.find(lookup, *args, sort=sort, limit=self.max_results,
+                                 batch_size=STREAM_BATCH_SIZE, count=False, **kwargs)
+        total = self.count(resource, lookup)
+        if not self.cursor_mode:
+            found, _ = resource.find(lookup, *args, sort=sort, skip=self.skip,
+                                     limit=self.max_results, count=False, **kwargs)
+            return found, total
+        # `_id` is the tie-breaker between documents with the same sort values
+        self.sort = [s for s in sort or [] if s[0] != '_id']
+        self.sort.append(('_id', self.sort[-1][1] if self.sort else 1))
+        if self.cursor:
+            if [field for field, _ in self.sort] != self.cursor['fields']:
+                abort(422, {'cursor': 'cursor not generated for this request'})
+            after = build_keyset_lookup(self.sort, self.cursor['values'])
+            lookup = {'$and': [lookup, after]} if lookup else after
+        # Retrieve one more document to know if there is a next page
+        found, _ = resource.find(lookup, *args, sort=self.sort,
+                                 limit=self.max_results + 1, count=False, **kwargs)
+        return found, total
 
     def make_response(self, items, total=None):
+        if self.stream:
+            return self._make_stream_response(items)
         if isinstance(items, Cursor):
-            total = items.count(with_limit_and_skip=False)
+            if self.total_mode != 'false':
+                total = items.count(with_limit_and_skip=False)
+                self.total_kind = 'exact'
             items = list(items)
-        return jsonify({
-            '_items': items,
-            '_meta': {'max_results': self.max_results,
-                      'total': total,
-                      'page': self.page}
+        if self.total_kind is None:
+            # Total computed by the caller
+            self.total_kind = 'exact' if total is not None else 'disabled'
+        if self.cursor_mode:
+            return self._make_cursor_response(items, total)
+        return self._make_json_response(items, {
+            'max_results': self.max_results,
+            'total': total,
+            'total_kind': self.total_kind,
+            'page': self.page
         })
 
+    def _make_cursor_response(self, items, total):
+        items = list(items)
+        next_cursor = None
+        if len(items) > self.max_results:
+            items = items[:self.max_results]
+            last = items[-1]
+            next_cursor = encode_cursor([field for field, _ in self.sort],
+                                        [_get_sort_value(last, field) for field, _ in self.sort])
+        return self._make_json_response(items, {
+            'max_results': self.max_results,
+            'total': total,
+            'total_kind': self.total_kind,
+            'next': next_cursor
+        })
+
+    def _make_json_response(self, items, meta):
+        # `items` may be a generator, it is iterated by the etag then jsonify
+        items = list(items)
+        etag = build_list_etag(items, meta)
+        if is_not_modified(etag):
+            return make_not_modified_response(etag, weak=True)
+        response = jsonify({'_items': items, '_meta': meta})
+        response.set_etag(etag, weak=True)
+        return response
+
+    def _make_stream_response(self, items):
+        if isinstance(items, Cursor):
+            items.batch_size(STREAM_BATCH_SIZE)
+        ndjson = self.stream == 'ndjson'
+
+        def generate():
+            # Group the serialized documents to avoid sending tiny chunks
+            chunk = []
+            size = 0
+            first = True
+            for item in items:
+                serialized = dumps_json(item)
+                if ndjson:
+                    chunk.append(serialized + b'\n')
+                else:
+                    chunk.append((b'[' if first else b',') + serialized)
+                first = False
+                size += len(serialized)
+                if size >= STREAM_CHUNK_SIZE:
+                    yield b''.join(chunk)
+                    chunk = []
+                    size = 0
+            if not ndjson:
+                chunk.append(b'[]' if first else b']')
+            yield b''.join(chunk)
+
+        mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+        return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
+def build_list_etag(items, meta=None):
+    """Weak etag of a page of documents, derived from the most recent
+    `_updated` of the documents, their ids (to detect removals) and
+    etags (`_updated` has a one second resolution)"""
+    h = hashlib.sha1()
+    updated = [item['_updated'] for item in items if item.get('_updated')]
+    h.update(str(max(updated) if updated else None).encode())
+    for item in items:
+        h.update(('%s:%s;' % (item.get('_id'), item.get('_etag'))).encode())
+    if meta:
+        h.update(str(sorted(meta.items())).encode())
+    return h.hexdigest()
+
+
+def _get_sort_value(document, field):
+    value = document
+    for key in field.split('.'):
+        value = value.get(key) if isinstance(value, dict) else None
+    # Expended data relation
+    if isinstance(value, dict) and '_id' in value:
+        value = value['_id']
+    return value
+
+
+def encode_cursor(fields, values):
+    """Return an opaque token of the sort values of the last document"""
+    # BSON keeps the type (datetime, ObjectId...) of the sort values
+    raw = bson.BSON.encode({'f': fields, 'v': values})
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        decoded = bson.BSON(raw).decode()
+        fields, values = decoded['f'], decoded['v']
+        if len(fields) != len(values):
+            raise ValueError()
+    except Exception:
+        abort(422, {'cursor': 'invalid cursor'})
+    return {'fields': fields, 'values': values}
+
+
+def build_keyset_lookup(sort, values):
+    """
+        Return the lookup of the documents after the given sort values,
+        i.g. with sort `[('a', 1), ('_id', 1)]`:
+        `{'$or': [{'a': {'$gt': a}}, {'a': a, '_id': {'$gt': _id}}]}`
+    """
+    branches = []
+    for i, (field, direction) in enumerate(sort):
+        branch = {f: v for (f, _), v in zip(sort[:i], values[:i])}
+        branch[field] = {'$gt' if direction == 1 else '$lt': values[i]}
+        branches.append(branch)
+    return {'$or': branches} if len(branches) > 1 else branches[0]
+
 
 def get_resource(resource, obj_id, field='_id', auto_abort=True, projection=None):
     """Retrieve object from database with it ID and resource name"""
@@ -48,16 +273,66 @@ def get_resource(resource, obj_id, field='_id', auto_abort=True, projection=None
     key = (resource, obj_id, field, json.dumps(projection))
     obj = g._cache_get_resource.get(key)
     if not obj:
-        obj = current_app.data.db[resource].find_one({field: obj_id}, projection)
+        # Per-request cache miss, try the process-wide one
+        process_cache = get_resource_cache(resource)
+        if process_cache:
+            generation = process_cache.generation
+            obj = process_cache.get(key[1:])
         if not obj:
-            if auto_abort:
-                abort(404, '`{}` is not a valid {} resource'.format(obj_id, resource))
-            else:
-                return None
+            obj = current_app.data.db[resource].find_one({field: obj_id}, projection)
+            if not obj:
+                if auto_abort:
+                    abort(404, '`{}` is not a valid {} resource'.format(obj_id, resource))
+                else:
+                    return None
+            if process_cache:
+                process_cache.set(key[1:], obj, generation)
         g._cache_get_resource[key] = obj
     return obj
 
 
+def get_resources(resource, obj_ids, field='_id', projection=None):
+    """
+        Retrieve multiple objects from database with a single query,
+        returns a dict of the found objects by id
+    """
+    if not getattr(g, '_cache_get_resource', None):
+        g._cache_get_resource = {}
+    projection_key = json.dumps(projection)
+    found = {}
+    missing = set()
+    for obj_id in obj_ids:
+        obj = g._cache_get_resource.get((resource, obj_id, field, projection_key))
+        if obj:
+            found[obj_id] = obj
+        else:
+            missing.add(obj_id)
+    process_cache = get_resource_cache(resource) if missing else None
+    if process_cache:
+        generation = process_cache.generation
+        for obj_id in list(missing):
+            obj = process_cache.get((obj_id, field, projection_key))
+            if obj:
+                found[obj_id] = obj
+                g._cache_get_resource[(resource, obj_id, field, projection_key)] = obj
+                missing.remove(obj_id)
+    if missing and projection is not None and field != '_id':
+        # The projection may not return the field needed to know which
+        # object has been retrieved, fallback to one query per object
+        for obj_id in missing:
+            obj = get_resource(resource, obj_id, field=field,
+                               projection=projection, auto_abort=False)
+            if obj:
+                found[obj_id] = obj
+    elif missing:
+        for obj in current_app.data.db[resource].find({field: {'$in': list(missing)}}, projection):
+            found[obj[field]] = obj
+            g._cache_get_resource[(resource, obj[field], field, projection_key)] = obj
+            if process_cache:
+                process_cache.set((obj[field], field, projection_key), obj, generation)
+    return found
+
+
 def get_payload(allowed_fields=None):
     """Return the json payload if present or abort request"""
     payload = request.get_json()
@@ -115,6 +390,17 @@ def get_url_params(params_spec=None, args=None):
     return result
 
 
+def get_selection_params(args=None):
+    """
+        Return the `fields` and `expand` params of the request to pass to
+        `Resource.find` or `Resource.find_one`, both are comma-separated
+        lists of field paths (e.g. `?fields=titre,observations.tadarida_taxon`)
+        and an empty `expand` disables the expansion of the data relations
+    """
+    args = args if args else request.args
+    return {param: args[param] for param in ('fields', 'expand') if param in args}
+
+
 def get_if_match():
     """Return the If-Match header if present or abort request"""
     if_match = request.headers.get('If-Match', None)
@@ -14,6 +14,10 @@ from flask import app, current_app, abort, request
 from flask_pymongo import PyMongo
 from bson.json_util import dumps
 from werkzeug.routing import BaseConverter, ValidationError
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 def dict_projection(data, projection):
@@ -95,6 +99,19 @@ def build_etag(value):
     return h.hexdigest()
 
 
+def is_not_modified(etag):
+    """Check the If-None-Match header of a GET request against the etag"""
+    if not etag or request.method not in ('GET', 'HEAD'):
+        return False
+    return request.if_none_match.contains_weak(etag)
+
+
+def make_not_modified_response(etag, weak=False):
+    response = Response(status=304)
+    response.set_etag(etag, weak=weak)
+    return response
+
+
 def compare_objectid(id1, id2):
     id1 = ObjectId(id1) if not isinstance(id1, ObjectId) else id1
     id2 = ObjectId(id2) if not isinstance(id2, ObjectId) else id2
@@ -114,13 +131,64 @@ class MongoJsonEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+def _dumps_stdlib(value, consumed=None):
+    # Compact and not ASCII escaped to match orjson's output
+    default = None
+    if consumed:
+        # Iterators already consumed by a failed orjson serialization
+        encoder = MongoJsonEncoder()
+        default = lambda obj: consumed[id(obj)] if id(obj) in consumed else encoder.default(obj)
+    return json.dumps(value, cls=MongoJsonEncoder, default=default, separators=(',', ':'),
+                      ensure_ascii=False).encode('utf-8')
+
+
+def _dumps_orjson(value):
+    consumed = {}
+
+    def default(obj):
+        # datetimes are natively serialized by orjson
+        if isinstance(obj, bson.ObjectId):
+            return str(obj)
+        elif hasattr(obj, "__iter__"):
+            consumed[id(obj)] = converted = list(obj)
+            return converted
+        raise TypeError('Object of type %s is not JSON serializable' % type(obj).__name__)
+
+    try:
+        return orjson.dumps(value, default=default, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        # orjson doesn't support the integers beyond 64 bits
+        return _dumps_stdlib(value, consumed)
+
+
+# Backends produce the same output except for the floats written with an
+# exponent (`1e-05` by stdlib, `0.00001` by orjson) and NaN/Infinity
+# (`NaN` by stdlib, `null` by orjson), see docs/api_routes.md
+JSON_BACKENDS = {'stdlib': _dumps_stdlib}
+if orjson:
+    JSON_BACKENDS['orjson'] = _dumps_orjson
+_json_backend = JSON_BACKENDS['orjson' if orjson else 'stdlib']
+
+
+def set_json_backend(name):
+    """Select the backend used by `dumps_json` (`stdlib` or `orjson`)"""
+    global _json_backend
+    if name not in JSON_BACKENDS:
+        raise RuntimeError('JSON backend `%s` is not available' % name)
+    _json_backend = JSON_BACKENDS[name]
+
+
+def dumps_json(value):
+    """Serialize in utf-8 encoded JSON with support for MongoDB types"""
+    return _json_backend(value)
+
+
 def jsonify(*args, **kwargs):
     """
         jsonify with support for MongoDB ObjectId
         (see: https://gist.github.com/akhenakh/2954605)
     """
-    return Response(json.dumps(dict(*args, **kwargs), cls=MongoJsonEncoder),
-                               mimetype='application/json')
+    return Response(dumps_json(dict(*args, **kwargs)), mimetype='application/json')
 
 
 def parse_id(obj_id):